@@ -0,0 +1,252 @@
+"""
+Backed(out-of-core)模式: 表达矩阵保留在磁盘上，按块执行质控、标准化与高变基因选择
+
+预处理结果（高变基因的对数表达矩阵）逐块追加写入磁盘上的h5ad文件并以backed模式返回，
+预处理的峰值内存只与 chunk_size 相关，不随细胞总数增长，用于数百万细胞规模的图谱数据。
+之后的阶段会把高变基因矩阵（稀疏，n_obs × n_HVG）载入内存。
+"""
+
+import logging
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+try:
+    from anndata.io import sparse_dataset, write_elem
+except ImportError:
+    from anndata.experimental import sparse_dataset, write_elem
+
+
+def iter_chunks(X, chunk_size: int, n_obs: Optional[int] = None) -> Iterator[Tuple[int, int, sp.csr_matrix]]:
+    """
+    按行分块读取表达矩阵
+
+    Args:
+        X: 内存矩阵或backed数据集（h5py Dataset / anndata稀疏数据集）
+        chunk_size: 每块的细胞数
+        n_obs: 总行数，默认取 X.shape[0]
+
+    Yields:
+        (起始行, 结束行, CSR格式的数据块)
+    """
+    n_obs = X.shape[0] if n_obs is None else n_obs
+    for start in range(0, n_obs, chunk_size):
+        end = min(start + chunk_size, n_obs)
+        chunk = X[start:end]
+        if sp.issparse(chunk):
+            chunk = sp.csr_matrix(chunk)
+        else:
+            chunk = sp.csr_matrix(np.asarray(chunk))
+        chunk.eliminate_zeros()
+        yield start, end, chunk
+
+
+def write_h5ad(path: str, adata):
+    """
+    把AnnData写入h5ad文件
+
+    与 AnnData.write 不同，backed对象写出后仍指向原文件：AnnData.write 会关闭并重新打开backed文件句柄，
+    与此同时并发执行的阶段（如可视化导出）可能正在读取它。
+    """
+    try:
+        from anndata.io import write_h5ad as _write_h5ad
+    except ImportError:
+        from anndata._io import write_h5ad as _write_h5ad
+    _write_h5ad(path, adata)
+
+
+def write_h5ad_chunks(path: str, chunks: Iterator[sp.csr_matrix], obs: pd.DataFrame, var: pd.DataFrame,
+                      uns: Optional[dict] = None):
+    """
+    把按行分块产出的CSR表达矩阵逐块追加写入h5ad文件，不在内存中拼接
+
+    Args:
+        path: h5ad文件路径
+        chunks: 依次产出的CSR数据块，行数之和等于 obs 的行数
+        obs: 细胞元数据
+        var: 基因元数据
+        uns: 非结构化元数据
+    """
+    import h5py
+
+    with h5py.File(path, 'w') as f:
+        matrix = None
+        for chunk in chunks:
+            if matrix is None:
+                write_elem(f, 'X', chunk)
+                matrix = sparse_dataset(f['X'])
+            else:
+                matrix.append(chunk)
+        if matrix is None:
+            write_elem(f, 'X', sp.csr_matrix((0, var.shape[0]), dtype=np.float32))
+        for key, value in (('obs', obs), ('var', var), ('uns', uns or {}), ('obsm', {}), ('varm', {}),
+                           ('obsp', {}), ('varp', {}), ('layers', {})):
+            write_elem(f, key, value)
+
+
+def mito_gene_mask(var: pd.DataFrame) -> np.ndarray:
+    """线粒体基因掩码：优先使用 var['mt']，否则按 'MT-' 前缀识别"""
+    if 'mt' in var.columns:
+        return var['mt'].to_numpy(dtype=bool)
+    return np.asarray(var.index.str.upper().str.startswith('MT-'), dtype=bool)
+
+
+def select_hvg_seurat(mean: np.ndarray, var: np.ndarray, n_top_genes: int, n_bins: int = 20) -> pd.DataFrame:
+    """
+    基于均值与方差按Seurat方式选择高变基因（与 sc.pp.highly_variable_genes 的默认flavor一致）
+
+    Args:
+        mean: 标准化后（未取对数）表达量的基因均值
+        var: 标准化后（未取对数）表达量的基因方差
+        n_top_genes: 选取的高变基因数量
+        n_bins: 按均值分箱的数量
+
+    Returns:
+        包含 means、dispersions、dispersions_norm、highly_variable 列的DataFrame
+    """
+    mean = mean.astype(np.float64).copy()
+    mean[mean == 0] = 1e-12
+    dispersion = var / mean
+    dispersion[dispersion == 0] = np.nan
+    dispersion = np.log(dispersion)
+    mean = np.log1p(mean)
+
+    df = pd.DataFrame({'means': mean, 'dispersions': dispersion})
+    df['mean_bin'] = pd.cut(df['means'], bins=n_bins)
+    disp_grouped = df.groupby('mean_bin', observed=False)['dispersions']
+    disp_mean_bin = disp_grouped.mean()
+    disp_std_bin = disp_grouped.std(ddof=1)
+    # 只有一个基因的分箱无法计算标准差，直接将其归一化为1
+    one_gene_per_bin = disp_std_bin.isnull()
+    disp_std_bin[one_gene_per_bin] = disp_mean_bin[one_gene_per_bin]
+    disp_mean_bin[one_gene_per_bin] = 0
+    df['dispersions_norm'] = (
+        (df['dispersions'].to_numpy() - disp_mean_bin[df['mean_bin']].to_numpy())
+        / disp_std_bin[df['mean_bin']].to_numpy()
+    )
+
+    dispersion_norm = df['dispersions_norm'].to_numpy()
+    valid = dispersion_norm[~np.isnan(dispersion_norm)]
+    n_top_genes = min(n_top_genes, len(valid))
+    highly_variable = np.zeros(len(df), dtype=bool)
+    if n_top_genes > 0:
+        threshold = np.sort(valid)[::-1][n_top_genes - 1]
+        highly_variable = np.nan_to_num(dispersion_norm, nan=-np.inf) >= threshold
+
+    df['highly_variable'] = highly_variable
+    return df.drop(columns='mean_bin')
+
+
+class BackedPreprocessor:
+    """对backed模式的AnnData按块执行预处理"""
+
+    def __init__(self, adata, chunk_size: int = 20000, n_threads: Optional[int] = None):
+        """
+        初始化分块预处理器
+
+        Args:
+            adata: 以 backed='r' 方式打开的AnnData
+            chunk_size: 每块的细胞数
+            n_threads: 质控计算使用的线程数
+        """
+        self.logger = logging.getLogger(__name__)
+        self.adata = adata
+        self.chunk_size = chunk_size
+        self.n_threads = n_threads
+        self.cell_mask = None
+        self.gene_mask = None
+
+    def _normalized_chunks(self, target_sum: float) -> Iterator[sp.csr_matrix]:
+        """按块产出过滤后、标准化并取对数的表达矩阵"""
+        for start, end, chunk in iter_chunks(self.adata.X, self.chunk_size):
+            chunk = chunk[self.cell_mask[start:end]][:, self.gene_mask].astype(np.float32)
+            if chunk.shape[0] == 0:
+                continue
+            totals = np.asarray(chunk.sum(axis=1)).ravel()
+            scale = np.divide(target_sum, totals, out=np.zeros_like(totals), where=totals > 0)
+            chunk = sp.csr_matrix(sp.diags(scale) @ chunk)
+            np.log1p(chunk.data, out=chunk.data)
+            yield chunk
+
+    @staticmethod
+    def _write_store(store_path: str, chunks: Iterator[sp.csr_matrix], obs: pd.DataFrame,
+                     var: pd.DataFrame, uns: dict):
+        """把表达矩阵逐块追加写入h5ad文件，返回以backed模式打开的AnnData"""
+        import anndata as ad
+
+        write_h5ad_chunks(store_path, chunks, obs, var, uns)
+        return ad.read_h5ad(store_path, backed='r')
+
+    def run(self, store_path: str, min_genes: int = 200, min_cells: int = 3, max_genes: int = 5000,
+            max_mt_percent: float = 10.0, n_top_genes: int = 2000,
+            target_sum: float = 1e4):
+        """
+        执行完整的分块预处理
+
+        Args:
+            store_path: 预处理结果h5ad文件路径，高变基因矩阵逐块追加写入，不在内存中拼接
+
+        Returns:
+            以backed模式打开的AnnData，包含高变基因对数表达矩阵与质控指标
+        """
+        from app.analysis.qc import QCEngine
+
+        self.logger.info(f"backed模式预处理，每块 {self.chunk_size} 个细胞")
+
+        # 质控与过滤：单次扫描得到细胞掩码和通过质控细胞中的基因表达细胞数
+        self.qc_engine = QCEngine(n_threads=self.n_threads, chunk_size=self.chunk_size)
+        with self.qc_engine.timed('qc_metrics'):
+            qc = self.qc_engine.compute(self.adata.X, self.adata.var, min_genes, max_genes, max_mt_percent)
+        qc_df = qc['obs']
+        self.cell_mask = qc['cell_mask']
+        self.gene_n_cells = qc['gene_n_cells']
+        self.gene_mask = self.gene_n_cells >= min_cells
+        self.logger.info(f"质控后保留 {int(self.cell_mask.sum())} 个细胞, {int(self.gene_mask.sum())} 个基因")
+
+        # 标准化后表达量的一阶、二阶矩，用于高变基因选择
+        with self.qc_engine.timed('highly_variable_genes'):
+            n_vars = int(self.gene_mask.sum())
+            gene_sum = np.zeros(n_vars, dtype=np.float64)
+            gene_sq_sum = np.zeros(n_vars, dtype=np.float64)
+            n_cells = 0
+            for chunk in self._normalized_chunks(target_sum):
+                counts = chunk.copy()
+                np.expm1(counts.data, out=counts.data)
+                gene_sum += np.asarray(counts.sum(axis=0)).ravel()
+                counts.data **= 2
+                gene_sq_sum += np.asarray(counts.sum(axis=0)).ravel()
+                n_cells += chunk.shape[0]
+
+            mean = gene_sum / n_cells
+            variance = (gene_sq_sum - n_cells * mean ** 2) / max(n_cells - 1, 1)
+            hvg_df = select_hvg_seurat(mean, variance, n_top_genes)
+            hvg_mask = hvg_df['highly_variable'].to_numpy()
+
+        var = self.adata.var.loc[self.gene_mask].copy()
+        var['n_cells'] = self.gene_n_cells[self.gene_mask]
+        for column in ['means', 'dispersions', 'dispersions_norm', 'highly_variable']:
+            var[column] = hvg_df[column].to_numpy()
+        var = var.loc[hvg_mask]
+
+        obs = self.adata.obs.loc[self.cell_mask].copy()
+        for column in qc_df.columns:
+            obs[column] = qc_df[column].to_numpy()[self.cell_mask]
+
+        uns = {
+            'log1p': {'base': None},
+            'backed_preprocessing': {
+                'chunk_size': self.chunk_size,
+                'n_obs_raw': int(self.adata.n_obs),
+                'n_vars_raw': int(self.adata.n_vars),
+            },
+        }
+
+        # 只保留高变基因的对数表达矩阵（稀疏），逐块写入磁盘；PCA在之后的PCA阶段按块完成
+        with self.qc_engine.timed('hvg_matrix'):
+            result = self._write_store(
+                store_path, (chunk[:, hvg_mask] for chunk in self._normalized_chunks(target_sum)), obs, var, uns
+            )
+        result.uns['preprocess_timings'] = dict(self.qc_engine.timings)
+        return result
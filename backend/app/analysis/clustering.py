@@ -0,0 +1,120 @@
+"""
+多分辨率Leiden聚类: 在同一个预计算的近邻图上并行运行多个分辨率
+
+各分辨率在fork出的子进程中运行，子进程以写时复制方式共享邻接矩阵。
+每个分辨率的稳定性用其与相邻分辨率划分的调整兰德指数（ARI）均值衡量：
+分辨率小幅变化时划分基本不变，说明该聚类结构稳定。
+"""
+
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+# 由父进程在创建进程池之前设置，fork后子进程直接读取
+_SHARED_GRAPH = None
+
+
+def resolution_key(resolution: float) -> str:
+    """分辨率对应的obs列名"""
+    return f"leiden_r{resolution:g}"
+
+
+def _run_leiden(resolution: float, random_state: int) -> np.ndarray:
+    """在共享的邻接矩阵上运行单个分辨率的Leiden，返回簇编号"""
+    import anndata as ad
+    import scanpy as sc
+
+    connectivities = _SHARED_GRAPH
+    stub = ad.AnnData(obs=pd.DataFrame(index=pd.RangeIndex(connectivities.shape[0]).astype(str)))
+    stub.obsp['connectivities'] = connectivities
+    stub.uns['neighbors'] = {'connectivities_key': 'connectivities'}
+    sc.tl.leiden(stub, resolution=resolution, random_state=random_state)
+    return stub.obs['leiden'].cat.codes.to_numpy(dtype=np.int32)
+
+
+def stability_scores(partitions: List[np.ndarray]) -> List[float]:
+    """每个划分与相邻分辨率划分的ARI均值（partitions按分辨率升序）"""
+    from sklearn.metrics import adjusted_rand_score
+
+    if len(partitions) < 2:
+        return [1.0] * len(partitions)
+    adjacent = [adjusted_rand_score(a, b) for a, b in zip(partitions[:-1], partitions[1:])]
+    scores = []
+    for i in range(len(partitions)):
+        neighbors = adjacent[max(i - 1, 0):i + 1]
+        scores.append(float(np.mean(neighbors)))
+    return scores
+
+
+def leiden_sweep(adata, resolutions: List[float], n_workers: Optional[int] = None,
+                 random_state: int = 0) -> Dict[str, Any]:
+    """
+    在同一个近邻图上运行多个分辨率的Leiden聚类
+
+    每个分辨率的结果写入 obs['leiden_r{分辨率}']。
+
+    Args:
+        adata: 已构建近邻图的AnnData
+        resolutions: 分辨率列表
+        n_workers: 并行进程数
+        random_state: 随机种子
+
+    Returns:
+        扫描摘要（分辨率、obs列名、簇数、稳定性、耗时）
+    """
+    global _SHARED_GRAPH
+    from app.analysis.parallel import fork_pool, fork_safe
+    from app.analysis.qc import available_cpus
+
+    logger = logging.getLogger(__name__)
+    resolutions = sorted(set(float(r) for r in resolutions))
+    connectivities_key = adata.uns['neighbors'].get('connectivities_key', 'connectivities')
+
+    start = time.perf_counter()
+    _SHARED_GRAPH = adata.obsp[connectivities_key]
+    try:
+        n_workers = max(1, min(n_workers or available_cpus(), len(resolutions)))
+        if n_workers > 1 and fork_safe():
+            pool = fork_pool(n_workers)
+            try:
+                partitions = pool.starmap(_run_leiden, [(r, random_state) for r in resolutions])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            partitions = [_run_leiden(r, random_state) for r in resolutions]
+    finally:
+        _SHARED_GRAPH = None
+
+    keys = []
+    for resolution, codes in zip(resolutions, partitions):
+        key = resolution_key(resolution)
+        categories = [str(i) for i in range(int(codes.max()) + 1)]
+        adata.obs[key] = pd.Categorical.from_codes(codes, categories=categories)
+        keys.append(key)
+
+    summary = {
+        'resolutions': resolutions,
+        'keys': keys,
+        'n_clusters': [int(codes.max()) + 1 for codes in partitions],
+        'stability': stability_scores(partitions),
+        'seconds': time.perf_counter() - start,
+    }
+    for resolution, n_clusters, stability in zip(resolutions, summary['n_clusters'], summary['stability']):
+        logger.info(f"Leiden 分辨率 {resolution:g}: {n_clusters} 个簇, 稳定性 {stability:.3f}")
+    return summary
+
+
+def choose_resolution(summary: Dict[str, Any], resolution: Optional[float] = None) -> float:
+    """选定分辨率：指定的分辨率在扫描范围内时直接使用，否则取稳定性最高的分辨率"""
+    if resolution is not None and float(resolution) in summary['resolutions']:
+        return float(resolution)
+    # 只有一个簇的划分总是与相邻的单簇划分一致，不参与选择
+    stability = np.array(summary['stability'])
+    stability[np.array(summary['n_clusters']) < 2] = -np.inf
+    if np.isinf(stability).all():
+        stability = np.array(summary['stability'])
+    return summary['resolutions'][int(np.argmax(stability))]
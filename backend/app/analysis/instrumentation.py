@@ -0,0 +1,214 @@
+"""
+阶段资源监控: 记录分析流程每个阶段的墙钟时间、CPU时间、峰值内存与磁盘读写量
+
+CPU时间包含已结束的子进程（如并行绘图的进程池）；并发执行的阶段的CPU时间与读写量按进程统计，会相互重叠。
+阶段内的峰值常驻内存由后台线程定期采样。读写字节数来自 /proc/self/io（非Linux系统上记为0）：
+read_bytes/write_bytes 为实际落到存储设备的字节数，read_chars/write_chars 为经过read/write系统调用的字节数
+（含页缓存命中）。结果写入任务输出目录下的 metrics.json，从上次中断处继续时保留之前运行的阶段记录。
+"""
+
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+METRICS_FILE = 'metrics.json'
+
+
+def rss_mb() -> float:
+    """当前进程的常驻内存（MB）"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return 0.0
+
+
+def peak_rss_mb() -> float:
+    """进程启动以来的峰值常驻内存（MB，Linux上ru_maxrss单位为KB）"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def cpu_seconds() -> float:
+    """本进程及已结束子进程的用户态与内核态CPU时间之和"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def io_bytes() -> Dict[str, int]:
+    """本进程累计的读写字节数"""
+    names = {'read_bytes': 'read_bytes', 'write_bytes': 'write_bytes', 'rchar': 'read_chars', 'wchar': 'write_chars'}
+    counters = dict.fromkeys(names.values(), 0)
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                if key in names:
+                    counters[names[key]] = int(value)
+    except (OSError, ValueError):
+        pass
+    return counters
+
+
+class _RSSSampler(threading.Thread):
+    """阶段运行期间定期采样常驻内存，记录阶段内的峰值"""
+
+    def __init__(self, interval: float):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = rss_mb()
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def stop(self) -> float:
+        self._stop_event.set()
+        self.join()
+        self.peak = max(self.peak, rss_mb())
+        return self.peak
+
+
+@contextmanager
+def sample_rss(interval: float = 0.1):
+    """
+    在with块运行期间定期采样常驻内存
+
+    Yields:
+        采样器，退出with块后其 peak 属性为块内的峰值常驻内存（MB）
+    """
+    sampler = _RSSSampler(interval)
+    sampler.start()
+    try:
+        yield sampler
+    finally:
+        sampler.stop()
+
+
+class StageMonitor:
+    """分析流程的阶段资源监控"""
+
+    def __init__(self, task_id: str, output_path: Optional[str] = None, sample_interval: float = 0.5,
+                 resume: bool = False):
+        """
+        初始化阶段监控
+
+        Args:
+            task_id: 任务ID
+            output_path: 任务输出目录，给定时每个阶段结束后更新其中的 metrics.json
+            sample_interval: 常驻内存采样间隔（秒）
+            resume: 是否合并输出目录中已有的 metrics.json（从上次中断处继续时，之前运行的阶段不会重新执行）
+        """
+        self.logger = logging.getLogger(__name__)
+        self.task_id = task_id
+        self.output_path = output_path
+        self.sample_interval = sample_interval
+        self.stages: List[Dict[str, Any]] = []
+        self.started_at = time.time()
+        self._started = time.perf_counter()
+        # 阶段可以在多个线程中并发执行
+        self._lock = threading.Lock()
+        # 之前运行的指标（metrics.json 的内容）
+        self.previous: Optional[Dict[str, Any]] = None
+        if resume and output_path:
+            try:
+                self.previous = read_metrics(output_path)
+                self.started_at = self.previous.get('started_at', self.started_at)
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"读取之前的阶段指标失败，不再保留: {str(e)}")
+
+    def discard_previous(self):
+        """丢弃之前运行的指标（如输入数据或配置已变化，全部阶段重新执行）"""
+        with self._lock:
+            self.previous = None
+            self.started_at = time.time()
+
+    @contextmanager
+    def stage(self, name: str):
+        """监控一个阶段；阶段抛出异常时同样记录，并标记为失败"""
+        sampler = _RSSSampler(self.sample_interval)
+        sampler.start()
+        wall_start = time.perf_counter()
+        cpu_start = cpu_seconds()
+        io_start = io_bytes()
+        status = 'completed'
+        try:
+            yield
+        except BaseException:
+            status = 'failed'
+            raise
+        finally:
+            wall = time.perf_counter() - wall_start
+            io_end = io_bytes()
+            metrics = {
+                'stage': name,
+                'status': status,
+                'wall_seconds': wall,
+                'cpu_seconds': cpu_seconds() - cpu_start,
+                'peak_rss_mb': sampler.stop(),
+                'process_peak_rss_mb': peak_rss_mb(),
+            }
+            metrics.update({key: io_end[key] - io_start[key] for key in io_end})
+            with self._lock:
+                self.stages.append(metrics)
+            self.logger.info(
+                f"阶段 {name}: 墙钟 {wall:.1f}s, CPU {metrics['cpu_seconds']:.1f}s, "
+                f"峰值内存 {metrics['peak_rss_mb']:.0f}MB, 读 {metrics['read_chars'] / 2 ** 20:.1f}MB, "
+                f"写 {metrics['write_chars'] / 2 ** 20:.1f}MB"
+            )
+            self.save()
+
+    def summary(self) -> Dict[str, Any]:
+        """
+        所有已完成阶段的指标及合计（包括之前运行的阶段）
+
+        并发阶段的墙钟时间相互重叠，合计的 wall_seconds 为各次运行监控开始以来经过的时间之和，
+        各阶段墙钟时间之和另记为 stage_wall_seconds
+        """
+        previous = self.previous or {}
+        stages = list(previous.get('stages', [])) + self.stages
+        total = {
+            key: sum(stage.get(key, 0) for stage in stages)
+            for key in ('cpu_seconds', 'read_bytes', 'write_bytes', 'read_chars', 'write_chars')
+        }
+        total['wall_seconds'] = (
+            previous.get('total', {}).get('wall_seconds', 0.0) + time.perf_counter() - self._started
+        )
+        total['stage_wall_seconds'] = sum(stage.get('wall_seconds', 0.0) for stage in stages)
+        total['peak_rss_mb'] = max((stage.get('peak_rss_mb', 0.0) for stage in stages), default=0.0)
+        return {
+            'task_id': self.task_id,
+            'started_at': self.started_at,
+            'stages': stages,
+            'total': total,
+        }
+
+    def save(self):
+        """写入 metrics.json（先写临时文件再替换，读取方不会看到写了一半的文件）"""
+        if not self.output_path:
+            return
+        try:
+            os.makedirs(self.output_path, exist_ok=True)
+            path = os.path.join(self.output_path, METRICS_FILE)
+            with self._lock:
+                with open(path + '.tmp', 'w') as f:
+                    json.dump(self.summary(), f, indent=2)
+                os.replace(path + '.tmp', path)
+        except OSError as e:
+            self.logger.warning(f"写入阶段指标失败: {str(e)}")
+
+
+def read_metrics(output_path: str) -> Dict[str, Any]:
+    """读取任务输出目录下的 metrics.json"""
+    with open(os.path.join(output_path, METRICS_FILE)) as f:
+        return json.load(f)
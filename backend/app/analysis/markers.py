@@ -0,0 +1,214 @@
+"""
+Marker基因注释引擎: 构建 (基因 × 细胞类型) 稀疏权重矩阵，一次稀疏矩阵乘法为所有细胞打分
+
+支持PanglaoDB、CellMarker等格式的marker表（TSV/CSV），可包含数千种细胞类型。
+"""
+
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# 内置的常见免疫/基质细胞marker
+DEFAULT_MARKERS = {
+    'T细胞': ['CD3D', 'CD3E', 'CD3G', 'CD8A', 'CD4'],
+    'B细胞': ['CD19', 'CD79A', 'CD79B', 'MS4A1'],
+    'NK细胞': ['NCAM1', 'NKG7', 'KLRD1'],
+    '单核细胞': ['CD14', 'LYZ', 'CSF1R'],
+    '巨噬细胞': ['CD68', 'CD163', 'MRC1'],
+    '树突状细胞': ['ITGAX', 'CLEC9A', 'CD1C'],
+    '上皮细胞': ['EPCAM', 'KRT8', 'KRT18'],
+    '成纤维细胞': ['COL1A1', 'DCN', 'LUM']
+}
+
+# 常见marker数据库的列名（PanglaoDB / CellMarker / 通用格式）
+_CELL_TYPE_COLUMNS = ['cell type', 'cell_type', 'celltype', 'cell_name', 'cellName', 'cell_type_name']
+_GENE_COLUMNS = ['official gene symbol', 'gene', 'gene_symbol', 'geneSymbol', 'Symbol', 'symbol', 'marker']
+_SPECIES_COLUMNS = ['species', 'speciesType']
+
+
+def _find_column(df: pd.DataFrame, candidates: List[str], requested: Optional[str] = None) -> Optional[str]:
+    if requested:
+        if requested not in df.columns:
+            raise ValueError(f"marker表中不存在列: {requested}")
+        return requested
+    lower_columns = {column.lower(): column for column in df.columns}
+    for candidate in candidates:
+        if candidate.lower() in lower_columns:
+            return lower_columns[candidate.lower()]
+    return None
+
+
+def load_marker_table(path: str, cell_type_column: Optional[str] = None, gene_column: Optional[str] = None,
+                      weight_column: Optional[str] = None, species: Optional[str] = None,
+                      sep: Optional[str] = None) -> pd.DataFrame:
+    """
+    读取marker数据库表格
+
+    每行一个 (细胞类型, 基因) 对，或一个细胞类型对应逗号分隔的多个基因（CellMarker格式）。
+
+    Args:
+        path: TSV/CSV文件路径
+        cell_type_column: 细胞类型列名，默认自动识别
+        gene_column: 基因列名，默认自动识别
+        weight_column: 基因权重列名，为None时所有marker权重相同
+        species: 物种过滤（如 'Hs'、'Human'），需要表中存在物种列
+        sep: 分隔符，默认根据扩展名判断
+
+    Returns:
+        包含 cell_type、gene、weight 三列的DataFrame
+    """
+    if sep is None:
+        sep = ',' if path.endswith('.csv') else '\t'
+    df = pd.read_csv(path, sep=sep)
+
+    cell_type_column = _find_column(df, _CELL_TYPE_COLUMNS, cell_type_column)
+    gene_column = _find_column(df, _GENE_COLUMNS, gene_column)
+    if cell_type_column is None or gene_column is None:
+        raise ValueError(f"无法识别marker表的细胞类型列或基因列: {list(df.columns)}")
+
+    if species:
+        species_column = _find_column(df, _SPECIES_COLUMNS)
+        if species_column is None:
+            raise ValueError("marker表中没有物种列，无法按物种过滤")
+        df = df[df[species_column].astype(str).str.contains(species, case=False, regex=False)]
+
+    markers = pd.DataFrame({
+        'cell_type': df[cell_type_column].astype(str),
+        'gene': df[gene_column].astype(str),
+        'weight': pd.to_numeric(df[weight_column], errors='coerce') if weight_column else 1.0,
+    })
+    # 缺失、无法解析或非正的权重无法参与加权平均
+    invalid = ~(markers['weight'] > 0)
+    if invalid.any():
+        logging.getLogger(__name__).warning(f"忽略 {int(invalid.sum())} 条权重缺失或非正的marker")
+        markers = markers[~invalid]
+    # CellMarker等格式在一个单元格中列出多个基因
+    markers['gene'] = markers['gene'].str.replace(r'[\[\]]', '', regex=True).str.split(r'\s*,\s*')
+    markers = markers.explode('gene')
+    markers['gene'] = markers['gene'].str.strip()
+    markers = markers[(markers['gene'] != '') & (markers['gene'].str.lower() != 'nan')]
+    return markers.drop_duplicates(['cell_type', 'gene']).reset_index(drop=True)
+
+
+class MarkerScorer:
+    """基于稀疏矩阵乘法的marker基因打分器"""
+
+    def __init__(self, markers: pd.DataFrame, case_sensitive: bool = False):
+        """
+        初始化marker打分器
+
+        Args:
+            markers: 包含 cell_type、gene、weight 列的marker表
+            case_sensitive: 基因名匹配是否区分大小写
+        """
+        self.logger = logging.getLogger(__name__)
+        self.markers = markers
+        self.case_sensitive = case_sensitive
+
+    @classmethod
+    def from_dict(cls, marker_dict: Dict[str, List[str]], **kwargs) -> "MarkerScorer":
+        """从 {细胞类型: [marker基因]} 字典创建"""
+        rows = [(cell_type, gene, 1.0) for cell_type, genes in marker_dict.items() for gene in genes]
+        return cls(pd.DataFrame(rows, columns=['cell_type', 'gene', 'weight']), **kwargs)
+
+    @classmethod
+    def from_table(cls, path: str, case_sensitive: bool = False, **kwargs) -> "MarkerScorer":
+        """从marker数据库表格创建，kwargs 见 load_marker_table"""
+        return cls(load_marker_table(path, **kwargs), case_sensitive=case_sensitive)
+
+    def weight_matrix(self, var_names) -> Tuple[np.ndarray, sp.csr_matrix, List[str]]:
+        """
+        构建marker权重矩阵
+
+        每个细胞类型的权重按其在数据中存在的marker归一化，使得打分等于marker表达的加权平均。
+
+        Args:
+            var_names: 数据中的基因名
+
+        Returns:
+            (参与打分的基因列索引, (基因 × 细胞类型) 稀疏权重矩阵, 细胞类型列表)
+        """
+        var_names = pd.Index(var_names)
+        genes = self.markers['gene']
+        if not self.case_sensitive:
+            var_names = var_names.str.upper()
+            genes = genes.str.upper()
+
+        gene_index = pd.Series(np.arange(len(var_names)), index=var_names)
+        gene_index = gene_index[~gene_index.index.duplicated()]
+        var_idx = gene_index.reindex(genes.to_numpy()).to_numpy()
+        # 只保留权重为正的marker，每种细胞类型的权重和都大于0，归一化时不会除以0
+        present = ~np.isnan(var_idx) & (self.markers['weight'].to_numpy(dtype=np.float64) > 0)
+        markers = self.markers[present]
+        var_idx = var_idx[present].astype(np.int64)
+
+        cell_types = pd.unique(markers['cell_type']).tolist()
+        type_codes = pd.Categorical(markers['cell_type'], categories=cell_types).codes
+        used_genes, row_idx = np.unique(var_idx, return_inverse=True)
+
+        weights = markers['weight'].to_numpy(dtype=np.float64)
+        type_totals = np.bincount(type_codes, weights=weights, minlength=len(cell_types))
+        weights = weights / type_totals[type_codes]
+
+        W = sp.csr_matrix(
+            (weights.astype(np.float32), (row_idx, type_codes)),
+            shape=(len(used_genes), len(cell_types))
+        )
+        self.logger.info(f"marker权重矩阵: {len(used_genes)} 个基因 × {len(cell_types)} 种细胞类型")
+        return used_genes, W, cell_types
+
+    def score(self, X, var_names, chunk_size: int = 50000,
+              n_threads: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+        """
+        为每个细胞计算得分最高的细胞类型
+
+        X只按列选出marker基因后与权重矩阵相乘，分块执行，不会将X稠密化。
+
+        Args:
+            X: (细胞 × 基因) 表达矩阵
+            var_names: 基因名
+            chunk_size: 每块的细胞数
+            n_threads: 并行线程数
+
+        Returns:
+            (最高得分细胞类型的索引, 最高得分, 细胞类型列表)；没有任何marker表达的细胞索引为-1
+        """
+        used_genes, W, cell_types = self.weight_matrix(var_names)
+        n_obs = X.shape[0]
+        best_idx = np.full(n_obs, -1, dtype=np.int64)
+        best_score = np.zeros(n_obs, dtype=np.float32)
+        if len(cell_types) == 0:
+            self.logger.warning("数据中不存在任何marker基因")
+            return best_idx, best_score, cell_types
+
+        X_markers = sp.csr_matrix(X[:, used_genes]) if sp.issparse(X) else sp.csr_matrix(np.asarray(X)[:, used_genes])
+
+        def score_chunk(start):
+            end = min(start + chunk_size, n_obs)
+            scores = (X_markers[start:end] @ W).toarray()
+            idx = scores.argmax(axis=1)
+            top = scores[np.arange(end - start), idx]
+            best_idx[start:end] = np.where(top > 0, idx, -1)
+            best_score[start:end] = top
+
+        with ThreadPoolExecutor(max_workers=n_threads) as pool:
+            list(pool.map(score_chunk, range(0, n_obs, chunk_size)))
+
+        return best_idx, best_score, cell_types
+
+    def annotate(self, X, var_names, unknown_label: str = 'Unknown', **kwargs) -> Tuple[pd.Categorical, np.ndarray]:
+        """
+        注释细胞类型
+
+        Returns:
+            (细胞类型标签, 得分)
+        """
+        best_idx, best_score, cell_types = self.score(X, var_names, **kwargs)
+        categories = list(cell_types) + [unknown_label]
+        codes = np.where(best_idx >= 0, best_idx, len(cell_types))
+        labels = pd.Categorical.from_codes(codes, categories=categories)
+        return labels.remove_unused_categories(), best_score
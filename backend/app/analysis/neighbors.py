@@ -0,0 +1,248 @@
+"""
+近邻图构建: 可插拔的近似最近邻（ANN）后端，生成 sc.tl.leiden / sc.tl.umap 使用的邻接图
+
+支持的后端:
+    - nndescent: pynndescent 的 NN-descent（默认，随umap一起安装）
+    - hnsw: hnswlib 的HNSW图索引（可选依赖）
+    - exact: sklearn 精确kNN，用于小数据或基准对照
+
+所有后端都返回包含细胞自身的 (细胞数 × n_neighbors) 近邻索引与距离，
+再由 umap 的 fuzzy_simplicial_set 计算连接权重，写入 obsp['connectivities'] / obsp['distances']，
+与 sc.pp.neighbors 的输出格式一致。
+"""
+
+import logging
+import time
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+import scipy.sparse as sp
+
+NEIGHBOR_BACKENDS = ('nndescent', 'hnsw', 'exact')
+
+_HNSW_SPACES = {'euclidean': 'l2', 'cosine': 'cosine'}
+
+
+def knn_nndescent(X: np.ndarray, n_neighbors: int, metric: str = 'euclidean', n_threads: Optional[int] = None,
+                  random_state: int = 0, n_trees: Optional[int] = None,
+                  n_iters: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """NN-descent近似kNN"""
+    from pynndescent import NNDescent
+
+    index = NNDescent(
+        X,
+        n_neighbors=n_neighbors,
+        metric=metric,
+        n_trees=n_trees,
+        n_iters=n_iters,
+        random_state=random_state,
+        n_jobs=n_threads or -1,
+        low_memory=True,
+        compressed=True
+    )
+    indices, distances = index.neighbor_graph
+    return indices.astype(np.int64), distances.astype(np.float32)
+
+
+def knn_hnsw(X: np.ndarray, n_neighbors: int, metric: str = 'euclidean', n_threads: Optional[int] = None,
+             random_state: int = 0, M: int = 16, ef_construction: int = 200,
+             ef: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """HNSW近似kNN"""
+    import hnswlib
+
+    if metric not in _HNSW_SPACES:
+        raise ValueError(f"hnsw后端不支持的距离: {metric}")
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    index = hnswlib.Index(space=_HNSW_SPACES[metric], dim=X.shape[1])
+    index.init_index(max_elements=X.shape[0], ef_construction=ef_construction, M=M, random_seed=random_state)
+    index.set_num_threads(n_threads or -1)
+    index.add_items(X, np.arange(X.shape[0]))
+    index.set_ef(max(ef or 2 * n_neighbors, n_neighbors))
+    indices, distances = index.knn_query(X, k=n_neighbors)
+    if metric == 'euclidean':
+        # hnswlib的l2空间返回平方距离
+        distances = np.sqrt(np.maximum(distances, 0))
+    return indices.astype(np.int64), distances.astype(np.float32)
+
+
+def knn_exact(X: np.ndarray, n_neighbors: int, metric: str = 'euclidean', n_threads: Optional[int] = None,
+              random_state: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """精确kNN"""
+    from sklearn.neighbors import NearestNeighbors
+
+    nn = NearestNeighbors(n_neighbors=n_neighbors, metric=metric, n_jobs=n_threads or -1).fit(X)
+    distances, indices = nn.kneighbors(X)
+    return indices.astype(np.int64), distances.astype(np.float32)
+
+
+_KNN_FUNCTIONS = {
+    'nndescent': knn_nndescent,
+    'hnsw': knn_hnsw,
+    'exact': knn_exact,
+}
+
+
+def knn(X: np.ndarray, n_neighbors: int, backend: str = 'nndescent', **kwargs) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    用指定后端计算kNN，返回第一列为细胞自身的近邻索引与距离
+
+    Args:
+        X: (细胞数 × 维数) 低维表示
+        n_neighbors: 近邻数（包含细胞自身）
+        backend: 'nndescent'、'hnsw' 或 'exact'
+        kwargs: 传给后端的参数（metric、n_threads、random_state 及后端特有参数）
+    """
+    if backend not in _KNN_FUNCTIONS:
+        raise ValueError(f"不支持的近邻后端: {backend}，可选: {', '.join(NEIGHBOR_BACKENDS)}")
+    indices, distances = _KNN_FUNCTIONS[backend](X, n_neighbors, **kwargs)
+    return _self_first(indices, distances)
+
+
+def knn_query(X_index: np.ndarray, X_query: np.ndarray, n_neighbors: int, backend: str = 'nndescent',
+              metric: str = 'euclidean', n_threads: Optional[int] = None,
+              random_state: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    为查询点在索引点中查找近邻（如从全部细胞到抽样细胞）
+
+    Returns:
+        (查询点数 × n_neighbors) 的索引点编号与距离
+    """
+    X_index = np.ascontiguousarray(X_index, dtype=np.float32)
+    X_query = np.ascontiguousarray(X_query, dtype=np.float32)
+    n_neighbors = min(n_neighbors, X_index.shape[0])
+
+    if backend == 'nndescent':
+        from pynndescent import NNDescent
+
+        index = NNDescent(X_index, n_neighbors=max(n_neighbors, 15), metric=metric,
+                          random_state=random_state, n_jobs=n_threads or -1)
+        index.prepare()
+        indices, distances = index.query(X_query, k=n_neighbors)
+    elif backend == 'hnsw':
+        import hnswlib
+
+        if metric not in _HNSW_SPACES:
+            raise ValueError(f"hnsw后端不支持的距离: {metric}")
+        index = hnswlib.Index(space=_HNSW_SPACES[metric], dim=X_index.shape[1])
+        index.init_index(max_elements=X_index.shape[0], ef_construction=200, M=16, random_seed=random_state)
+        index.set_num_threads(n_threads or -1)
+        index.add_items(X_index, np.arange(X_index.shape[0]))
+        index.set_ef(max(2 * n_neighbors, 50))
+        indices, distances = index.knn_query(X_query, k=n_neighbors)
+        if metric == 'euclidean':
+            distances = np.sqrt(np.maximum(distances, 0))
+    elif backend == 'exact':
+        from sklearn.neighbors import NearestNeighbors
+
+        nn = NearestNeighbors(n_neighbors=n_neighbors, metric=metric, n_jobs=n_threads or -1).fit(X_index)
+        distances, indices = nn.kneighbors(X_query)
+    else:
+        raise ValueError(f"不支持的近邻后端: {backend}，可选: {', '.join(NEIGHBOR_BACKENDS)}")
+    return indices.astype(np.int64), distances.astype(np.float32)
+
+
+def _self_first(indices: np.ndarray, distances: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """保证每行第一列是细胞自身（近似搜索或存在重复细胞时可能不满足）"""
+    rows = np.arange(indices.shape[0])
+    is_self = indices == rows[:, None]
+    if is_self[:, 0].all():
+        return indices, distances
+
+    order = np.argsort(~is_self, axis=1, kind='stable')
+    indices = np.take_along_axis(indices, order, axis=1)
+    distances = np.take_along_axis(distances, order, axis=1)
+
+    # 结果中没有自身的行：把自身插到第一列，丢弃最远的近邻
+    missing = ~is_self.any(axis=1)
+    indices[missing, 1:] = indices[missing, :-1]
+    distances[missing, 1:] = distances[missing, :-1]
+    indices[missing, 0] = rows[missing]
+    distances[missing, 0] = 0
+    return indices, distances
+
+
+def neighbor_graphs(indices: np.ndarray, distances: np.ndarray) -> Tuple[sp.csr_matrix, sp.csr_matrix]:
+    """
+    由kNN结果构建距离矩阵与UMAP连接权重矩阵
+
+    Returns:
+        (distances, connectivities) 两个 (细胞数 × 细胞数) CSR矩阵
+    """
+    from umap.umap_ import fuzzy_simplicial_set
+
+    n_obs, n_neighbors = indices.shape
+    connectivities, _sigmas, _rhos = fuzzy_simplicial_set(
+        sp.coo_matrix((n_obs, 1)),
+        n_neighbors,
+        None,
+        None,
+        knn_indices=indices,
+        knn_dists=distances,
+        set_op_mix_ratio=1.0,
+        local_connectivity=1.0
+    )
+
+    # 距离矩阵不保存自身
+    k = n_neighbors - 1
+    distance_matrix = sp.csr_matrix(
+        (distances[:, 1:].ravel(), indices[:, 1:].ravel(), np.arange(0, n_obs * k + 1, k)),
+        shape=(n_obs, n_obs)
+    )
+    return distance_matrix, connectivities.tocsr()
+
+
+def compute_neighbors(adata, n_neighbors: int = 15, use_rep: Optional[str] = None, backend: str = 'nndescent',
+                      metric: str = 'euclidean', n_threads: Optional[int] = None, random_state: int = 0,
+                      backend_options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """
+    构建近邻图并写入AnnData，输出与 sc.pp.neighbors 相同
+
+    Args:
+        adata: AnnData
+        n_neighbors: 近邻数（包含细胞自身）
+        use_rep: 使用的低维表示，默认 uns['X_emb'] 指定的表示或 X_pca
+        backend: 近邻后端
+        metric: 距离度量
+        n_threads: 线程数，默认使用所有可用CPU
+        random_state: 随机种子
+        backend_options: 后端特有参数（如nndescent的n_trees/n_iters，hnsw的M/ef_construction/ef）
+
+    Returns:
+        uns['neighbors'] 中记录的参数
+    """
+    from app.analysis.qc import available_cpus
+
+    logger = logging.getLogger(__name__)
+    use_rep = use_rep or adata.uns.get('X_emb', 'X_pca')
+    X = np.asarray(adata.obsm[use_rep], dtype=np.float32)
+    n_threads = n_threads or available_cpus()
+
+    start = time.perf_counter()
+    indices, distances = knn(
+        X, n_neighbors, backend=backend, metric=metric, n_threads=n_threads,
+        random_state=random_state, **(backend_options or {})
+    )
+    knn_seconds = time.perf_counter() - start
+    distance_matrix, connectivities = neighbor_graphs(indices, distances)
+
+    adata.obsp['distances'] = distance_matrix
+    adata.obsp['connectivities'] = connectivities
+    params = {
+        'n_neighbors': n_neighbors,
+        'method': 'umap',
+        'random_state': random_state,
+        'metric': metric,
+        'use_rep': use_rep,
+        'backend': backend,
+        'knn_seconds': knn_seconds,
+    }
+    adata.uns['neighbors'] = {
+        'connectivities_key': 'connectivities',
+        'distances_key': 'distances',
+        'params': params,
+    }
+    logger.info(
+        f"近邻图构建完成: 后端 {backend}, {n_threads} 线程, kNN耗时 {knn_seconds:.1f}s, "
+        f"总耗时 {time.perf_counter() - start:.1f}s"
+    )
+    return params
@@ -0,0 +1,25 @@
+"""
+多进程工具: 基于fork的进程池让子进程以写时复制方式共享父进程中的大数组
+"""
+
+import multiprocessing
+import sys
+
+
+def fork_safe() -> bool:
+    """当前进程能否安全fork: numba的TBB线程层一旦启动，fork后父进程退出时会挂起"""
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return False
+    numba = sys.modules.get('numba')
+    if numba is None:
+        return True
+    try:
+        return numba.threading_layer() != 'tbb'
+    except ValueError:
+        # 线程层尚未初始化，之后会按 NUMBA_THREADING_LAYER 选择
+        return True
+
+
+def fork_pool(n_workers: int):
+    """创建fork上下文的进程池（调用前应确认 fork_safe()）"""
+    return multiprocessing.get_context('fork').Pool(processes=n_workers)
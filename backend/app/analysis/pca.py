@@ -0,0 +1,236 @@
+"""
+稀疏PCA: 直接在稀疏CSR矩阵上做隐式中心化的随机SVD，以及适用于backed/分块数据的增量PCA
+
+随机SVD把中心化矩阵 A = X - 1·μᵀ 只当作线性算子使用：
+    A·Q  = X·Q  - 1·(μᵀQ)
+    Aᵀ·Y = Xᵀ·Y - μ·(1ᵀY)
+因此表达矩阵始终保持稀疏，稠密的工作矩阵只有 (细胞数 × l) 和 (基因数 × l)，l = 主成分数 + 过采样数。
+"""
+
+import logging
+import time
+from typing import Any, Callable, Dict, Iterator, Optional
+
+import numpy as np
+import scipy.sparse as sp
+
+PCA_METHODS = ('randomized', 'incremental')
+
+
+def _column_variance(X) -> np.ndarray:
+    n_obs = X.shape[0]
+    mean = np.asarray(X.mean(axis=0), dtype=np.float64).ravel()
+    if sp.issparse(X):
+        sq_mean = np.asarray(X.multiply(X).mean(axis=0), dtype=np.float64).ravel()
+    else:
+        sq_mean = np.mean(np.asarray(X, dtype=np.float64) ** 2, axis=0)
+    return (sq_mean - mean ** 2) * n_obs / max(n_obs - 1, 1)
+
+
+def _flip_signs(components: np.ndarray, scores: np.ndarray):
+    """让每个主成分中绝对值最大的载荷为正，保证结果确定"""
+    signs = np.sign(components[np.arange(components.shape[0]), np.argmax(np.abs(components), axis=1)])
+    signs[signs == 0] = 1
+    return components * signs[:, None], scores * signs[None, :]
+
+
+def randomized_pca(X, n_comps: int = 50, n_oversamples: int = 10, n_iter: int = 4,
+                   random_state: int = 0) -> Dict[str, np.ndarray]:
+    """
+    隐式中心化的随机SVD（Halko等的随机范围查找 + 幂迭代）
+
+    Args:
+        X: (细胞数 × 基因数) 稀疏或稠密矩阵，不会被稠密化或修改
+        n_comps: 主成分数
+        n_oversamples: 随机投影的过采样维数
+        n_iter: 幂迭代次数
+        random_state: 随机种子
+
+    Returns:
+        X_pca、components、variance、variance_ratio
+    """
+    from scipy.linalg import qr, svd
+
+    if not sp.issparse(X):
+        X = np.asarray(X)
+    n_obs, n_vars = X.shape
+    # float32输入保持float32，避免为了类型提升复制整个稀疏矩阵
+    dtype = np.float32 if X.dtype == np.float32 else np.float64
+    n_random = min(n_comps + n_oversamples, min(n_obs, n_vars))
+
+    mean = np.asarray(X.mean(axis=0), dtype=dtype).ravel()
+
+    def matmul(Q):
+        # A·Q，Q为 (基因数 × l)
+        return np.asarray(X @ Q) - (mean @ Q)[None, :]
+
+    def rmatmul(Y):
+        # Aᵀ·Y，Y为 (细胞数 × l)
+        return np.asarray(X.T @ Y) - mean[:, None] * Y.sum(axis=0)[None, :]
+
+    rng = np.random.default_rng(random_state)
+    Q = rng.standard_normal((n_vars, n_random)).astype(dtype)
+    Q, _ = qr(matmul(Q), mode='economic')
+    for _ in range(n_iter):
+        Q, _ = qr(rmatmul(Q), mode='economic')
+        Q, _ = qr(matmul(Q), mode='economic')
+
+    # B = Qᵀ·A 的SVD给出A的近似奇异向量
+    B = rmatmul(Q).T
+    U_b, S, Vt = svd(B, full_matrices=False)
+    U = Q @ U_b[:, :n_comps]
+    S = S[:n_comps]
+    components, scores = _flip_signs(Vt[:n_comps], U * S)
+
+    variance = S.astype(np.float64) ** 2 / max(n_obs - 1, 1)
+    total_variance = _column_variance(X).sum()
+    return {
+        'X_pca': scores.astype(np.float32),
+        'components': components,
+        'variance': variance,
+        'variance_ratio': variance / total_variance,
+    }
+
+
+def incremental_pca(chunks: Callable[[], Iterator[sp.csr_matrix]], n_comps: int = 50,
+                    batch_size: Optional[int] = None) -> Dict[str, np.ndarray]:
+    """
+    分块增量PCA，适用于backed模式：任意时刻只有一个批次被稠密化
+
+    Args:
+        chunks: 返回 (细胞块) 迭代器的函数，会被调用两次（拟合与投影）
+        n_comps: 主成分数
+        batch_size: 每次 partial_fit 的最少细胞数，默认取块大小
+
+    Returns:
+        X_pca、components、variance、variance_ratio
+    """
+    from sklearn.decomposition import IncrementalPCA
+
+    ipca = IncrementalPCA(n_components=n_comps)
+    pending = []
+    n_pending = 0
+    # 最近凑满的批次推迟一步拟合：末尾不足 n_comps 个细胞的剩余部分无法单独 partial_fit，并入该批次
+    held = None
+    for chunk in chunks():
+        pending.append(chunk)
+        n_pending += chunk.shape[0]
+        if n_pending >= max(n_comps, batch_size or 0):
+            if held is not None:
+                ipca.partial_fit(held.toarray())
+            held = sp.vstack(pending)
+            pending, n_pending = [], 0
+    if pending and (n_pending < n_comps or held is None):
+        held = sp.vstack(([held] if held is not None else []) + pending)
+        pending = []
+    for batch in ([held] if held is not None else []) + ([sp.vstack(pending)] if pending else []):
+        ipca.partial_fit(batch.toarray())
+
+    scores = np.vstack([ipca.transform(chunk.toarray()).astype(np.float32) for chunk in chunks()])
+    components, scores = _flip_signs(ipca.components_, scores)
+    return {
+        'X_pca': scores,
+        'components': components,
+        'variance': ipca.explained_variance_,
+        'variance_ratio': ipca.explained_variance_ratio_,
+    }
+
+
+def run_pca(adata, method: str = 'randomized', n_comps: int = 50, n_oversamples: int = 10, n_iter: int = 4,
+            use_highly_variable: bool = True, chunk_size: int = 20000, n_threads: Optional[int] = None,
+            random_state: int = 0) -> Dict[str, Any]:
+    """
+    执行PCA并按 sc.pp.pca 的格式写入 obsm['X_pca']、varm['PCs']、uns['pca']
+
+    Args:
+        adata: log标准化后的AnnData，X可以是backed数据集（仅incremental方法）
+        method: 'randomized'（稀疏隐式中心化随机SVD）或 'incremental'（分块增量PCA）；
+            X为backed数据集时总是使用 'incremental'
+        n_comps: 主成分数
+        n_oversamples: 随机SVD的过采样维数
+        n_iter: 随机SVD的幂迭代次数
+        use_highly_variable: 存在 var['highly_variable'] 时只使用高变基因
+        chunk_size: 增量PCA每块的细胞数
+        n_threads: BLAS线程数，默认使用所有可用CPU
+        random_state: 随机种子
+
+    Returns:
+        uns['pca'] 的内容（含参数、耗时与内存统计）
+    """
+    from threadpoolctl import threadpool_limits
+
+    from app.analysis.backed import iter_chunks
+    from app.analysis.instrumentation import rss_mb, sample_rss
+    from app.analysis.qc import available_cpus
+
+    logger = logging.getLogger(__name__)
+    if method not in PCA_METHODS:
+        raise ValueError(f"不支持的PCA方法: {method}，可选: {', '.join(PCA_METHODS)}")
+
+    if method == 'randomized' and adata.isbacked:
+        # 随机SVD需要整个矩阵在内存中，backed数据改为按块读取
+        logger.info("表达矩阵为backed模式，使用分块增量PCA")
+        method = 'incremental'
+
+    gene_mask = np.ones(adata.n_vars, dtype=bool)
+    if use_highly_variable and 'highly_variable' in adata.var:
+        gene_mask = adata.var['highly_variable'].to_numpy(dtype=bool)
+    n_comps = min(n_comps, int(gene_mask.sum()) - 1, adata.n_obs - 1)
+    n_threads = n_threads or available_cpus()
+
+    start = time.perf_counter()
+    rss_before = rss_mb()
+    with sample_rss() as sampler, threadpool_limits(limits=n_threads):
+        if method == 'randomized':
+            X = adata.X
+            if not gene_mask.all():
+                X = X[:, gene_mask]
+            X = sp.csr_matrix(X) if sp.issparse(X) else np.asarray(X)
+            result = randomized_pca(
+                X, n_comps=n_comps, n_oversamples=n_oversamples, n_iter=n_iter, random_state=random_state
+            )
+            n_random = min(n_comps + n_oversamples, min(X.shape))
+            itemsize = X.dtype.itemsize
+            working_mb = (X.shape[0] + X.shape[1]) * n_random * itemsize * 2 / 2 ** 20
+        else:
+            def chunks():
+                for _, _, chunk in iter_chunks(adata.X, chunk_size):
+                    yield chunk[:, gene_mask]
+
+            result = incremental_pca(chunks, n_comps=n_comps, batch_size=chunk_size)
+            working_mb = chunk_size * int(gene_mask.sum()) * 8 * 2 / 2 ** 20
+
+    seconds = time.perf_counter() - start
+    memory = {
+        'rss_before_mb': rss_before,
+        'rss_after_mb': rss_mb(),
+        # PCA期间采样得到的峰值，而不是进程启动以来的峰值
+        'peak_rss_mb': sampler.peak,
+        'peak_rss_delta_mb': sampler.peak - rss_before,
+        'working_set_mb': working_mb,
+    }
+
+    adata.obsm['X_pca'] = result['X_pca']
+    PCs = np.zeros((adata.n_vars, n_comps), dtype=np.float32)
+    PCs[gene_mask] = result['components'].T
+    adata.varm['PCs'] = PCs
+    adata.uns['pca'] = {
+        'params': {
+            'method': method,
+            'n_comps': n_comps,
+            'n_oversamples': n_oversamples,
+            'n_iter': n_iter,
+            'use_highly_variable': bool(use_highly_variable and 'highly_variable' in adata.var),
+            'zero_center': True,
+            'n_threads': n_threads,
+        },
+        'variance': result['variance'],
+        'variance_ratio': result['variance_ratio'],
+        'seconds': seconds,
+        'memory': memory,
+    }
+    logger.info(
+        f"PCA完成: 方法 {method}, {n_comps} 个主成分, 耗时 {seconds:.1f}s, "
+        f"工作内存约 {working_mb:.0f}MB, 峰值RSS {memory['peak_rss_mb']:.0f}MB"
+    )
+    return adata.uns['pca']
@@ -0,0 +1,236 @@
+"""
+阶段依赖图执行器: 按依赖关系调度分析阶段，互不依赖的阶段并发执行，并持久化每个阶段的完成状态
+
+状态保存在输出目录下的 .pipeline_state.json。作业失败或被抢占后以相同的数据与配置重新提交时，
+已完成的阶段直接跳过，从检查点（阶段输出存储）恢复数据后继续执行。
+
+只有输出已写入检查点的阶段（persistent）可以在恢复时跳过；输出只存在于内存中的阶段
+（如数据加载、抽样模式下的中间阶段），只要还有未完成的阶段依赖它，就需要重新执行。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional, Set
+
+STATE_FILE = '.pipeline_state.json'
+
+
+class Stage:
+    """流程中的一个阶段"""
+
+    def __init__(self, name: str, func: Callable[[], bool], deps: Optional[List[str]] = None,
+                 persistent: bool = True, weight: float = 1.0):
+        """
+        Args:
+            name: 阶段名称
+            func: 阶段函数，返回False表示失败
+            deps: 依赖的阶段名称
+            persistent: 阶段输出是否写入检查点（恢复时可跳过）
+            weight: 在总进度中所占的权重
+        """
+        self.name = name
+        self.func = func
+        self.deps = list(deps or [])
+        self.persistent = persistent
+        self.weight = weight
+
+
+class StageFailed(Exception):
+    """阶段执行失败"""
+
+    def __init__(self, stage: str, message: str):
+        super().__init__(f"{stage}: {message}")
+        self.stage = stage
+
+
+def run_fingerprint(data_path: str, config: Dict[str, Any]) -> str:
+    """输入数据（路径、大小、修改时间）与配置的指纹，两者不变时才能恢复"""
+    stat = os.stat(data_path)
+    digest = hashlib.sha256()
+    digest.update(f"{os.path.abspath(data_path)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+    digest.update(json.dumps(config, sort_keys=True, default=str).encode())
+    return digest.hexdigest()
+
+
+class PipelineState:
+    """持久化的阶段完成状态"""
+
+    def __init__(self, output_path: str, fingerprint: str):
+        self.logger = logging.getLogger(__name__)
+        self.path = os.path.join(output_path, STATE_FILE)
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.meta: Dict[str, Any] = {}
+
+        if os.path.exists(self.path):
+            try:
+                with open(self.path) as f:
+                    state = json.load(f)
+                if state.get('fingerprint') == fingerprint:
+                    self.stages = state.get('stages', {})
+                    self.meta = state.get('meta', {})
+                else:
+                    self.logger.info("输入数据或配置已变化，忽略上次运行的阶段状态")
+            except (OSError, ValueError) as e:
+                self.logger.warning(f"读取阶段状态失败，将重新执行全部阶段: {str(e)}")
+
+    def completed(self) -> Dict[str, bool]:
+        """已完成的阶段及其输出是否已持久化"""
+        return {
+            name: record.get('persistent', False)
+            for name, record in self.stages.items() if record.get('status') == 'completed'
+        }
+
+    def reset(self):
+        with self._lock:
+            self.stages = {}
+            self.meta = {}
+        self.save()
+
+    def update(self, stage: str, **fields):
+        with self._lock:
+            self.stages.setdefault(stage, {}).update(fields)
+        self.save()
+
+    def save(self):
+        with self._lock:
+            state = {'fingerprint': self.fingerprint, 'stages': self.stages, 'meta': self.meta}
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(state, f, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+class DAGExecutor:
+    """按依赖图并发执行阶段"""
+
+    def __init__(self, stages: List[Stage], state: PipelineState, max_workers: int = 4,
+                 monitor=None, on_progress: Optional[Callable[[float], None]] = None,
+                 on_stage_complete: Optional[Callable[[Stage], None]] = None,
+                 on_stage_event: Optional[Callable[[Stage, str, Optional[str]], None]] = None):
+        """
+        Args:
+            stages: 阶段列表（声明顺序即同时就绪时的启动顺序）
+            state: 持久化状态
+            max_workers: 最多同时执行的阶段数
+            monitor: StageMonitor，给定时记录每个阶段的资源使用
+            on_progress: 进度回调，参数为已完成阶段的权重占比
+            on_stage_complete: 阶段成功后、记录完成状态前调用（如等待检查点写入完成）
+            on_stage_event: 阶段状态变化（running/completed/failed）时调用，参数为阶段、状态与错误信息
+        """
+        self.logger = logging.getLogger(__name__)
+        self.stages = {stage.name: stage for stage in stages}
+        for stage in stages:
+            missing = [dep for dep in stage.deps if dep not in self.stages]
+            if missing:
+                raise ValueError(f"阶段 {stage.name} 依赖不存在的阶段: {', '.join(missing)}")
+        self.order = [stage.name for stage in stages]
+        self.state = state
+        self.max_workers = max_workers
+        self.monitor = monitor
+        self.on_progress = on_progress
+        self.on_stage_complete = on_stage_complete
+        self.on_stage_event = on_stage_event
+
+    def plan(self) -> Set[str]:
+        """
+        根据上次运行的状态确定需要执行的阶段
+
+        未完成的阶段需要执行；它依赖的已完成但未持久化的阶段也需要重新执行（递归）。
+        """
+        completed = self.state.completed()
+        to_run = set(name for name in self.order if name not in completed)
+        pending = list(to_run)
+        while pending:
+            for dep in self.stages[pending.pop()].deps:
+                if dep not in to_run and not completed.get(dep, False):
+                    to_run.add(dep)
+                    pending.append(dep)
+        return to_run
+
+    def _progress(self, done: Set[str]):
+        if self.on_progress:
+            total = sum(stage.weight for stage in self.stages.values())
+            self.on_progress(sum(self.stages[name].weight for name in done) / max(total, 1e-12))
+
+    def _stage_event(self, stage: Stage, status: str, error: Optional[str] = None):
+        if self.on_stage_event:
+            try:
+                self.on_stage_event(stage, status, error)
+            except Exception as e:
+                self.logger.warning(f"阶段事件回调失败: {str(e)}")
+
+    def _run_stage(self, stage: Stage):
+        self.state.update(stage.name, status='running', started_at=time.time(), error=None)
+        self._stage_event(stage, 'running')
+        self.logger.info(f"开始阶段: {stage.name}")
+        try:
+            if self.monitor is not None:
+                with self.monitor.stage(stage.name):
+                    ok = stage.func()
+            else:
+                ok = stage.func()
+            if ok is False:
+                raise StageFailed(stage.name, "阶段返回失败")
+            if self.on_stage_complete:
+                self.on_stage_complete(stage)
+        except Exception as e:
+            self.state.update(stage.name, status='failed', finished_at=time.time(), error=str(e))
+            self._stage_event(stage, 'failed', str(e))
+            if isinstance(e, StageFailed):
+                raise
+            raise StageFailed(stage.name, str(e)) from e
+        self.state.update(stage.name, status='completed', finished_at=time.time(), persistent=stage.persistent)
+        self._stage_event(stage, 'completed')
+
+    def run(self, to_run: Optional[Set[str]] = None):
+        """
+        执行阶段直到全部完成；任一阶段失败时等待已启动的阶段结束后抛出 StageFailed
+
+        Args:
+            to_run: 需要执行的阶段，默认由 plan() 决定
+        """
+        to_run = self.plan() if to_run is None else set(to_run)
+        done = set(name for name in self.order if name not in to_run)
+        if done:
+            self.logger.info(f"跳过上次已完成的阶段: {', '.join(name for name in self.order if name in done)}")
+        self._progress(done)
+
+        running = {}
+        failure = None
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while True:
+                if failure is None:
+                    for name in self.order:
+                        if len(running) >= self.max_workers:
+                            break
+                        if name in done or name in running.values():
+                            continue
+                        if all(dep in done for dep in self.stages[name].deps):
+                            running[pool.submit(self._run_stage, self.stages[name])] = name
+                if not running:
+                    break
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(name)
+                        self._progress(done)
+                    except StageFailed as e:
+                        self.logger.error(f"阶段 {name} 失败: {str(e)}")
+                        failure = failure or e
+
+        if failure is not None:
+            raise failure
+        remaining = [name for name in self.order if name not in done]
+        if remaining:
+            raise RuntimeError(f"阶段依赖无法满足: {', '.join(remaining)}")
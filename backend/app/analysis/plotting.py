@@ -0,0 +1,154 @@
+"""
+并行图表生成: 在fork出的进程池中并发绘制各图表，散点层栅格化，同时生成PNG/WebP缩略图
+
+子进程通过fork继承父进程中的AnnData（写时复制），不需要序列化或复制数组。
+每个图表有独立的时间预算，超时的图表会被跳过，绘图不会拖慢整个分析任务。
+"""
+
+import logging
+import multiprocessing
+import os
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# 超过该细胞数时小提琴图不再绘制逐细胞的抖动散点
+MAX_JITTER_CELLS = 50000
+
+# 由父进程在创建进程池之前设置，fork后子进程直接读取
+_SHARED_ADATA = None
+
+
+def _plot_qc_metrics(adata, sc):
+    metrics = [m for m in ['n_genes_by_counts', 'total_counts', 'pct_counts_mt'] if m in adata.obs]
+    jitter = 0.4 if adata.n_obs <= MAX_JITTER_CELLS else False
+    sc.pl.violin(adata, metrics, jitter=jitter, multi_panel=True, show=False)
+
+
+def _plot_umap_clusters(adata, sc):
+    sc.pl.umap(adata, color=['leiden'], show=False)
+
+
+def _plot_umap_cell_types(adata, sc):
+    sc.pl.umap(adata, color=['predicted_cell_type'], show=False)
+
+
+def _plot_marker_heatmap(adata, sc):
+    sc.pl.rank_genes_groups_heatmap(adata, n_genes=10, show=False)
+
+
+def _plot_marker_dotplot(adata, sc):
+    sc.pl.rank_genes_groups_dotplot(adata, n_genes=5, show=False)
+
+
+# (图表名称, 绘图函数, 是否适用)
+PLOTS: List[Tuple[str, Callable, Callable]] = [
+    ('qc_metrics', _plot_qc_metrics, lambda adata: 'n_genes_by_counts' in adata.obs),
+    ('umap_clusters', _plot_umap_clusters, lambda adata: 'X_umap' in adata.obsm and 'leiden' in adata.obs),
+    ('umap_cell_types', _plot_umap_cell_types,
+     lambda adata: 'X_umap' in adata.obsm and 'predicted_cell_type' in adata.obs),
+    ('marker_genes_heatmap', _plot_marker_heatmap, lambda adata: 'rank_genes_groups' in adata.uns),
+    ('marker_genes_dotplot', _plot_marker_dotplot, lambda adata: 'rank_genes_groups' in adata.uns),
+]
+
+
+def _render_plot(name: str, plots_dir: str, dpi: int, thumbnail_dpi: int) -> Dict[str, Any]:
+    """在当前进程中绘制单个图表并保存PDF、PNG与WebP"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import scanpy as sc
+    from PIL import Image
+
+    start = time.perf_counter()
+    plot_func = dict((plot_name, func) for plot_name, func, _ in PLOTS)[name]
+    plot_func(_SHARED_ADATA, sc)
+
+    fig = plt.gcf()
+    # 散点、小提琴等矢量集合层栅格化，避免PDF中每个细胞一条路径
+    for ax in fig.axes:
+        for artist in ax.collections:
+            artist.set_rasterized(True)
+
+    paths = {fmt: os.path.join(plots_dir, f"{name}.{fmt}") for fmt in ['pdf', 'png', 'webp']}
+    fig.savefig(paths['pdf'], dpi=dpi, bbox_inches='tight')
+    fig.savefig(paths['png'], dpi=thumbnail_dpi, bbox_inches='tight')
+    plt.close('all')
+    Image.open(paths['png']).save(paths['webp'], 'WEBP', quality=80)
+
+    return {'status': 'ok', 'files': paths, 'seconds': time.perf_counter() - start}
+
+
+def render_plots(adata, plots_dir: str, n_workers: Optional[int] = None, time_budget: float = 300.0,
+                 dpi: int = 150, thumbnail_dpi: int = 72) -> Dict[str, Dict[str, Any]]:
+    """
+    并行生成所有适用的图表
+
+    Args:
+        adata: 分析完成的AnnData
+        plots_dir: 图表输出目录
+        n_workers: 并行进程数，默认与图表数量相同（不超过可用CPU数）
+        time_budget: 每个图表的时间预算（秒），超时的图表被跳过
+        dpi: PDF中栅格化图层的分辨率
+        thumbnail_dpi: PNG/WebP缩略图的分辨率
+
+    Returns:
+        图表名称到结果（状态、文件路径、耗时）的字典
+    """
+    global _SHARED_ADATA
+    from app.analysis.parallel import fork_pool, fork_safe
+    from app.analysis.qc import available_cpus
+
+    logger = logging.getLogger(__name__)
+    os.makedirs(plots_dir, exist_ok=True)
+    names = [name for name, _, applicable in PLOTS if applicable(adata)]
+    results = {}
+    if not names:
+        return results
+
+    if adata.isbacked:
+        # 子进程不能使用fork前打开的HDF5文件句柄；只有marker基因图需要表达矩阵，只载入这些基因
+        from app.analysis.viz_export import top_marker_genes
+
+        adata = adata[:, top_marker_genes(adata, 10)].to_memory()
+
+    _SHARED_ADATA = adata
+    try:
+        if not fork_safe():
+            # 不支持fork的平台或fork不安全时顺序绘制
+            logger.warning("当前进程无法安全fork，图表将顺序生成")
+            for name in names:
+                try:
+                    results[name] = _render_plot(name, plots_dir, dpi, thumbnail_dpi)
+                except Exception as e:
+                    logger.error(f"绘制图表 {name} 失败: {str(e)}")
+                    results[name] = {'status': 'failed', 'error': str(e)}
+            return results
+
+        n_workers = max(1, min(n_workers or available_cpus(), len(names)))
+        pool = fork_pool(n_workers)
+        try:
+            start = time.perf_counter()
+            pending = [
+                (name, pool.apply_async(_render_plot, (name, plots_dir, dpi, thumbnail_dpi)))
+                for name in names
+            ]
+            for i, (name, async_result) in enumerate(pending):
+                # 进程数少于图表数时按批次执行，后面批次的截止时间顺延
+                deadline = start + time_budget * (i // n_workers + 1)
+                try:
+                    results[name] = async_result.get(timeout=max(0.0, deadline - time.perf_counter()))
+                    logger.info(f"图表 {name} 完成，耗时 {results[name]['seconds']:.1f}s")
+                except multiprocessing.TimeoutError:
+                    logger.warning(f"图表 {name} 超出时间预算 {time_budget}s，已跳过")
+                    results[name] = {'status': 'timeout'}
+                except Exception as e:
+                    logger.error(f"绘制图表 {name} 失败: {str(e)}")
+                    results[name] = {'status': 'failed', 'error': str(e)}
+        finally:
+            # 终止仍在运行的超时任务
+            pool.terminate()
+            pool.join()
+    finally:
+        _SHARED_ADATA = None
+
+    return results
@@ -0,0 +1,264 @@
+"""
+任务进度事件日志: 分析作业向输出目录下的 progress.jsonl 追加进度事件，API进程读取并推送给客户端
+
+每个事件占一行JSON，包含任务状态、总进度以及（阶段事件的）阶段名称与阶段状态。
+文件只追加不改写，读取方按字节偏移增量读取，只解析完整的行；偏移同时用作SSE事件ID，
+客户端断线重连时据此从中断处继续。
+
+API进程中每个任务只有一个后台读取协程（ProgressBroadcaster），无论有多少客户端订阅，
+读取文件与查询调度器的开销都不随订阅数增长。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+PROGRESS_FILE = 'progress.jsonl'
+TERMINAL_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def progress_log_path(output_path: str) -> str:
+    return os.path.join(output_path, PROGRESS_FILE)
+
+
+class ProgressLog:
+    """作业侧的进度事件写入器"""
+
+    def __init__(self, output_path: str, task_id: str):
+        self.logger = logging.getLogger(__name__)
+        self.path = progress_log_path(output_path)
+        self.task_id = task_id
+
+    def append(self, status: str, progress: float, **fields):
+        """
+        追加一个事件
+
+        Args:
+            status: 任务状态
+            progress: 总进度（0-1）
+            fields: 其余字段，如 stage、stage_status、metrics、error
+        """
+        event = {'task_id': self.task_id, 'time': time.time(), 'status': status, 'progress': progress}
+        event.update({key: value for key, value in fields.items() if value is not None})
+        line = (json.dumps(event, ensure_ascii=False, default=str) + '\n').encode('utf-8')
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # 单次O_APPEND写入整行，并发写入的事件不会交错
+            fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+        except OSError as e:
+            self.logger.warning(f"写入进度事件失败: {str(e)}")
+
+
+def read_events(path: str, offset: int = 0) -> Tuple[List[Tuple[int, Dict[str, Any]]], int]:
+    """
+    从字节偏移处读取新的完整事件
+
+    Returns:
+        [(事件结束处的偏移, 事件)] 与新的读取偏移（最后一个完整行之后）
+    """
+    try:
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        return [], offset
+
+    events = []
+    end = data.rfind(b'\n') + 1
+    position = offset
+    for line in data[:end].splitlines(keepends=True):
+        position += len(line)
+        try:
+            events.append((position, json.loads(line)))
+        except ValueError:
+            continue
+    return events, offset + end
+
+
+def last_event(path: str, max_bytes: int = 65536) -> Optional[Dict[str, Any]]:
+    """读取最后一个完整事件（只读取文件末尾），日志不存在或为空时返回None"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            f.seek(max(size - max_bytes, 0))
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    for line in reversed(data.splitlines()):
+        try:
+            return json.loads(line)
+        except ValueError:
+            continue
+    return None
+
+
+def orphaned_event(event: Dict[str, Any], scheduler_status: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """
+    作业被强制终止（内存不足、SIGKILL、超时或抢占）时不会写入结束事件；日志最后一个事件不是结束事件、
+    调度器却报告作业已结束时，生成代替结束事件的failed事件，否则返回None
+    """
+    if event.get('status') in TERMINAL_STATUSES or not scheduler_status:
+        return None
+    if scheduler_status.get('status') not in TERMINAL_STATUSES:
+        return None
+    error = f"作业已在调度器中结束（{scheduler_status['status']}），但没有写入结束事件，可能被强制终止"
+    if scheduler_status.get('error'):
+        error += f": {scheduler_status['error']}"
+    orphan = {'status': 'failed', 'progress': event.get('progress', 0.0), 'error': error}
+    if event.get('task_id'):
+        orphan['task_id'] = event['task_id']
+    if event.get('stage'):
+        orphan['stage'] = event['stage']
+    return orphan
+
+
+class _TaskTail:
+    """单个任务的进度日志读取协程及已读取的事件"""
+
+    def __init__(self, path: str):
+        self.path = path
+        # (事件结束处的偏移, 事件)；偏移为None的是由回退状态查询生成的事件
+        self.events: List[Tuple[Optional[int], Dict[str, Any]]] = []
+        self.offset = 0
+        self.done = False
+        self.subscribers = 0
+        self.changed = asyncio.Condition()
+        self.task: Optional[asyncio.Task] = None
+
+    async def publish(self, events: List[Tuple[Optional[int], Dict[str, Any]]], done: bool = False):
+        async with self.changed:
+            self.events.extend(events)
+            self.done = self.done or done
+            self.changed.notify_all()
+
+
+class ProgressBroadcaster:
+    """API进程内的进度事件分发：每个任务一个读取协程，所有订阅者共享"""
+
+    def __init__(self, poll_interval: float = 1.0, fallback_interval: float = 30.0):
+        """
+        Args:
+            poll_interval: 检查进度日志的间隔（秒，只是一次stat）
+            fallback_interval: 调用回退状态查询（如调度器）的间隔（秒）。日志尚未出现时按该间隔查询；
+                日志已有事件但不是结束事件时，在日志停止增长该秒数后查询，以发现被强制终止的作业
+        """
+        self.logger = logging.getLogger(__name__)
+        self.poll_interval = poll_interval
+        self.fallback_interval = fallback_interval
+        self._tails: Dict[str, _TaskTail] = {}
+
+    async def _query_fallback(self, fallback) -> Optional[Dict[str, Any]]:
+        try:
+            return await fallback()
+        except Exception as e:
+            self.logger.warning(f"查询任务状态失败: {str(e)}")
+            return None
+
+    async def _follow(self, tail: _TaskTail, fallback: Optional[Callable[[], Awaitable[Dict[str, Any]]]]):
+        size = -1
+        next_fallback = 0.0
+        fallback_status = None
+        last = None
+        while tail.subscribers > 0:
+            try:
+                current_size = os.stat(tail.path).st_size
+            except FileNotFoundError:
+                current_size = -1
+
+            if current_size != size:
+                size = current_size
+                events, tail.offset = read_events(tail.path, tail.offset)
+                if events:
+                    last = events[-1][1]
+                    done = last.get('status') in TERMINAL_STATUSES
+                    await tail.publish(events, done)
+                    if done:
+                        return
+                # 日志仍在增长说明作业还在运行，停止增长后才需要询问调度器
+                if current_size >= 0:
+                    next_fallback = time.monotonic() + self.fallback_interval
+            elif fallback is not None and time.monotonic() >= next_fallback:
+                next_fallback = time.monotonic() + self.fallback_interval
+                status = await self._query_fallback(fallback)
+                if last is None:
+                    # 作业还没有写入任何事件（排队中），或在启动前就已失败/被取消
+                    if status and status.get('status') != fallback_status and \
+                            status.get('status') in TERMINAL_STATUSES + ('pending',):
+                        fallback_status = status['status']
+                        done = fallback_status in TERMINAL_STATUSES
+                        event = {'status': fallback_status, 'progress': status.get('progress', 0.0)}
+                        if status.get('error'):
+                            event['error'] = status['error']
+                        # 不是日志中的事件，没有偏移
+                        await tail.publish([(None, event)], done)
+                        if done:
+                            return
+                elif orphaned_event(last, status) is not None:
+                    # 作业可能恰好在查询前写完结束事件并退出，先读完日志再判断
+                    events, tail.offset = read_events(tail.path, tail.offset)
+                    if events:
+                        last = events[-1][1]
+                    orphan = orphaned_event(last, status)
+                    if orphan is not None:
+                        self.logger.warning(f"作业未写入结束事件即终止: {tail.path}")
+                        events.append((None, orphan))
+                    await tail.publish(events, True)
+                    return
+
+            await asyncio.sleep(self.poll_interval)
+
+    async def subscribe(self, path: str, offset: int = 0, heartbeat: float = 15.0,
+                        fallback: Optional[Callable[[], Awaitable[Dict[str, Any]]]] = None
+                        ) -> AsyncIterator[Optional[Tuple[Optional[int], Dict[str, Any]]]]:
+        """
+        订阅任务的进度事件，任务结束后迭代终止
+
+        Args:
+            path: 进度日志路径
+            offset: 从该字节偏移之后的事件开始（断线重连时为最后收到的事件ID）
+            heartbeat: 没有新事件时每隔该秒数产出一次None，供调用方发送心跳
+            fallback: 查询调度器中任务状态的协程函数，用于日志尚未出现时以及发现被强制终止的作业
+
+        Yields:
+            (事件偏移, 事件)，或心跳时的None；不是来自日志的事件偏移为None
+        """
+        tail = self._tails.get(path)
+        if tail is None:
+            tail = self._tails[path] = _TaskTail(path)
+        tail.subscribers += 1
+        if tail.task is None or (tail.task.done() and not tail.done):
+            tail.task = asyncio.create_task(self._follow(tail, fallback))
+
+        try:
+            index = 0
+            while True:
+                async with tail.changed:
+                    if index >= len(tail.events) and not tail.done:
+                        try:
+                            await asyncio.wait_for(tail.changed.wait(), heartbeat)
+                        except asyncio.TimeoutError:
+                            pass
+                    # 跳过订阅者在offset之前已经收到的事件
+                    pending = [item for item in tail.events[index:] if item[0] is None or item[0] > offset]
+                    index = len(tail.events)
+                    finished = tail.done
+
+                if not pending and not finished:
+                    yield None
+                for event in pending:
+                    yield event
+                if finished:
+                    return
+        finally:
+            tail.subscribers -= 1
+            if tail.subscribers == 0 and self._tails.get(path) is tail:
+                # 最后一个订阅者离开后释放已读取的事件；读取协程在下次检查时退出
+                del self._tails[path]
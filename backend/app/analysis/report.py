@@ -0,0 +1,233 @@
+"""
+分析报告: 基于字符串模板生成单个自包含的HTML文件
+
+图表缩略图以base64内嵌（优先WebP，其次PNG），PDF原图以相对路径链接；
+统计表格直接由AnnData生成。只依赖标准库，渲染耗时为毫秒级。
+"""
+
+import base64
+import datetime
+import html
+import os
+from string import Template
+from typing import Any, Dict, Iterable, List, Optional
+
+import pandas as pd
+
+# 报告中图表的顺序与标题
+REPORT_PLOTS = [
+    ('qc_metrics', '质量控制指标'),
+    ('umap_clusters', '聚类分析'),
+    ('umap_cell_types', '细胞类型注释'),
+    ('marker_genes_heatmap', 'Marker基因热图'),
+    ('marker_genes_dotplot', 'Marker基因气泡图'),
+]
+
+_IMAGE_TYPES = {'webp': 'image/webp', 'png': 'image/png'}
+
+_PAGE = Template("""<!DOCTYPE html>
+<html lang="zh-CN">
+<head>
+<meta charset="utf-8">
+<title>单细胞RNA-seq分析报告</title>
+<style>
+body { font-family: -apple-system, "Helvetica Neue", "PingFang SC", "Microsoft YaHei", sans-serif;
+       max-width: 1100px; margin: 2em auto; padding: 0 1em; color: #222; line-height: 1.6; }
+h1 { border-bottom: 2px solid #3a6ea5; padding-bottom: .3em; }
+h2 { color: #3a6ea5; margin-top: 2em; }
+table { border-collapse: collapse; margin: 1em 0; }
+th, td { border: 1px solid #ccc; padding: .3em .8em; text-align: left; }
+th { background: #f0f4f8; }
+td.num { text-align: right; font-variant-numeric: tabular-nums; }
+figure { margin: 1.5em 0; }
+figure img { max-width: 100%; border: 1px solid #eee; }
+figcaption { color: #555; font-size: .9em; }
+.meta { color: #555; }
+.missing { color: #a33; }
+</style>
+</head>
+<body>
+<h1>单细胞RNA-seq分析报告</h1>
+<p class="meta"><b>分析时间:</b> $timestamp<br><b>数据路径:</b> $data_path<br><b>输出路径:</b> $output_path</p>
+$sections
+</body>
+</html>
+""")
+
+
+def _escape(value: Any) -> str:
+    return html.escape(str(value))
+
+
+def _table(headers: List[str], rows: Iterable[Iterable[Any]]) -> str:
+    """生成HTML表格，数值列右对齐"""
+    head = ''.join(f"<th>{_escape(h)}</th>" for h in headers)
+    body = []
+    for row in rows:
+        cells = []
+        for value in row:
+            css = ' class="num"' if isinstance(value, (int, float)) else ''
+            text = f"{value:.3f}" if isinstance(value, float) else value
+            cells.append(f"<td{css}>{_escape(text)}</td>")
+        body.append(f"<tr>{''.join(cells)}</tr>")
+    return f"<table><thead><tr>{head}</tr></thead><tbody>{''.join(body)}</tbody></table>"
+
+
+def _section(title: str, body: str) -> str:
+    return f"<h2>{_escape(title)}</h2>\n{body}"
+
+
+def _embed_image(files: Dict[str, str]) -> Optional[str]:
+    """读取缩略图并转为data URI"""
+    for fmt, mime in _IMAGE_TYPES.items():
+        path = files.get(fmt)
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                return f"data:{mime};base64,{base64.b64encode(f.read()).decode('ascii')}"
+    return None
+
+
+def _plot_files(plots_dir: str, name: str) -> Dict[str, str]:
+    return {fmt: os.path.join(plots_dir, f"{name}.{fmt}") for fmt in ['pdf', 'png', 'webp']}
+
+
+def _count_table(labels: pd.Series, header: str) -> str:
+    counts = labels.value_counts()
+    percentages = counts / counts.sum() * 100
+    return _table(
+        [header, '数量', '百分比'],
+        [(label, int(count), f"{percentages[label]:.2f}%") for label, count in counts.items()]
+    )
+
+
+def _data_section(adata) -> str:
+    rows = [('细胞数量', adata.n_obs), ('基因数量', adata.n_vars)]
+    if 'batch' in adata.obs:
+        rows.append(('批次数量', int(adata.obs['batch'].nunique())))
+    if 'highly_variable' in adata.var:
+        rows.append(('高变基因数量', int(adata.var['highly_variable'].sum())))
+    return _section('数据描述', _table(['项目', '数值'], rows))
+
+
+def _preprocess_section() -> str:
+    steps = [
+        '细胞质量控制（过滤低质量细胞）',
+        '基因过滤（移除低表达基因）',
+        '数据标准化',
+        '特征选择（高变异基因）',
+        '主成分分析',
+        '批次效应校正（如果适用）',
+    ]
+    return _section('预处理步骤', '<ol>' + ''.join(f"<li>{_escape(step)}</li>" for step in steps) + '</ol>')
+
+
+def _sketch_section(adata) -> str:
+    if 'sketch' not in adata.uns:
+        return ''
+    info = adata.uns['sketch']
+    body = (
+        f"<p>本次分析使用了几何抽样模式：聚类与细胞类型注释仅在 {int(info['n_sketch'])} 个代表性细胞"
+        f"（共 {int(info['n_cells'])} 个细胞）上运行，其余细胞的标签通过PCA空间中的kNN投票传播得到。</p>"
+    )
+    agreement = info.get('agreement', {})
+    if agreement:
+        body += _table(
+            ['标签', '留一法一致率'],
+            [(column, f"{float(value) * 100:.2f}%") for column, value in agreement.items()]
+        )
+    return _section('几何抽样', body)
+
+
+def _clustering_section(adata) -> str:
+    if 'leiden' not in adata.obs:
+        return ''
+    resolution = adata.uns.get('leiden', {}).get('params', {}).get('resolution')
+    body = f"<p>Leiden聚类共得到 {adata.obs['leiden'].nunique()} 个簇"
+    body += f"（分辨率 {float(resolution):g}）。</p>" if resolution is not None else "。</p>"
+
+    sweep = adata.uns.get('leiden_sweep')
+    if sweep is not None:
+        chosen = float(sweep.get('chosen', resolution if resolution is not None else -1))
+        body += _table(
+            ['分辨率', '簇数', '稳定性(ARI)', '选定'],
+            [
+                (f"{float(r):g}", int(n), float(s), '✓' if float(r) == chosen else '')
+                for r, n, s in zip(sweep['resolutions'], sweep['n_clusters'], sweep['stability'])
+            ]
+        )
+    body += _count_table(adata.obs['leiden'], '簇')
+    return _section('聚类结果', body)
+
+
+def _plots_section(plots_dir: str, plot_results: Dict[str, Dict[str, Any]]) -> str:
+    figures = []
+    for name, title in REPORT_PLOTS:
+        result = plot_results.get(name)
+        files = result.get('files', {}) if result else _plot_files(plots_dir, name)
+        if result is not None and result.get('status') != 'ok':
+            figures.append(f'<h3>{_escape(title)}</h3><p class="missing">图表未生成（{_escape(result["status"])}）</p>')
+            continue
+        data_uri = _embed_image(files)
+        if data_uri is None:
+            continue
+        pdf = f"plots/{name}.pdf"
+        figures.append(
+            f"<h3>{_escape(title)}</h3><figure><img src=\"{data_uri}\" alt=\"{_escape(title)}\">"
+            f"<figcaption>缩略图，原图见 <a href=\"{_escape(pdf)}\">{_escape(pdf)}</a></figcaption></figure>"
+        )
+    if not figures:
+        return ''
+    return _section('可视化结果', '\n'.join(figures))
+
+
+def _conclusion_section(adata) -> str:
+    if 'predicted_cell_type' not in adata.obs:
+        return _section('结论', '<ul><li>聚类分析完成，请查看UMAP可视化结果</li><li>尚未进行细胞类型注释</li></ul>')
+
+    counts = adata.obs['predicted_cell_type'].value_counts()
+    top_percentage = counts.iloc[0] / counts.sum() * 100
+    body = '<h3>细胞类型组成</h3>' + _count_table(adata.obs['predicted_cell_type'], '细胞类型')
+    body += (
+        '<h3>主要发现</h3><ul>'
+        f"<li>数据中识别出{len(counts)}种主要细胞类型</li>"
+        f"<li>主要细胞类型是{_escape(counts.index[0])}，占比{top_percentage:.2f}%</li></ul>"
+    )
+    return _section('结论', body)
+
+
+def render_report(adata, data_path: str, output_path: str,
+                  plot_results: Optional[Dict[str, Dict[str, Any]]] = None,
+                  filename: str = 'analysis_report.html') -> str:
+    """
+    生成自包含的HTML分析报告
+
+    Args:
+        adata: 分析完成的AnnData
+        data_path: 输入数据路径
+        output_path: 输出目录（图表位于其下的 plots/）
+        plot_results: generate_plots 的结果，为空时直接查找 plots/ 下已有的缩略图
+        filename: 报告文件名
+
+    Returns:
+        报告文件路径
+    """
+    plots_dir = os.path.join(output_path, 'plots')
+    sections = [
+        _data_section(adata),
+        _preprocess_section(),
+        _sketch_section(adata),
+        _clustering_section(adata),
+        _plots_section(plots_dir, plot_results or {}),
+        _conclusion_section(adata),
+    ]
+    page = _PAGE.substitute(
+        timestamp=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        data_path=_escape(data_path),
+        output_path=_escape(output_path),
+        sections='\n'.join(section for section in sections if section)
+    )
+
+    report_path = os.path.join(output_path, filename)
+    with open(report_path, 'w', encoding='utf-8') as f:
+        f.write(page)
+    return report_path
@@ -4,15 +4,25 @@
 """
 
 import argparse
+import gc
 import json
 import logging
 import os
 import sys
 import traceback
-from typing import Dict, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional
 import time
 
+# 绘图阶段会fork子进程，numba的TBB线程层在fork后会使父进程退出时挂起，
+# 因此须在导入numba之前默认使用workqueue线程层
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
+
+from app.analysis.instrumentation import StageMonitor
+from app.analysis.pipeline_dag import DAGExecutor, PipelineState, Stage, run_fingerprint
+from app.analysis.progress_log import ProgressLog
 from app.analysis.sc_analysis import SingleCellAnalysis
+from app.analysis.stage_cache import StageCache
 from app.core.config import settings
 
 # 设置日志
@@ -26,17 +36,34 @@ logging.basicConfig(
 )
 logger = logging.getLogger("analysis")
 
+# 可缓存的分析阶段（按执行顺序）
+CACHED_STAGES = ["preprocess", "pca", "batch_correction", "clustering", "cell_annotation"]
+
 def parse_args():
     """解析命令行参数"""
     parser = argparse.ArgumentParser(description='执行生物数据分析任务')
-    parser.add_argument('--task_id', type=str, required=True, help='任务ID')
-    parser.add_argument('--data_path', type=str, required=True, help='数据路径')
-    parser.add_argument('--output_path', type=str, required=True, help='输出路径')
-    parser.add_argument('--config', type=str, required=True, help='分析配置文件路径')
-    return parser.parse_args()
-
-def update_progress(task_id: str, progress: float, status: str, error: str = None):
-    """更新任务进度（简化版本）"""
+    parser.add_argument('--task_id', type=str, help='任务ID')
+    parser.add_argument('--data_path', type=str, help='数据路径')
+    parser.add_argument('--output_path', type=str, help='输出路径')
+    parser.add_argument('--config', type=str, help='分析配置文件路径')
+    parser.add_argument('--manifest', type=str,
+                        help='批量模式: 数据集清单（JSON或JSONL），在同一进程中依次分析多个数据集')
+    parser.add_argument('--summary', type=str, help='批量模式: 汇总结果输出路径，默认写在清单旁')
+    parser.add_argument('--no-resume', action='store_true', help='忽略上次运行的阶段状态，重新执行全部阶段')
+    args = parser.parse_args()
+    if not args.manifest:
+        missing = [name for name in ('task_id', 'data_path', 'output_path', 'config') if not getattr(args, name)]
+        if missing:
+            parser.error(f"未指定 --manifest 时必须提供: {', '.join('--' + name for name in missing)}")
+    return args
+
+def update_progress(task_id: str, progress: float, status: str, error: str = None,
+                    stages: List[Dict[str, Any]] = None, log: Optional[ProgressLog] = None, **event_fields):
+    """
+    更新任务进度（简化版本），stages 为已完成阶段的资源使用记录
+    
+    给定 log 时同时向输出目录的进度事件日志追加一个事件，event_fields 为事件的附加字段
+    """
     progress_file = f"{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}/progress/{task_id}.json"
     os.makedirs(os.path.dirname(progress_file), exist_ok=True)
     
@@ -45,83 +72,267 @@ def update_progress(task_id: str, progress: float, status: str, error: str = Non
         "progress": progress,
         "status": status,
         "timestamp": time.time(),
-        "error": error
+        "error": error,
+        "stages": stages or []
     }
     
     with open(progress_file, 'w') as f:
         json.dump(progress_data, f)
     
+    if log is not None:
+        log.append(status, progress, error=error, **event_fields)
+    
     logger.info(f"任务 {task_id} 进度更新: {progress:.2f}, 状态: {status}")
 
-def run_analysis(task_id: str, data_path: str, output_path: str, config: Dict[str, Any]):
-    """运行分析流程"""
+def create_analyzer(data_path: str, output_path: str, config: Dict[str, Any]) -> SingleCellAnalysis:
+    """按配置创建单细胞分析实例"""
+    output_params = config.get("output", {})
+    return SingleCellAnalysis(
+        data_path,
+        output_path,
+        store_format=output_params.get("format", "zarr"),
+        background_writes=output_params.get("background_writes", False)
+    )
+
+def pipeline_stages(config: Dict[str, Any], stage_funcs: Optional[Dict[str, Any]] = None) -> List[Stage]:
+    """
+    按配置构建分析阶段依赖图
+    
+    Args:
+        stage_funcs: 阶段名到阶段函数的映射；为None时阶段函数为空，只用于确定需要执行的阶段
+    """
+    stage_funcs = stage_funcs or {}
+    func = lambda name: stage_funcs.get(name, lambda: True)
+    sketch_enabled = config.get("sketch", {}).get("enabled", False)
+    
+    # 分析阶段依次依赖
+    # 抽样模式下抽样之后的阶段只在内存中的抽样数据上运行，直到标签传播后才写入检查点
+    analysis_stages = [
+        Stage("load", func("load"), persistent=False, weight=0.1),
+        Stage("preprocess", func("preprocess"), weight=0.2),
+        Stage("pca", func("pca"), weight=0.1),
+    ]
+    if sketch_enabled:
+        analysis_stages.append(Stage("sketch", func("sketch"), persistent=False, weight=0.05))
+    if config.get("batch_correction", {}).get("enabled"):
+        analysis_stages.append(
+            Stage("batch_correction", func("batch_correction"), persistent=not sketch_enabled, weight=0.1)
+        )
+    analysis_stages.append(Stage("clustering", func("clustering"), persistent=not sketch_enabled, weight=0.2))
+    if config.get("cell_annotation", {}).get("enabled"):
+        analysis_stages.append(
+            Stage("cell_annotation", func("cell_annotation"), persistent=not sketch_enabled, weight=0.1)
+        )
+    if sketch_enabled:
+        analysis_stages.append(Stage("sketch_propagation", func("sketch_propagation"), weight=0.05))
+    for previous, stage in zip(analysis_stages[:-1], analysis_stages[1:]):
+        stage.deps = [previous.name]
+    
+    # 绘图在fork出的进程池中进行：fork时其他阶段线程可能正持有HDF5/Zarr或内存分配器的锁，
+    # 子进程会在这些锁上挂起，因此绘图单独执行，完成后报告与各导出阶段再并发执行
+    last_stage = analysis_stages[-1].name
+    output_stages = [
+        Stage("plots", func("plots"), deps=[last_stage], weight=0.1),
+        Stage("viz_export", func("viz_export"), deps=["plots"], weight=0.05),
+        Stage("report", func("report"), deps=["plots"], weight=0.02),
+    ]
+    if config.get("output", {}).get("export_h5ad", False):
+        output_stages.append(Stage("export_h5ad", func("export_h5ad"), deps=["plots"], weight=0.05))
+    return analysis_stages + output_stages
+
+def run_analysis(task_id: str, data_path: str, output_path: str, config: Dict[str, Any], resume: bool = True,
+                 analyzer: Optional[SingleCellAnalysis] = None) -> bool:
+    """
+    运行分析流程
+    
+    各阶段按依赖图执行，完成状态持久化在输出目录中。resume为True时，
+    以相同数据与配置重新运行会跳过上次已完成的阶段。
+    
+    Args:
+        analyzer: 已创建（可能已预先加载数据）的分析实例，批量模式下由预取线程提供
+    
+    Returns:
+        是否成功
+    """
+    # 各阶段的资源使用写入进度记录与输出目录下的 metrics.json
+    monitor = StageMonitor(task_id, output_path, resume=resume)
+    # 进度事件追加到输出目录下的 progress.jsonl，由API推送给客户端
+    progress_log = ProgressLog(output_path, task_id)
+    current_progress = [0.0]
     try:
         # 更新初始进度
-        update_progress(task_id, 0.0, "running")
+        update_progress(task_id, 0.0, "running", log=progress_log)
+        
+        def progress(value: float):
+            current_progress[0] = value
+            update_progress(task_id, value, "running", stages=monitor.stages, log=progress_log)
+        
+        def stage_event(stage: Stage, status: str, error: Optional[str]):
+            metrics = None
+            if status != "running":
+                metrics = next((m for m in reversed(monitor.stages) if m["stage"] == stage.name), None)
+            progress_log.append(
+                "running", current_progress[0], stage=stage.name, stage_status=status, error=error, metrics=metrics
+            )
         
         # 确定分析类型
         analysis_type = config.get("analysis_type", "single_cell")
         
         if analysis_type == "single_cell":
             # 创建单细胞分析实例
-            analyzer = SingleCellAnalysis(data_path, output_path)
-            
-            # 加载数据
-            logger.info("开始加载数据...")
-            if not analyzer.load_data():
-                raise Exception("加载数据失败")
-            update_progress(task_id, 0.1, "running")
+            if analyzer is None:
+                analyzer = create_analyzer(data_path, output_path, config)
             
-            # 预处理数据
-            logger.info("开始预处理数据...")
+            load_params = config.get("load_params", {})
             preprocess_params = config.get("preprocess_params", {})
-            if not analyzer.preprocess(**preprocess_params):
-                raise Exception("预处理数据失败")
-            update_progress(task_id, 0.3, "running")
+            pca_params = config.get("pca_params", {})
+            bc_params = config.get("batch_correction", {"enabled": False})
+            clustering_params = config.get("clustering_params", {})
+            neighbors_params = dict(config.get("neighbors_params", {}))
+            neighbors_params.setdefault("backend", settings.NEIGHBORS_BACKEND)
+            annotation_params = config.get("cell_annotation", {"enabled": False})
+            plot_params = config.get("plot_params", {})
+            sketch_params = dict(config.get("sketch", {"enabled": False}))
+            sketch_enabled = sketch_params.pop("enabled", False)
+            if sketch_enabled:
+                sketch_params.setdefault("n_sketch", settings.SKETCH_SIZE)
             
-            # 批次效应校正（如果需要）
-            if "batch_correction" in config and config["batch_correction"]["enabled"]:
-                logger.info("开始批次效应校正...")
-                bc_params = config["batch_correction"]
-                if not analyzer.batch_correction(
-                    batch_key=bc_params.get("batch_key", "batch"),
-                    method=bc_params.get("method", "harmony")
-                ):
-                    raise Exception("批次效应校正失败")
-            update_progress(task_id, 0.5, "running")
+            # 阶段缓存：输入数据与参数链均未变化的阶段直接从缓存加载
+            stage_cache = StageCache.from_config(config.get("stage_cache", {}))
+            stage_keys = {}
+            cached_stages = []
+            if stage_cache:
+                stage_keys = stage_cache.stage_keys(stage_cache.dataset_digest(data_path), [
+                    ("preprocess", {"load_params": load_params, "preprocess_params": preprocess_params}),
+                    ("pca", pca_params),
+                    ("batch_correction", {"batch_correction": bc_params, "neighbors_params": neighbors_params}),
+                    ("clustering", {"clustering_params": clustering_params, "neighbors_params": neighbors_params}),
+                    ("cell_annotation", annotation_params),
+                ])
+                if sketch_enabled:
+                    # 抽样模式下之后的阶段只在抽样细胞上运行，不进入缓存
+                    stage_keys = {stage: stage_keys[stage] for stage in ("preprocess", "pca")}
+                latest_stage = stage_cache.latest_hit(stage_keys)
+                if latest_stage:
+                    cached_stages = CACHED_STAGES[:CACHED_STAGES.index(latest_stage) + 1]
             
-            # 聚类分析
-            logger.info("开始聚类分析...")
-            clustering_params = config.get("clustering_params", {})
-            if not analyzer.clustering(**clustering_params):
-                raise Exception("聚类分析失败")
-            update_progress(task_id, 0.7, "running")
+            def cache_stage(stage: str):
+                if not stage_cache or stage not in stage_keys:
+                    return
+                try:
+                    stage_cache.save(stage_keys[stage], analyzer.adata, stage)
+                except Exception as e:
+                    logger.warning(f"写入阶段缓存失败: {str(e)}")
+            
+            # 阶段函数：返回False表示失败
+            def load():
+                if cached_stages:
+                    logger.info(f"从阶段缓存恢复 {cached_stages[-1]} 阶段的结果...")
+                    analyzer.adata = stage_cache.load(stage_keys[cached_stages[-1]])
+                    return True
+                if analyzer.adata is not None:
+                    # 批量模式下数据已在上一个数据集分析期间预先加载
+                    return True
+                return analyzer.load_data(**load_params)
             
-            # 细胞类型注释（如果需要）
-            if "cell_annotation" in config and config["cell_annotation"]["enabled"]:
-                logger.info("开始细胞类型注释...")
-                annotation_params = config["cell_annotation"]
-                if not analyzer.cell_type_annotation(
-                    method=annotation_params.get("method", "scgpt"),
-                    model_path=annotation_params.get("model_path", settings.SCGPT_MODEL_PATH)
-                ):
-                    raise Exception("细胞类型注释失败")
-            update_progress(task_id, 0.8, "running")
+            def cached_or(stage: str, func):
+                def run():
+                    if stage in cached_stages:
+                        return True
+                    if not func():
+                        return False
+                    cache_stage(stage)
+                    return True
+                return run
             
-            # 生成图表
-            logger.info("生成可视化图表...")
-            if not analyzer.generate_plots():
-                raise Exception("生成可视化图表失败")
-            update_progress(task_id, 0.9, "running")
+            def sketch():
+                return analyzer.sketch(**{k: v for k, v in sketch_params.items() if k != "propagation"})
             
-            # 生成报告
-            logger.info("生成分析报告...")
-            if not analyzer.generate_report():
-                raise Exception("生成分析报告失败")
+            def propagate_sketch():
+                propagation_params = dict(sketch_params.get("propagation", {}))
+                propagation_params.setdefault("backend", neighbors_params["backend"])
+                return analyzer.propagate_sketch(**propagation_params)
+            
+            stages = pipeline_stages(config, {
+                "load": load,
+                "preprocess": cached_or("preprocess", lambda: analyzer.preprocess(**preprocess_params)),
+                "pca": cached_or("pca", lambda: analyzer.pca(**pca_params)),
+                "sketch": sketch,
+                "batch_correction": cached_or(
+                    "batch_correction",
+                    lambda: analyzer.batch_correction(
+                        batch_key=bc_params.get("batch_key", "batch"),
+                        method=bc_params.get("method", "harmony"),
+                        neighbors_params=neighbors_params
+                    )
+                ),
+                "clustering": cached_or(
+                    "clustering",
+                    lambda: analyzer.clustering(**clustering_params, neighbors_params=neighbors_params)
+                ),
+                "cell_annotation": cached_or(
+                    "cell_annotation",
+                    lambda: analyzer.cell_type_annotation(
+                        method=annotation_params.get("method", "scgpt"),
+                        model_path=annotation_params.get("model_path", settings.SCGPT_MODEL_PATH),
+                        marker_db=annotation_params.get("marker_db"),
+                        marker_db_options=annotation_params.get("marker_db_options"),
+                        n_threads=annotation_params.get("n_threads"),
+                        batch_size=annotation_params.get("batch_size")
+                    )
+                ),
+                "sketch_propagation": propagate_sketch,
+                "plots": lambda: analyzer.generate_plots(**plot_params),
+                "viz_export": analyzer.export_visualization,
+                "report": analyzer.generate_report,
+                "export_h5ad": analyzer.export_h5ad,
+            })
+            
+            def on_stage_complete(stage: Stage):
+                # 检查点写入完成后才记录阶段完成
+                if stage.persistent:
+                    analyzer.flush()
+                    if analyzer.checkpoint_path:
+                        state.meta["checkpoint"] = analyzer.checkpoint_path
+            
+            state = PipelineState(output_path, run_fingerprint(data_path, config))
+            if not resume:
+                state.reset()
+            executor = DAGExecutor(
+                stages,
+                state,
+                max_workers=config.get("max_parallel_stages", 3),
+                monitor=monitor,
+                on_progress=progress,
+                on_stage_complete=on_stage_complete,
+                on_stage_event=stage_event
+            )
+            to_run = executor.plan()
+            if "load" not in to_run and to_run:
+                # 从上次中断处继续：数据从检查点恢复，不再使用阶段缓存
+                cached_stages = []
+                if not analyzer.load_checkpoint(state.meta.get("checkpoint", "")):
+                    logger.warning("检查点不可用，重新执行全部阶段")
+                    state.reset()
+                    to_run = executor.plan()
+            if not state.completed():
+                # 全部阶段重新执行，之前运行的指标与本次结果无关
+                monitor.discard_previous()
+            for stage in stages:
+                if stage.name in cached_stages:
+                    # 从缓存恢复的阶段没有写入检查点
+                    stage.persistent = False
+            executor.run(to_run)
+            
+            # 等待阶段输出写入完成
+            with monitor.stage("flush"):
+                analyzer.close()
             
             # 完成分析
-            update_progress(task_id, 1.0, "completed")
+            update_progress(task_id, 1.0, "completed", stages=monitor.stages, log=progress_log,
+                            metrics=monitor.summary()["total"])
             logger.info(f"分析任务 {task_id} 已完成")
+            return True
             
         else:
             raise ValueError(f"不支持的分析类型: {analysis_type}")
@@ -129,19 +340,153 @@ def run_analysis(task_id: str, data_path: str, output_path: str, config: Dict[st
     except Exception as e:
         logger.error(f"分析失败: {str(e)}")
         logger.error(traceback.format_exc())
-        update_progress(task_id, 0.0, "failed", str(e))
-        sys.exit(1)
+        # 保留失败前的进度：重新提交时从最后完成的阶段继续
+        update_progress(task_id, current_progress[0], "failed", str(e), stages=monitor.stages, log=progress_log)
+        return False
+
+def load_manifest(manifest_path: str) -> List[Dict[str, Any]]:
+    """
+    读取批量模式的数据集清单
+    
+    清单为JSON（条目列表，或含 entries 字段的对象）或JSONL（每行一个条目）。每个条目包含
+    data_path、output_path 以及 config（配置对象）或 config_path（配置文件路径），task_id
+    默认为输出目录名。相对路径相对于清单所在目录解析。
+    """
+    with open(manifest_path, 'r') as f:
+        if manifest_path.endswith('.jsonl'):
+            entries = [json.loads(line) for line in f if line.strip()]
+        else:
+            entries = json.load(f)
+    if isinstance(entries, dict):
+        entries = entries.get("entries", [])
+    
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    resolve = lambda path: path if os.path.isabs(path) else os.path.join(base_dir, path)
+    datasets = []
+    for i, entry in enumerate(entries):
+        missing = [key for key in ("data_path", "output_path") if key not in entry]
+        if missing or ("config" not in entry and "config_path" not in entry):
+            raise ValueError(f"清单第 {i + 1} 项缺少字段: {', '.join(missing or ['config'])}")
+        config = entry.get("config")
+        if config is None:
+            with open(resolve(entry["config_path"]), 'r') as f:
+                config = json.load(f)
+        output_path = resolve(entry["output_path"])
+        datasets.append({
+            "task_id": entry.get("task_id") or os.path.basename(os.path.normpath(output_path)),
+            "data_path": resolve(entry["data_path"]),
+            "output_path": output_path,
+            "config": config,
+        })
+    return datasets
+
+def _uses_scgpt(config: Dict[str, Any]) -> bool:
+    annotation_params = config.get("cell_annotation", {})
+    return bool(annotation_params.get("enabled")) and annotation_params.get("method", "scgpt") == "scgpt"
+
+def _needs_load(dataset: Dict[str, Any], resume: bool) -> bool:
+    """分析该数据集时是否会执行load阶段：从上次中断处继续或全部阶段已完成时不加载原始数据"""
+    if not resume:
+        return True
+    config = dataset["config"]
+    state = PipelineState(dataset["output_path"], run_fingerprint(dataset["data_path"], config))
+    return "load" in DAGExecutor(pipeline_stages(config), state).plan()
+
+def _prefetch(dataset: Dict[str, Any], resume: bool = True) -> SingleCellAnalysis:
+    """在后台线程中创建分析实例并加载数据；加载失败时返回未加载数据的实例，由分析流程重新尝试并记录错误"""
+    config = dataset["config"]
+    analyzer = create_analyzer(dataset["data_path"], dataset["output_path"], config)
+    if (config.get("analysis_type", "single_cell") == "single_cell" and not config.get("stage_cache")
+            and _needs_load(dataset, resume)):
+        analyzer.load_data(**config.get("load_params", {}))
+    return analyzer
+
+def run_batch(datasets: List[Dict[str, Any]], resume: bool = True, prefetch: bool = True) -> List[Dict[str, Any]]:
+    """
+    在同一进程中依次分析多个数据集
+    
+    模型在进程内只加载一次，供所有数据集共享；分析当前数据集时，下一个数据集的数据在后台线程中
+    预先加载。每个数据集有独立的进度记录与输出目录，单个数据集失败不影响其余数据集。
+    
+    Args:
+        datasets: load_manifest 返回的数据集列表
+        resume: 是否跳过各数据集上次已完成的阶段
+        prefetch: 是否预先加载下一个数据集（会同时占用两个数据集的内存）
+    
+    Returns:
+        每个数据集的执行结果
+    """
+    # 预先加载一次注释模型，后续数据集直接复用
+    scgpt_paths = set(
+        dataset["config"]["cell_annotation"].get("model_path", settings.SCGPT_MODEL_PATH)
+        for dataset in datasets if _uses_scgpt(dataset["config"])
+    )
+    for model_path in scgpt_paths:
+        try:
+            from app.models.scgpt_integration import get_scgpt_model
+            get_scgpt_model(model_path)
+        except Exception as e:
+            logger.warning(f"预先加载scGPT模型失败，将在注释阶段重试: {str(e)}")
+    
+    results = []
+    with ThreadPoolExecutor(max_workers=1) as loader:
+        pending = loader.submit(_prefetch, datasets[0], resume) if prefetch and datasets else None
+        for i, dataset in enumerate(datasets):
+            task_id = dataset["task_id"]
+            started_at = time.time()
+            try:
+                analyzer = pending.result() if pending is not None else None
+            except Exception as e:
+                logger.warning(f"预先加载数据集 {task_id} 失败，将重新加载: {str(e)}")
+                analyzer = None
+            pending = None
+            if prefetch and i + 1 < len(datasets):
+                pending = loader.submit(_prefetch, datasets[i + 1], resume)
+            
+            logger.info(f"批量分析 [{i + 1}/{len(datasets)}]: {task_id}")
+            try:
+                ok = run_analysis(
+                    task_id, dataset["data_path"], dataset["output_path"], dataset["config"],
+                    resume=resume, analyzer=analyzer
+                )
+            except Exception as e:
+                logger.error(f"数据集 {task_id} 分析失败: {str(e)}")
+                ok = False
+            results.append({
+                "task_id": task_id,
+                "data_path": dataset["data_path"],
+                "output_path": dataset["output_path"],
+                "status": "completed" if ok else "failed",
+                "seconds": time.time() - started_at,
+            })
+            # 释放当前数据集，避免与预取的下一个数据集叠加占用内存
+            del analyzer
+            gc.collect()
+    
+    failed = [result["task_id"] for result in results if result["status"] != "completed"]
+    logger.info(f"批量分析完成: 成功 {len(results) - len(failed)} 个, 失败 {len(failed)} 个")
+    if failed:
+        logger.error(f"失败的数据集: {', '.join(failed)}")
+    return results
 
 def main():
     """主函数"""
     args = parse_args()
     
+    if args.manifest:
+        results = run_batch(load_manifest(args.manifest), resume=not args.no_resume)
+        summary_path = args.summary or os.path.splitext(os.path.abspath(args.manifest))[0] + ".summary.json"
+        with open(summary_path, 'w') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+        sys.exit(0 if all(result["status"] == "completed" for result in results) else 1)
+    
     # 加载配置
     with open(args.config, 'r') as f:
         config = json.load(f)
     
     # 运行分析
-    run_analysis(args.task_id, args.data_path, args.output_path, config)
+    if not run_analysis(args.task_id, args.data_path, args.output_path, config, resume=not args.no_resume):
+        sys.exit(1)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -1,31 +1,151 @@
-import scanpy as sc
 import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 from typing import Dict, Any, List, Optional, Tuple
 import logging
 import os
+import time
 
 class SingleCellAnalysis:
     """单细胞分析核心类"""
     
-    def __init__(self, data_path: str, output_path: str):
+    def __init__(self, data_path: str, output_path: str, store_format: str = 'zarr',
+                 background_writes: bool = False):
+        """
+        初始化单细胞分析
+        
+        Args:
+            data_path: 输入数据路径
+            output_path: 输出目录
+            store_format: 阶段输出格式，'zarr' 为增量写入同一存储，'h5ad' 为每个阶段写完整文件
+            background_writes: 是否在后台线程写入阶段输出
+        """
         self.logger = logging.getLogger(__name__)
         self.data_path = data_path
         self.output_path = output_path
         self.adata = None
+        # backed模式下表达矩阵保留在磁盘上，按块处理
+        self.backed = False
+        self.chunk_size = 20000
+        # 各图表的生成结果（见 generate_plots）
+        self.plot_results = {}
+        # 抽样模式下保存全部细胞的数据与抽样细胞索引，聚类等阶段只在抽样细胞上运行
+        self.full_adata = None
+        self.sketch_idx = None
+        # 最近一次写入的阶段输出位置，用于作业中断后恢复
+        self.checkpoint_path = None
         
         # 确保输出目录存在
         os.makedirs(output_path, exist_ok=True)
+        
+        self.store_format = store_format
+        self.store = None
+        if store_format == 'zarr':
+            from app.analysis.stage_store import StageStore
+            self.store = StageStore(os.path.join(output_path, 'analysis.zarr'), background=background_writes)
+    
+    def _save_stage(self, stage: str, h5ad_name: str, full: bool = False, **slots):
+        """
+        保存阶段输出
+        
+        Args:
+            stage: 阶段名称
+            h5ad_name: h5ad格式下的输出文件名
+            full: 是否写入完整数据（矩阵发生变化的阶段）
+            slots: 增量写入的数据槽，见 StageStore.write_slots
+        """
+        if self.full_adata is not None:
+            # 抽样细胞上的结果在传播回全部细胞后统一写入
+            self.logger.info(f"抽样模式: 阶段 {stage} 的输出将在标签传播后写入")
+        elif self.store is None:
+            from app.analysis.backed import write_h5ad
+            
+            self.checkpoint_path = os.path.join(self.output_path, h5ad_name)
+            write_h5ad(self.checkpoint_path, self.adata)
+        else:
+            if full:
+                self.store.write_full(self.adata, stage)
+            else:
+                self.store.write_slots(self.adata, stage, **slots)
+            self.checkpoint_path = self.store.path
+    
+    def flush(self):
+        """等待已提交的阶段输出写入完成"""
+        if self.store is not None:
+            self.store.flush()
+    
+    def load_checkpoint(self, checkpoint_path: str) -> bool:
+        """
+        从阶段输出（Zarr存储或阶段h5ad文件）恢复数据，用于作业中断后继续执行
+        
+        Args:
+            checkpoint_path: 中断前记录的 checkpoint_path
+        """
+        try:
+            import scanpy as sc
+            
+            if self.store is not None and os.path.abspath(checkpoint_path) == os.path.abspath(self.store.path):
+                self.adata = self.store.read()
+            else:
+                self.adata = sc.read_h5ad(checkpoint_path)
+            self.checkpoint_path = checkpoint_path
+            self.logger.info(f"已从检查点恢复数据: {checkpoint_path}，形状: {self.adata.shape}")
+            return True
+        except Exception as e:
+            self.logger.error(f"从检查点恢复数据失败: {str(e)}")
+            return False
     
-    def load_data(self) -> bool:
-        """加载单细胞数据"""
+    def export_h5ad(self, filename: str = 'analysis_result.h5ad') -> bool:
+        """导出完整分析结果为h5ad文件"""
         try:
+            from app.analysis.backed import write_h5ad
+            
+            h5ad_path = os.path.join(self.output_path, filename)
+            # 与可视化导出等阶段并发执行，backed数据不能改为指向导出文件
+            if self.store is not None:
+                self.store.export_h5ad(h5ad_path, self.adata)
+            else:
+                write_h5ad(h5ad_path, self.adata)
+            return True
+        except Exception as e:
+            self.logger.error(f"导出h5ad文件失败: {str(e)}")
+            return False
+    
+    def _load_backed(self):
+        """
+        把backed模式预处理得到的高变基因矩阵（稀疏）载入内存，供需要完整表达矩阵的阶段
+        （批次校正、聚类与marker基因、注释）使用；PCA与抽样按块读取，不需要载入
+        """
+        if self.adata.isbacked:
+            self.logger.info(f"载入高变基因矩阵: {self.adata.n_obs} 个细胞 × {self.adata.n_vars} 个基因")
+            self.adata = self.adata.to_memory()
+        self.backed = False
+    
+    def close(self):
+        """等待所有阶段输出写入完成"""
+        if self.store is not None:
+            self.store.close()
+    
+    def load_data(self, backed: bool = False, chunk_size: int = 20000) -> bool:
+        """
+        加载单细胞数据
+        
+        Args:
+            backed: 是否以backed模式打开h5ad文件（矩阵保留在磁盘上，按块预处理）
+            chunk_size: backed模式下每块处理的细胞数
+        """
+        try:
+            import scanpy as sc
+            
             self.logger.info(f"加载数据: {self.data_path}")
             
+            if backed and not self.data_path.endswith('.h5ad'):
+                self.logger.warning("backed模式仅支持h5ad格式，将完整加载到内存")
+                backed = False
+            
             if self.data_path.endswith('.h5ad'):
-                self.adata = sc.read_h5ad(self.data_path)
+                self.adata = sc.read_h5ad(self.data_path, backed='r' if backed else None)
+                self.backed = backed
+                self.chunk_size = chunk_size
             elif self.data_path.endswith('.mtx'):
                 # 读取10x格式
                 self.adata = sc.read_10x_mtx(
@@ -46,39 +166,242 @@ class SingleCellAnalysis:
             return False
     
     def preprocess(self, min_genes: int = 200, min_cells: int = 3, 
-                  max_genes: int = 5000, max_mt_percent: float = 10.0) -> bool:
-        """预处理数据"""
+                  max_genes: int = 5000, max_mt_percent: float = 10.0,
+                  n_threads: Optional[int] = None) -> bool:
+        """
+        预处理数据
+        
+        Args:
+            min_genes: 细胞最少表达基因数
+            min_cells: 基因最少表达细胞数
+            max_genes: 细胞最多表达基因数
+            max_mt_percent: 线粒体基因counts占比上限
+            n_threads: 质控计算使用的线程数，默认使用全部可用CPU
+        """
         try:
-            # 质量控制
-            sc.pp.calculate_qc_metrics(self.adata, qc_vars=['mt'], inplace=True)
+            import scanpy as sc
+            
+            if self.backed:
+                # 分块完成质控、标准化和高变基因选择，高变基因矩阵逐块写入磁盘，峰值内存只取决于chunk_size
+                from app.analysis.backed import BackedPreprocessor
+                
+                preprocessor = BackedPreprocessor(self.adata, chunk_size=self.chunk_size, n_threads=n_threads)
+                self.adata = preprocessor.run(
+                    os.path.join(self.output_path, 'preprocessed_hvg.h5ad'),
+                    min_genes=min_genes,
+                    min_cells=min_cells,
+                    max_genes=max_genes,
+                    max_mt_percent=max_mt_percent
+                )
+                self._save_stage('preprocess', 'preprocessed.h5ad', full=True)
+                return True
             
-            # 过滤细胞和基因
-            self.adata = self.adata[self.adata.obs.n_genes_by_counts > min_genes, :]
-            self.adata = self.adata[self.adata.obs.n_genes_by_counts < max_genes, :]
-            self.adata = self.adata[self.adata.obs.pct_counts_mt < max_mt_percent, :]
+            from app.analysis.qc import QCEngine
             
-            # 过滤低表达基因
-            sc.pp.filter_genes(self.adata, min_cells=min_cells)
+            # 质量控制：单次扫描计算质控指标，合并所有阈值后一次性过滤细胞和基因
+            qc_engine = QCEngine(n_threads=n_threads, chunk_size=self.chunk_size)
+            self.adata = qc_engine.filter(
+                self.adata,
+                min_genes=min_genes,
+                min_cells=min_cells,
+                max_genes=max_genes,
+                max_mt_percent=max_mt_percent
+            )
             
             # 标准预处理流程
-            sc.pp.normalize_total(self.adata, target_sum=1e4)
-            sc.pp.log1p(self.adata)
-            sc.pp.highly_variable_genes(self.adata, n_top_genes=2000)
+            with qc_engine.timed('normalize_total'):
+                sc.pp.normalize_total(self.adata, target_sum=1e4)
+            with qc_engine.timed('log1p'):
+                sc.pp.log1p(self.adata)
+            with qc_engine.timed('highly_variable_genes'):
+                sc.pp.highly_variable_genes(self.adata, n_top_genes=2000)
+            self.adata.uns['preprocess_timings'] = dict(qc_engine.timings)
             
             # 保存预处理后的数据
-            self.adata.write(os.path.join(self.output_path, 'preprocessed.h5ad'))
+            self._save_stage('preprocess', 'preprocessed.h5ad', full=True)
             
             return True
         except Exception as e:
             self.logger.error(f"预处理失败: {str(e)}")
             return False
     
-    def batch_correction(self, batch_key: str, method: str = 'harmony') -> bool:
-        """批次效应校正"""
+    def pca(self, method: str = 'randomized', n_comps: int = 50, n_oversamples: int = 10, n_iter: int = 4,
+            n_threads: Optional[int] = None) -> bool:
+        """
+        主成分分析（稀疏隐式中心化随机SVD或分块增量PCA，见 pca.run_pca）
+        
+        Args:
+            method: 'randomized' 或 'incremental'
+            n_comps: 主成分数
+            n_oversamples: 随机SVD的过采样维数
+            n_iter: 随机SVD的幂迭代次数
+            n_threads: BLAS线程数
+        """
+        try:
+            from app.analysis.pca import run_pca
+            
+            # backed模式下按块读取磁盘上的高变基因矩阵做增量PCA
+            run_pca(
+                self.adata,
+                method=method,
+                n_comps=n_comps,
+                n_oversamples=n_oversamples,
+                n_iter=n_iter,
+                chunk_size=self.chunk_size,
+                n_threads=n_threads
+            )
+            
+            # 保存PCA结果
+            self._save_stage('pca', 'pca.h5ad', obsm=['X_pca'], varm=['PCs'], uns=['pca'])
+            
+            return True
+        except Exception as e:
+            self.logger.error(f"PCA失败: {str(e)}")
+            return False
+    
+    def sketch(self, n_sketch: int = 50000, n_dims: int = 10, random_state: int = 0) -> bool:
+        """
+        几何抽样：之后的批次校正、聚类与注释只在抽样细胞上运行，最后由 propagate_sketch 传播回全部细胞
+        
+        Args:
+            n_sketch: 抽样细胞数
+            n_dims: 用于划分网格的前几个主成分
+            random_state: 随机种子
+        """
+        try:
+            from app.analysis.sketch import geometric_sketch
+            
+            sketch_idx = geometric_sketch(self.adata.obsm['X_pca'], n_sketch, n_dims=n_dims, random_state=random_state)
+            self.full_adata = self.adata
+            self.sketch_idx = sketch_idx
+            # backed模式下只把抽样细胞的表达矩阵载入内存，全部细胞仍保留在磁盘上
+            sketch_adata = self.full_adata[sketch_idx]
+            self.adata = sketch_adata.to_memory() if self.full_adata.isbacked else sketch_adata.copy()
+            self.adata.uns['sketch'] = {
+                'method': 'geometric',
+                'n_cells': int(self.full_adata.n_obs),
+                'n_sketch': int(len(sketch_idx)),
+                'params': {'n_dims': n_dims, 'random_state': random_state},
+            }
+            self.logger.info(f"几何抽样: 从 {self.full_adata.n_obs} 个细胞中选出 {len(sketch_idx)} 个")
+            return True
+        except Exception as e:
+            self.logger.error(f"几何抽样失败: {str(e)}")
+            return False
+    
+    def propagate_sketch(self, n_neighbors: int = 15, backend: str = 'nndescent',
+                         n_threads: Optional[int] = None) -> bool:
+        """
+        在PCA空间中用kNN投票把抽样细胞上的聚类与细胞类型标签传播回全部细胞，UMAP坐标按近邻加权平均投影
+        
+        Args:
+            n_neighbors: 投票使用的近邻数
+            backend: 近邻后端，见 neighbors.knn_query
+            n_threads: 线程数
+        """
+        try:
+            from app.analysis.neighbors import knn_query
+            from app.analysis.sketch import loo_agreement, project_embedding, propagate_labels
+            
+            sketch, full, sketch_idx = self.adata, self.full_adata, self.sketch_idx
+            query_idx = np.setdiff1d(np.arange(full.n_obs), sketch_idx)
+            indices, distances = knn_query(
+                sketch.obsm['X_pca'], full.obsm['X_pca'][query_idx], n_neighbors,
+                backend=backend, n_threads=n_threads
+            )
+            
+            # 分类标签：抽样细胞保留原标签，其余细胞按近邻投票
+            columns = [
+                column for column in sketch.obs.columns
+                if column == 'leiden' or column.startswith('leiden_r') or column == 'predicted_cell_type'
+            ]
+            labels, confidence = propagate_labels(sketch.obs, indices, distances, columns)
+            for column in columns:
+                categories = labels[column].cat.categories
+                codes = np.empty(full.n_obs, dtype=np.int64)
+                codes[sketch_idx] = pd.Categorical(sketch.obs[column], categories=categories).codes
+                codes[query_idx] = labels[column].cat.codes.to_numpy()
+                full.obs[column] = pd.Categorical.from_codes(codes, categories=categories)
+            
+            in_sketch = np.zeros(full.n_obs, dtype=bool)
+            in_sketch[sketch_idx] = True
+            full.obs['in_sketch'] = in_sketch
+            label_confidence = np.ones(full.n_obs, dtype=np.float32)
+            label_confidence[query_idx] = confidence['leiden']
+            full.obs['sketch_label_confidence'] = label_confidence
+            
+            if 'X_umap' in sketch.obsm:
+                umap_coords = np.empty((full.n_obs, sketch.obsm['X_umap'].shape[1]), dtype=np.float32)
+                umap_coords[sketch_idx] = sketch.obsm['X_umap']
+                umap_coords[query_idx] = project_embedding(np.asarray(sketch.obsm['X_umap']), indices, distances)
+                full.obsm['X_umap'] = umap_coords
+            
+            # 聚类与marker基因结果来自抽样细胞
+            result_keys = [
+                key for key in sketch.uns
+                if key in ('leiden', 'leiden_sweep', 'umap') or key.startswith('rank_genes_groups')
+            ]
+            for key in result_keys:
+                full.uns[key] = sketch.uns[key]
+            
+            # 留一法估计传播准确率
+            agreement = loo_agreement(
+                sketch.obsm['X_pca'], sketch.obs,
+                [column for column in ('leiden', 'predicted_cell_type') if column in columns],
+                n_neighbors=n_neighbors, backend=backend, n_threads=n_threads
+            )
+            full.uns['sketch'] = dict(
+                sketch.uns['sketch'],
+                n_neighbors=n_neighbors,
+                agreement=agreement,
+                mean_confidence=float(confidence['leiden'].mean()) if len(query_idx) else 1.0
+            )
+            self.logger.info(f"标签已传播到 {len(query_idx)} 个细胞，留一法一致率: {agreement}")
+            
+            self.adata = full
+            self.full_adata = None
+            self.sketch_idx = None
+            self._save_stage(
+                'sketch_propagation', 'sketch_propagated.h5ad', obs=True,
+                obsm=['X_umap'], uns=['sketch'] + result_keys
+            )
+            return True
+        except Exception as e:
+            self.logger.error(f"抽样标签传播失败: {str(e)}")
+            return False
+    
+    def compute_neighbors(self, use_rep: Optional[str] = None,
+                          neighbors_params: Optional[Dict[str, Any]] = None):
+        """
+        构建近邻图（近似最近邻后端，见 neighbors.compute_neighbors）
+        
+        Args:
+            use_rep: 使用的低维表示
+            neighbors_params: 近邻参数（backend、n_neighbors、metric、n_threads、backend_options）
+        """
+        from app.analysis.neighbors import compute_neighbors
+        
+        compute_neighbors(self.adata, use_rep=use_rep, **(neighbors_params or {}))
+    
+    def batch_correction(self, batch_key: str, method: str = 'harmony',
+                         neighbors_params: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        批次效应校正
+        
+        Args:
+            batch_key: 批次列名
+            method: 校正方法，'harmony'、'bbknn' 或 'scanorama'
+            neighbors_params: 近邻图参数，见 compute_neighbors
+        """
         try:
+            import scanpy as sc
+            
+            self._load_backed()
+            
             if method == 'harmony':
-                # 先进行PCA
-                sc.pp.pca(self.adata)
+                # 先进行PCA（通常已在PCA阶段完成）
+                if 'X_pca' not in self.adata.obsm and not self.pca():
+                    return False
                 # 然后使用Harmony
                 import harmonypy
                 from harmonypy import run_harmony
@@ -93,14 +416,15 @@ class SingleCellAnalysis:
                 self.adata.uns['X_emb'] = 'X_harmony'
                 
                 # 使用harmony校正后的结果进行降维
-                sc.pp.neighbors(self.adata, use_rep='X_harmony')
+                self.compute_neighbors(use_rep='X_harmony', neighbors_params=neighbors_params)
                 sc.tl.umap(self.adata)
                 
             elif method == 'bbknn':
                 # 使用BBKNN进行批次校正
                 import bbknn
                 # 先进行PCA
-                sc.pp.pca(self.adata)
+                if 'X_pca' not in self.adata.obsm and not self.pca():
+                    return False
                 # 直接用BBKNN构建批次校正后的KNN图
                 bbknn.bbknn(self.adata, batch_key=batch_key)
                 sc.tl.umap(self.adata)
@@ -131,289 +455,243 @@ class SingleCellAnalysis:
                     start += n_cells
                 
                 # 使用scanorama校正后的结果进行降维
-                sc.pp.neighbors(self.adata, use_rep='X_scanorama')
+                self.compute_neighbors(use_rep='X_scanorama', neighbors_params=neighbors_params)
                 sc.tl.umap(self.adata)
             
             else:
                 self.logger.error(f"不支持的批次校正方法: {method}")
                 return False
             
-            # 保存批次校正后的数据
-            self.adata.write(os.path.join(self.output_path, 'batch_corrected.h5ad'))
+            # 保存批次校正后的数据（只写入降维与邻接图相关的数据槽）
+            self._save_stage(
+                'batch_correction', 'batch_corrected.h5ad',
+                obsm=['X_pca', 'X_harmony', 'X_scanorama', 'X_umap'],
+                obsp=['connectivities', 'distances'],
+                varm=['PCs'],
+                uns=['pca', 'neighbors', 'umap', 'X_emb']
+            )
             
             return True
         except Exception as e:
             self.logger.error(f"批次校正失败: {str(e)}")
             return False
     
-    def clustering(self, resolution: float = 0.5) -> bool:
-        """聚类分析"""
+    def clustering(self, resolution: Optional[float] = 0.5, resolutions: Optional[List[float]] = None,
+                   marker_resolutions: Optional[List[float]] = None, n_workers: Optional[int] = None,
+                   n_threads: Optional[int] = None,
+                   neighbors_params: Optional[Dict[str, Any]] = None) -> bool:
+        """
+        聚类分析
+        
+        Args:
+            resolution: Leiden分辨率；扫描模式下为选定的分辨率，不在扫描范围内或为None时选稳定性最高的分辨率
+            resolutions: 扫描的分辨率列表，所有划分并列保存在 obs['leiden_r{分辨率}'] 中
+            marker_resolutions: 扫描模式下额外计算marker基因的分辨率
+            n_workers: 扫描模式下的并行进程数
+            n_threads: marker基因检测使用的线程数
+            neighbors_params: 未做批次校正（尚无近邻图）时构建近邻图的参数，见 compute_neighbors
+        """
         try:
-            # 执行聚类
-            sc.tl.leiden(self.adata, resolution=resolution)
+            import scanpy as sc
+            
+            self._load_backed()
+            
+            # 未做批次校正时在PCA上构建近邻图与UMAP
+            built_graph = 'neighbors' not in self.adata.uns
+            if built_graph:
+                if 'X_pca' not in self.adata.obsm and not self.pca():
+                    return False
+                self.compute_neighbors(use_rep='X_pca', neighbors_params=neighbors_params)
+                sc.tl.umap(self.adata)
+            
+            extra_markers = []
+            if resolutions:
+                # 多分辨率扫描：所有分辨率共享同一个近邻图，并行运行
+                from app.analysis.clustering import choose_resolution, leiden_sweep, resolution_key
+                
+                summary = leiden_sweep(self.adata, resolutions, n_workers=n_workers)
+                chosen = choose_resolution(summary, resolution)
+                summary['chosen'] = chosen
+                self.adata.uns['leiden_sweep'] = summary
+                self.adata.obs['leiden'] = self.adata.obs[resolution_key(chosen)].copy()
+                self.adata.uns['leiden'] = {'params': {'resolution': chosen, 'sweep': True}}
+                self.logger.info(f"选定Leiden分辨率: {chosen:g}")
+                
+                # marker基因只为选定的分辨率计算
+                for extra in marker_resolutions or []:
+                    key = resolution_key(float(extra))
+                    if float(extra) != chosen and key in self.adata.obs:
+                        extra_markers.append(key)
+            else:
+                # 执行聚类
+                sc.tl.leiden(self.adata, resolution=resolution)
+            
+            # 计算每个簇的marker基因（向量化秩和检验，所有簇一次完成）
+            from app.analysis.rank_markers import rank_genes_groups
             
-            # 计算每个簇的marker基因
-            sc.tl.rank_genes_groups(self.adata, 'leiden', method='wilcoxon')
+            rank_genes_groups(self.adata, 'leiden', n_threads=n_threads)
+            for key in extra_markers:
+                rank_genes_groups(self.adata, key, key_added=f"rank_genes_groups_{key}", n_threads=n_threads)
             
             # 保存聚类结果
-            self.adata.write(os.path.join(self.output_path, 'clustered.h5ad'))
+            graph_slots = {
+                'obsm': ['X_pca', 'X_umap'],
+                'obsp': ['connectivities', 'distances'],
+                'varm': ['PCs'],
+            } if built_graph else {}
+            self._save_stage(
+                'clustering', 'clustered.h5ad', obs=True,
+                uns=['leiden', 'leiden_sweep', 'rank_genes_groups', 'pca', 'neighbors', 'umap']
+                    + [f"rank_genes_groups_{key}" for key in extra_markers],
+                **graph_slots
+            )
             
             return True
         except Exception as e:
             self.logger.error(f"聚类失败: {str(e)}")
             return False
     
-    def cell_type_annotation(self, method: str = 'scgpt', model_path: str = None) -> bool:
-        """细胞类型注释"""
+    def cell_type_annotation(self, method: str = 'scgpt', model_path: str = None,
+                             marker_db: Optional[str] = None,
+                             marker_db_options: Optional[Dict[str, Any]] = None,
+                             n_threads: Optional[int] = None,
+                             batch_size: Optional[int] = None) -> bool:
+        """
+        细胞类型注释
+        
+        Args:
+            method: 注释方法，'scgpt' 或 'marker_genes'
+            model_path: scGPT模型路径
+            marker_db: marker数据库表格路径（PanglaoDB/CellMarker格式TSV），为None时使用内置marker
+            marker_db_options: 读取marker表的选项，见 load_marker_table
+            n_threads: marker打分使用的线程数
+            batch_size: scGPT每批推理的细胞数，默认为 SCGPT_BATCH_SIZE
+        """
         try:
+            self._load_backed()
+            
             if method == 'scgpt':
-                # 使用scGPT进行细胞类型注释
-                from app.models.scgpt.inference import SCGPTAnnotator
+                # 使用scGPT进行细胞类型注释：模型在进程内缓存，批量处理多个数据集时只加载一次
+                from app.analysis.markers import DEFAULT_MARKERS, load_marker_table
+                from app.core.config import settings
+                from app.models.embedding_cache import EmbeddingCache
+                from app.models.scgpt_integration import get_scgpt_model
                 
-                annotator = SCGPTAnnotator(model_path=model_path)
-                cell_types = annotator.predict(self.adata)
+                if marker_db:
+                    options = {k: v for k, v in (marker_db_options or {}).items() if k != 'case_sensitive'}
+                    table = load_marker_table(marker_db, **options)
+                    # 保留marker表中的基因权重，细胞类型中心按权重加权
+                    cell_type_markers = {
+                        cell_type: dict(zip(group['gene'], group['weight']))
+                        for cell_type, group in table.groupby('cell_type', sort=False)
+                    }
+                else:
+                    cell_type_markers = DEFAULT_MARKERS
+                
+                # 模型流式读取稀疏表达矩阵（backed模式下逐批从磁盘读取），逐批把结果写入输出目录；
+                # 细胞嵌入缓存在数据文件旁，只更换marker或阈值时不再重新推理
+                model = get_scgpt_model(model_path or settings.SCGPT_MODEL_PATH)
+                labels, scores = model.annotate_cell_types(
+                    self.adata, cell_type_markers, batch_size=batch_size,
+                    output_dir=os.path.join(self.output_path, 'scgpt_annotation'),
+                    embedding_cache=EmbeddingCache.from_settings(self.data_path)
+                )
                 
                 # 将注释结果添加到adata
-                self.adata.obs['predicted_cell_type'] = cell_types
+                self.adata.obs['predicted_cell_type'] = labels
+                self.adata.obs['cell_type_score'] = np.asarray(scores)
                 
             elif method == 'marker_genes':
-                # 基于已知marker基因进行注释
-                marker_dict = {
-                    'T细胞': ['CD3D', 'CD3E', 'CD3G', 'CD8A', 'CD4'],
-                    'B细胞': ['CD19', 'CD79A', 'CD79B', 'MS4A1'],
-                    'NK细胞': ['NCAM1', 'NKG7', 'KLRD1'],
-                    '单核细胞': ['CD14', 'LYZ', 'CSF1R'],
-                    '巨噬细胞': ['CD68', 'CD163', 'MRC1'],
-                    '树突状细胞': ['ITGAX', 'CLEC9A', 'CD1C'],
-                    '上皮细胞': ['EPCAM', 'KRT8', 'KRT18'],
-                    '成纤维细胞': ['COL1A1', 'DCN', 'LUM']
-                }
-                
-                # 为每个细胞计算每个细胞类型的得分
-                cell_type_scores = {}
-                for cell_type, markers in marker_dict.items():
-                    # 获取存在于数据中的marker
-                    existing_markers = [m for m in markers if m in self.adata.var_names]
-                    if not existing_markers:
-                        continue
-                    
-                    # 计算marker基因的平均表达
-                    cell_type_scores[cell_type] = self.adata[:, existing_markers].X.mean(axis=1)
+                # 基于marker基因进行注释：一次稀疏矩阵乘法为所有细胞和细胞类型打分
+                from app.analysis.markers import DEFAULT_MARKERS, MarkerScorer
                 
-                # 转换为DataFrame
-                scores_df = pd.DataFrame(cell_type_scores, index=self.adata.obs_names)
+                if marker_db:
+                    scorer = MarkerScorer.from_table(marker_db, **(marker_db_options or {}))
+                else:
+                    scorer = MarkerScorer.from_dict(DEFAULT_MARKERS)
                 
-                # 分配细胞类型（选择得分最高的类型）
-                predicted_types = scores_df.idxmax(axis=1)
-                self.adata.obs['predicted_cell_type'] = predicted_types
+                labels, scores = scorer.annotate(
+                    self.adata.X,
+                    self.adata.var_names,
+                    chunk_size=self.chunk_size,
+                    n_threads=n_threads
+                )
+                self.adata.obs['predicted_cell_type'] = labels
+                self.adata.obs['cell_type_score'] = scores
                 
             else:
                 self.logger.error(f"不支持的注释方法: {method}")
                 return False
             
             # 保存注释结果
-            self.adata.write(os.path.join(self.output_path, 'annotated.h5ad'))
+            self._save_stage('cell_annotation', 'annotated.h5ad', obs=True)
             
             return True
         except Exception as e:
             self.logger.error(f"细胞类型注释失败: {str(e)}")
             return False
     
-    def generate_plots(self) -> bool:
-        """生成可视化图表"""
+    def generate_plots(self, n_workers: Optional[int] = None, time_budget: float = 300.0,
+                       dpi: int = 150, thumbnail_dpi: int = 72) -> bool:
+        """
+        生成可视化图表
+        
+        各图表在fork出的进程池中并行绘制（子进程共享AnnData，不复制数据），
+        散点层栅格化，同时生成PNG/WebP缩略图。超出时间预算的图表会被跳过。
+        
+        Args:
+            n_workers: 并行绘图进程数
+            time_budget: 每个图表的时间预算（秒）
+            dpi: PDF中栅格化图层的分辨率
+            thumbnail_dpi: 缩略图分辨率
+        """
         try:
-            # 创建图表目录
-            plots_dir = os.path.join(self.output_path, 'plots')
-            os.makedirs(plots_dir, exist_ok=True)
-            
-            # QC指标可视化
-            sc.pl.violin(self.adata, ['n_genes_by_counts', 'total_counts', 'pct_counts_mt'],
-                        jitter=0.4, multi_panel=True,
-                        save=os.path.join(plots_dir, 'qc_metrics.pdf'))
-            
-            # UMAP聚类可视化
-            sc.pl.umap(self.adata, color=['leiden'], 
-                      save=os.path.join(plots_dir, 'umap_clusters.pdf'))
+            from app.analysis.plotting import render_plots
             
-            # 如果有细胞类型注释，则可视化
-            if 'predicted_cell_type' in self.adata.obs:
-                sc.pl.umap(self.adata, color=['predicted_cell_type'], 
-                          save=os.path.join(plots_dir, 'umap_cell_types.pdf'))
+            # fork前等待后台写入完成，避免子进程继承写线程持有的锁
+            if self.store is not None:
+                self.store.flush()
             
-            # 热图展示各簇marker基因
-            sc.pl.rank_genes_groups_heatmap(self.adata, n_genes=10, 
-                                          save=os.path.join(plots_dir, 'marker_genes_heatmap.pdf'))
-            
-            # 气泡图展示各簇特征基因
-            sc.pl.rank_genes_groups_dotplot(self.adata, n_genes=5, 
-                                          save=os.path.join(plots_dir, 'marker_genes_dotplot.pdf'))
-            
-            # 保存数据用于前端可视化
-            self._export_for_plotly()
+            plots_dir = os.path.join(self.output_path, 'plots')
+            self.plot_results = render_plots(
+                self.adata,
+                plots_dir,
+                n_workers=n_workers,
+                time_budget=time_budget,
+                dpi=dpi,
+                thumbnail_dpi=thumbnail_dpi
+            )
+            skipped = [name for name, result in self.plot_results.items() if result['status'] != 'ok']
+            if skipped:
+                self.logger.warning(f"以下图表未生成: {', '.join(skipped)}")
             
             return True
         except Exception as e:
             self.logger.error(f"生成可视化图表失败: {str(e)}")
             return False
     
-    def _export_for_plotly(self):
-        """导出数据用于前端Plotly.js可视化"""
+    def export_visualization(self, n_top_genes: int = 50) -> bool:
+        """导出数据用于前端Plotly.js可视化（二进制列式格式，见 viz_export）"""
         try:
-            # 导出UMAP坐标和元数据
-            umap_coords = self.adata.obsm['X_umap']
-            
-            # 准备数据
-            export_data = {
-                'umap': {
-                    'x': umap_coords[:, 0].tolist(),
-                    'y': umap_coords[:, 1].tolist()
-                },
-                'metadata': {}
-            }
-            
-            # 添加聚类信息
-            if 'leiden' in self.adata.obs:
-                export_data['metadata']['cluster'] = self.adata.obs['leiden'].astype(str).tolist()
-            
-            # 添加细胞类型注释（如果有）
-            if 'predicted_cell_type' in self.adata.obs:
-                export_data['metadata']['cell_type'] = self.adata.obs['predicted_cell_type'].astype(str).tolist()
-            
-            # 添加QC指标
-            for metric in ['n_genes_by_counts', 'total_counts', 'pct_counts_mt']:
-                if metric in self.adata.obs:
-                    export_data['metadata'][metric] = self.adata.obs[metric].tolist()
+            from app.analysis.viz_export import export_visualization
             
-            # 保存为JSON文件
-            import json
-            json_path = os.path.join(self.output_path, 'plotly_data.json')
-            with open(json_path, 'w') as f:
-                json.dump(export_data, f)
-                
-            # 导出热门基因的表达数据
-            n_top_genes = 50
-            if hasattr(self.adata, 'uns') and 'rank_genes_groups' in self.adata.uns:
-                top_genes = []
-                for i in range(min(n_top_genes, self.adata.uns['rank_genes_groups']['names'].shape[1])):
-                    for cluster in self.adata.uns['rank_genes_groups']['names'].dtype.names:
-                        gene = self.adata.uns['rank_genes_groups']['names'][cluster][i]
-                        if gene not in top_genes:
-                            top_genes.append(gene)
-                
-                # 导出这些基因的表达数据
-                gene_exp_data = {}
-                for gene in top_genes:
-                    if gene in self.adata.var_names:
-                        gene_exp_data[gene] = self.adata[:, gene].X.toarray().flatten().tolist()
-                
-                # 保存为JSON
-                gene_exp_path = os.path.join(self.output_path, 'gene_expression.json')
-                with open(gene_exp_path, 'w') as f:
-                    json.dump(gene_exp_data, f)
-                    
+            manifest = export_visualization(self.adata, self.output_path, n_top_genes=n_top_genes)
+            self.logger.info(
+                f"可视化数据已导出: {len(manifest['columns'])} 列, {len(manifest['genes'])} 个基因"
+            )
+            return True
         except Exception as e:
             self.logger.error(f"导出前端可视化数据失败: {str(e)}")
+            return False
     
     def generate_report(self) -> bool:
-        """生成分析报告"""
+        """生成自包含的HTML分析报告（内嵌图表缩略图与统计表格，见 report）"""
         try:
-            # 使用nbconvert基于模板生成HTML报告
-            import nbformat as nbf
-            from nbconvert import HTMLExporter
-            import datetime
-            
-            # 创建一个notebook对象
-            nb = nbf.v4.new_notebook()
-            
-            # 添加标题单元格
-            title_cell = nbf.v4.new_markdown_cell(f"""
-            # 单细胞RNA-seq分析报告
-            **分析时间:** {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}
-            **数据路径:** {self.data_path}
-            **输出路径:** {self.output_path}
-            """)
-            
-            # 添加数据描述单元格
-            data_cell = nbf.v4.new_markdown_cell(f"""
-            ## 数据描述
-            
-            - 细胞数量: {self.adata.n_obs}
-            - 基因数量: {self.adata.n_vars}
-            - 批次数量: {self.adata.obs['batch'].nunique() if 'batch' in self.adata.obs else 'N/A'}
-            """)
-            
-            # 添加预处理描述
-            preprocess_cell = nbf.v4.new_markdown_cell("""
-            ## 预处理步骤
-            
-            1. 细胞质量控制（过滤低质量细胞）
-            2. 基因过滤（移除低表达基因）
-            3. 数据标准化
-            4. 特征选择（高变异基因）
-            5. 批次效应校正（如果适用）
-            """)
-            
-            # 添加图像单元格（嵌入图像文件）
-            plots_dir = os.path.join(self.output_path, 'plots')
-            plots_cell = nbf.v4.new_markdown_cell("""
-            ## 可视化结果
+            from app.analysis.report import render_report
             
-            ### 聚类分析
-            ![UMAP聚类结果](plots/umap_clusters.pdf)
-            
-            ### 细胞类型注释
-            ![细胞类型注释](plots/umap_cell_types.pdf)
-            
-            ### Marker基因热图
-            ![Marker基因热图](plots/marker_genes_heatmap.pdf)
-            
-            ### Marker基因气泡图
-            ![Marker基因气泡图](plots/marker_genes_dotplot.pdf)
-            """)
-            
-            # 添加结论单元格
-            if 'predicted_cell_type' in self.adata.obs:
-                # 计算每种细胞类型的数量
-                cell_type_counts = self.adata.obs['predicted_cell_type'].value_counts()
-                cell_type_percentages = cell_type_counts / cell_type_counts.sum() * 100
-                
-                cell_type_table = "| 细胞类型 | 数量 | 百分比 |\n|----------|------|---------|\n"
-                for cell_type, count in cell_type_counts.items():
-                    percentage = cell_type_percentages[cell_type]
-                    cell_type_table += f"| {cell_type} | {count} | {percentage:.2f}% |\n"
-                
-                conclusion_cell = nbf.v4.new_markdown_cell(f"""
-                ## 结论
-                
-                ### 细胞类型组成
-                
-                {cell_type_table}
-                
-                ### 主要发现
-                
-                - 数据中识别出{len(cell_type_counts)}种主要细胞类型
-                - 主要细胞类型是{cell_type_counts.index[0]}，占比{cell_type_percentages.iloc[0]:.2f}%
-                """)
-            else:
-                conclusion_cell = nbf.v4.new_markdown_cell("""
-                ## 结论
-                
-                - 聚类分析完成，请查看UMAP可视化结果
-                - 尚未进行细胞类型注释
-                """)
-            
-            # 添加所有单元格到notebook
-            nb.cells.extend([title_cell, data_cell, preprocess_cell, plots_cell, conclusion_cell])
-            
-            # 转换为HTML
-            html_exporter = HTMLExporter()
-            html_exporter.template_name = 'classic'
-            (body, resources) = html_exporter.from_notebook_node(nb)
-            
-            # 保存HTML报告
-            report_path = os.path.join(self.output_path, 'analysis_report.html')
-            with open(report_path, 'w', encoding='utf-8') as f:
-                f.write(body)
+            start = time.perf_counter()
+            report_path = render_report(self.adata, self.data_path, self.output_path, self.plot_results)
+            self.logger.info(f"分析报告已生成: {report_path}，耗时 {(time.perf_counter() - start) * 1000:.0f}ms")
             
             return True
         except Exception as e:
@@ -0,0 +1,139 @@
+"""
+几何抽样（geometric sketching）: 在PCA空间中按覆盖而非密度抽取代表性子集，保留稀有细胞群
+
+把PCA空间划分为等边长的超立方体网格，调整边长使非空格子数接近目标抽样数，
+再从每个格子中随机取一个细胞。稠密区域与稀疏区域得到的抽样数相近，稀有细胞群不会被淹没。
+聚类与注释只在抽样细胞上运行，之后在PCA空间中用kNN投票把标签传播回所有细胞。
+"""
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+
+def _occupied_boxes(grid: np.ndarray, hash_coefs: np.ndarray) -> Tuple[np.ndarray, int]:
+    # 用随机系数把网格坐标哈希为64位整数，等价于对整行去重但快得多
+    keys = grid @ hash_coefs
+    unique_keys, box_ids = np.unique(keys, return_inverse=True)
+    return box_ids, len(unique_keys)
+
+
+def geometric_sketch(X: np.ndarray, n_sketch: int, n_dims: int = 10, n_steps: int = 30,
+                     random_state: int = 0) -> np.ndarray:
+    """
+    几何抽样
+
+    Args:
+        X: (细胞数 × 维数) PCA表示
+        n_sketch: 抽样细胞数
+        n_dims: 用于划分网格的前几个主成分
+        n_steps: 二分搜索格子边长的步数
+        random_state: 随机种子
+
+    Returns:
+        排序后的抽样细胞索引
+    """
+    n_obs = X.shape[0]
+    if n_sketch >= n_obs:
+        return np.arange(n_obs)
+
+    rng = np.random.default_rng(random_state)
+    X = np.asarray(X[:, :n_dims], dtype=np.float64)
+    X = X - X.min(axis=0)
+    hash_coefs = rng.integers(1, 2 ** 62, size=X.shape[1], dtype=np.int64)
+
+    # 二分搜索格子边长：边长越小非空格子越多
+    # 初始时每个细胞自成一格，总能满足目标抽样数
+    low, high = 0.0, float(X.max()) + 1e-9
+    box_ids = np.arange(n_obs)
+    for _ in range(n_steps):
+        unit = (low + high) / 2
+        candidate_ids, candidate_boxes = _occupied_boxes((X / unit).astype(np.int64), hash_coefs)
+        if candidate_boxes < n_sketch:
+            high = unit
+        else:
+            low = unit
+            box_ids = candidate_ids
+        if candidate_boxes == n_sketch:
+            break
+
+    # 每个格子随机取一个细胞：打乱后取每个格子第一次出现的细胞
+    order = rng.permutation(n_obs)
+    _, first = np.unique(box_ids[order], return_index=True)
+    representatives = order[first]
+    if len(representatives) > n_sketch:
+        representatives = rng.choice(representatives, size=n_sketch, replace=False)
+    elif len(representatives) < n_sketch:
+        rest = np.setdiff1d(np.arange(n_obs), representatives)
+        extra = rng.choice(rest, size=n_sketch - len(representatives), replace=False)
+        representatives = np.concatenate([representatives, extra])
+    return np.sort(representatives)
+
+
+def _vote(neighbor_labels: np.ndarray, weights: np.ndarray, n_classes: int) -> Tuple[np.ndarray, np.ndarray]:
+    """按距离加权的多数投票，返回标签编码与得票比例"""
+    n_query = neighbor_labels.shape[0]
+    rows = np.repeat(np.arange(n_query), neighbor_labels.shape[1])
+    votes = np.bincount(
+        rows * n_classes + neighbor_labels.ravel(),
+        weights=weights.ravel(),
+        minlength=n_query * n_classes
+    ).reshape(n_query, n_classes)
+    codes = votes.argmax(axis=1)
+    confidence = votes[np.arange(n_query), codes] / np.maximum(votes.sum(axis=1), 1e-12)
+    return codes, confidence
+
+
+def _weights(distances: np.ndarray) -> np.ndarray:
+    return 1.0 / (distances.astype(np.float64) + 1e-6)
+
+
+def propagate_labels(sketch_obs: pd.DataFrame, indices: np.ndarray, distances: np.ndarray,
+                     columns: List[str]) -> Tuple[pd.DataFrame, Dict[str, np.ndarray]]:
+    """
+    把抽样细胞上的分类标签传播到查询细胞
+
+    Args:
+        sketch_obs: 抽样细胞的obs
+        indices: (查询细胞数 × k) 抽样细胞中的近邻编号
+        distances: 对应的距离
+        columns: 需要传播的分类列
+
+    Returns:
+        (查询细胞的标签表, 每列的投票置信度)
+    """
+    weights = _weights(distances)
+    labels = {}
+    confidence = {}
+    for column in columns:
+        categorical = pd.Categorical(sketch_obs[column])
+        codes, conf = _vote(categorical.codes[indices], weights, len(categorical.categories))
+        labels[column] = pd.Categorical.from_codes(codes, categories=categorical.categories)
+        confidence[column] = conf
+    return pd.DataFrame(labels), confidence
+
+
+def project_embedding(embedding: np.ndarray, indices: np.ndarray, distances: np.ndarray) -> np.ndarray:
+    """用近邻抽样细胞坐标的距离加权平均，把嵌入（如UMAP）投影到查询细胞"""
+    weights = _weights(distances)
+    weights /= weights.sum(axis=1, keepdims=True)
+    return np.einsum('ij,ijk->ik', weights, embedding[indices]).astype(np.float32)
+
+
+def loo_agreement(X_sketch: np.ndarray, sketch_obs: pd.DataFrame, columns: List[str], n_neighbors: int = 15,
+                  backend: str = 'nndescent', n_threads: Optional[int] = None) -> Dict[str, float]:
+    """
+    留一法估计传播准确率：每个抽样细胞用其余抽样细胞的近邻投票预测标签，与真实标签比较
+    """
+    from app.analysis.neighbors import knn
+
+    indices, distances = knn(X_sketch, min(n_neighbors + 1, X_sketch.shape[0]), backend=backend,
+                             n_threads=n_threads)
+    indices, distances = indices[:, 1:], distances[:, 1:]
+    predicted, _ = propagate_labels(sketch_obs, indices, distances, columns)
+    return {
+        column: float(np.mean(predicted[column].astype(str).to_numpy() == sketch_obs[column].astype(str).to_numpy()))
+        for column in columns
+    }
+
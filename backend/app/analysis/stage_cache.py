@@ -0,0 +1,204 @@
+"""
+分析阶段缓存: 以输入数据内容哈希和各阶段参数链为键，缓存每个阶段的输出
+
+只修改后续阶段参数（如聚类分辨率、注释方法）重新提交任务时，前面的阶段直接从缓存加载。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+# 计算文件哈希时每次读取的字节数
+_HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def _file_sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def dataset_digest(data_path: str, memo_file: Optional[str] = None) -> str:
+    """
+    计算输入数据的内容哈希
+
+    数据路径可以是单个文件或目录（如10x格式目录）。大文件哈希代价较高，
+    按 (路径, 大小, 修改时间) 记录在 memo_file 中，文件未变化时直接复用。
+
+    Args:
+        data_path: 数据文件或目录路径
+        memo_file: 哈希记录文件路径
+
+    Returns:
+        十六进制sha256摘要
+    """
+    if os.path.isdir(data_path):
+        files = sorted(
+            os.path.join(root, name)
+            for root, _, names in os.walk(data_path)
+            for name in names
+        )
+    else:
+        files = [data_path]
+
+    memo = {}
+    if memo_file and os.path.exists(memo_file):
+        try:
+            with open(memo_file, 'r') as f:
+                memo = json.load(f)
+        except (OSError, ValueError):
+            memo = {}
+
+    digest = hashlib.sha256()
+    updated = False
+    for path in files:
+        stat = os.stat(path)
+        memo_key = f"{os.path.abspath(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+        if memo_key not in memo:
+            memo[memo_key] = _file_sha256(path)
+            updated = True
+        digest.update(os.path.relpath(path, data_path).encode() if len(files) > 1 else b'')
+        digest.update(memo[memo_key].encode())
+
+    if memo_file and updated:
+        tmp_file = f"{memo_file}.{os.getpid()}.tmp"
+        with open(tmp_file, 'w') as f:
+            json.dump(memo, f)
+        os.replace(tmp_file, memo_file)
+
+    return digest.hexdigest()
+
+
+class StageCache:
+    """按内容寻址的分析阶段缓存，按总大小和时间淘汰"""
+
+    def __init__(self, cache_dir: str, max_size_bytes: Optional[int] = None,
+                 max_age_seconds: Optional[float] = None):
+        """
+        初始化阶段缓存
+
+        Args:
+            cache_dir: 缓存目录
+            max_size_bytes: 缓存总大小上限，超出时淘汰最久未使用的条目
+            max_age_seconds: 条目最长保留时间（自最近一次使用起算）
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_config(cls, cache_config: Dict[str, Any]) -> Optional["StageCache"]:
+        """根据分析配置中的 stage_cache 部分创建缓存，未启用时返回None"""
+        from app.core.config import settings
+
+        if not cache_config.get("enabled", settings.STAGE_CACHE_ENABLED):
+            return None
+
+        max_size_gb = cache_config.get("max_size_gb", settings.STAGE_CACHE_MAX_SIZE_GB)
+        max_age_days = cache_config.get("max_age_days", settings.STAGE_CACHE_MAX_AGE_DAYS)
+        return cls(
+            cache_config.get("cache_dir", settings.STAGE_CACHE_PATH),
+            max_size_bytes=int(max_size_gb * 1024 ** 3) if max_size_gb else None,
+            max_age_seconds=max_age_days * 86400 if max_age_days else None
+        )
+
+    def dataset_digest(self, data_path: str) -> str:
+        """计算输入数据的内容哈希（哈希记录保存在缓存目录中）"""
+        return dataset_digest(data_path, memo_file=os.path.join(self.cache_dir, 'digests.json'))
+
+    @staticmethod
+    def stage_keys(dataset_hash: str, stages: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, str]:
+        """
+        计算各阶段的缓存键
+
+        每个阶段的键由上一阶段的键、阶段名称和阶段参数共同决定，
+        因此任一阶段参数变化会使其后所有阶段的键失效。
+
+        Args:
+            dataset_hash: 输入数据内容哈希
+            stages: 按执行顺序排列的 (阶段名称, 阶段参数) 列表
+
+        Returns:
+            阶段名称到缓存键的字典
+        """
+        keys = {}
+        previous = dataset_hash
+        for name, params in stages:
+            payload = json.dumps(params, sort_keys=True, default=str)
+            previous = hashlib.sha256(f"{previous}\n{name}\n{payload}".encode()).hexdigest()
+            keys[name] = previous
+        return keys
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.h5ad")
+
+    def contains(self, key: str) -> bool:
+        return os.path.exists(self._entry_path(key))
+
+    def latest_hit(self, stage_keys: Dict[str, str]) -> Optional[str]:
+        """返回缓存中存在的最后一个阶段名称（各阶段按执行顺序排列）"""
+        for name in reversed(list(stage_keys)):
+            if self.contains(stage_keys[name]):
+                return name
+        return None
+
+    def load(self, key: str):
+        """从缓存加载阶段输出，并刷新条目的使用时间"""
+        import anndata as ad
+
+        path = self._entry_path(key)
+        adata = ad.read_h5ad(path)
+        os.utime(path)
+        self.logger.info(f"命中阶段缓存: {path}")
+        return adata
+
+    def save(self, key: str, adata, stage: str):
+        """写入阶段输出（先写临时文件再原子替换），并执行淘汰"""
+        from app.analysis.backed import write_h5ad
+
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        try:
+            # AnnData.write 会把backed对象改为指向新写入的文件，而临时文件随后会被改名
+            write_h5ad(tmp_path, adata)
+            os.replace(tmp_path, path)
+            self.logger.info(f"阶段 {stage} 输出已写入缓存: {path}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self.evict()
+
+    def evict(self):
+        """删除过期条目，并按最近使用时间淘汰直到总大小不超过上限"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.h5ad'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        now = time.time()
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            expired = self.max_age_seconds is not None and now - mtime > self.max_age_seconds
+            oversized = self.max_size_bytes is not None and total_size > self.max_size_bytes
+            if not (expired or oversized):
+                continue
+            try:
+                os.remove(path)
+                total_size -= size
+                self.logger.info(f"淘汰阶段缓存: {path}")
+            except FileNotFoundError:
+                pass
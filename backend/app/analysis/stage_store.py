@@ -0,0 +1,184 @@
+"""
+阶段输出存储: 所有分析阶段的结果增量写入同一个分块Zarr存储
+
+预处理阶段写入完整AnnData，后续阶段只写入自身修改的部分（obs、obsm、obsp、varm、uns中的键），
+避免每个阶段都重写一遍表达矩阵。写入可以放到后台线程执行，不阻塞计算。
+"""
+
+import logging
+import queue
+import threading
+from typing import Iterable
+
+try:
+    from anndata.io import write_elem
+except ImportError:
+    from anndata.experimental import write_elem
+
+
+class StageStore:
+    """基于Zarr的增量阶段输出存储"""
+
+    def __init__(self, path: str, background: bool = False, max_pending: int = 4):
+        """
+        初始化阶段输出存储
+
+        Args:
+            path: Zarr存储路径
+            background: 是否在后台写线程中执行写入
+            max_pending: 后台模式下最多排队的写入任务数
+        """
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.background = background
+        self._error = None
+        # 本次运行是否已写入过完整数据，之后的阶段才能只写增量
+        self._has_full = False
+        self._queue = None
+        self._worker = None
+        if background:
+            self._queue = queue.Queue(maxsize=max_pending)
+            self._worker = threading.Thread(target=self._run_worker, name="stage-store-writer", daemon=True)
+            self._worker.start()
+
+    def _open_group(self):
+        import zarr
+
+        # 存储带有合并元数据，必须绕过它才能增量修改，写完后重新合并
+        try:
+            return zarr.open_group(self.path, mode='r+', use_consolidated=False)
+        except TypeError:
+            return zarr.open_group(self.path, mode='r+')
+
+    def _write_full(self, adata):
+        adata.write_zarr(self.path)
+
+    def _write_slots(self, slots):
+        import zarr
+
+        group = self._open_group()
+        for slot, key, value in slots:
+            if key is None:
+                write_elem(group, slot, value)
+            else:
+                if slot not in group:
+                    group.create_group(slot)
+                write_elem(group[slot], key, value)
+        zarr.consolidate_metadata(self.path)
+
+    def _run_worker(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                func, args, stage = task
+                if self._error is None:
+                    func(*args)
+                    self.logger.info(f"阶段 {stage} 输出已写入: {self.path}")
+            except Exception as e:
+                self.logger.error(f"后台写入阶段输出失败: {str(e)}")
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _submit(self, func, args, stage: str):
+        if self._error is not None:
+            raise self._error
+        if self.background:
+            self._queue.put((func, args, stage))
+        else:
+            func(*args)
+            self.logger.info(f"阶段 {stage} 输出已写入: {self.path}")
+
+    @staticmethod
+    def _snapshot(adata):
+        import anndata as ad
+
+        return ad.AnnData(
+            X=adata.X,
+            obs=adata.obs.copy(),
+            var=adata.var.copy(),
+            uns=dict(adata.uns),
+            obsm=dict(adata.obsm),
+            varm=dict(adata.varm),
+            obsp=dict(adata.obsp),
+            layers=dict(adata.layers)
+        )
+
+    def write_full(self, adata, stage: str):
+        """写入完整的AnnData（覆盖已有存储）"""
+        # 后台写入时使用浅快照（共享矩阵数据，复制obs/var等容器），
+        # 避免后续阶段增删obs列、obsm键时与写线程冲突
+        snapshot = self._snapshot(adata) if self.background else adata
+        self._submit(self._write_full, (snapshot,), stage)
+        self._has_full = True
+
+    def write_slots(self, adata, stage: str, obs: bool = False, obsm: Iterable[str] = (),
+                    obsp: Iterable[str] = (), varm: Iterable[str] = (), uns: Iterable[str] = ()):
+        """
+        只写入指定的数据槽
+
+        Args:
+            adata: 当前的AnnData
+            stage: 阶段名称（用于日志）
+            obs: 是否重写obs表
+            obsm/obsp/varm/uns: 需要写入的键，不存在的键会被忽略
+        """
+        if not self._has_full:
+            # 阶段结果来自缓存等情况时本次运行尚未写入完整数据，先写入完整数据
+            self.write_full(adata, stage)
+            return
+
+        slots = []
+        if obs:
+            slots.append(('obs', None, adata.obs.copy()))
+        for slot, keys in (('obsm', obsm), ('obsp', obsp), ('varm', varm), ('uns', uns)):
+            mapping = getattr(adata, slot)
+            for key in keys:
+                if key in mapping:
+                    value = mapping[key]
+                    slots.append((slot, key, dict(value) if isinstance(value, dict) else value))
+        self._submit(self._write_slots, (slots,), stage)
+
+    def flush(self):
+        """等待所有后台写入完成，若有写入失败则抛出异常"""
+        if self.background:
+            self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """完成剩余写入并停止后台写线程"""
+        if self.background and self._worker.is_alive():
+            self._queue.put(None)
+            self._worker.join()
+        if self._error is not None:
+            raise self._error
+
+    def read(self):
+        """读取存储中的AnnData（从检查点恢复），之后的阶段继续增量写入"""
+        import anndata as ad
+
+        self.flush()
+        adata = ad.read_zarr(self.path)
+        self._has_full = True
+        return adata
+
+    def export_h5ad(self, h5ad_path: str, adata=None):
+        """
+        导出h5ad文件
+
+        Args:
+            h5ad_path: 导出路径
+            adata: 内存中的AnnData，为None时从Zarr存储读取
+        """
+        import anndata as ad
+
+        from app.analysis.backed import write_h5ad
+
+        self.flush()
+        if adata is None:
+            adata = ad.read_zarr(self.path)
+        write_h5ad(h5ad_path, adata)
+        self.logger.info(f"已导出h5ad文件: {h5ad_path}")
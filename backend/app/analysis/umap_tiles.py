@@ -0,0 +1,150 @@
+"""
+UMAP多分辨率瓦片金字塔: 为百万级细胞散点图预计算各缩放级别的降采样点集
+
+每个细胞被赋予一个随机优先级，缩放级别z取优先级最靠前的 tile_capacity * 4^z 个细胞，
+即各级别都是全体细胞的均匀随机子集，保留原始密度分布；级别之间互相嵌套，放大时只会增加细节。
+为防止极密集区域单块过大，每块点数另设上限。前端只请求当前视野和缩放级别对应的瓦片。
+"""
+
+import os
+from typing import Any, Dict, Optional
+
+import numpy as np
+
+# 最大缩放级别（4^10 约一百万块）
+MAX_ZOOM_LIMIT = 10
+
+
+def _tile_ids(norm_xy: np.ndarray, zoom: int) -> np.ndarray:
+    n_tiles = 2 ** zoom
+    tx = np.minimum((norm_xy[:, 0] * n_tiles).astype(np.int64), n_tiles - 1)
+    ty = np.minimum((norm_xy[:, 1] * n_tiles).astype(np.int64), n_tiles - 1)
+    return ty * n_tiles + tx
+
+
+def build_umap_tiles(coords: np.ndarray, viz_dir: str, tile_capacity: int = 4096,
+                     max_tile_points: Optional[int] = None, seed: int = 0) -> Dict[str, Any]:
+    """
+    构建UMAP瓦片金字塔
+
+    Args:
+        coords: (细胞数 × 2) UMAP坐标
+        viz_dir: 输出目录
+        tile_capacity: 平均每块瓦片的目标点数（级别0的点数）
+        max_tile_points: 单块瓦片点数上限，默认 4 * tile_capacity
+        seed: 随机种子
+
+    Returns:
+        写入可视化清单的瓦片描述
+    """
+    coords = np.asarray(coords, dtype=np.float32)
+    n_obs = coords.shape[0]
+    max_tile_points = max_tile_points or 4 * tile_capacity
+
+    if n_obs == 0:
+        # 没有细胞时只写出一个空的级别0，read_viewport 返回0个点
+        prefix = os.path.join(viz_dir, "tiles_z0")
+        for suffix, dtype in (('tiles.i64', '<i8'), ('cells.i32', '<i4'), ('xy.f32', '<f4')):
+            np.zeros(0, dtype=dtype).tofile(f"{prefix}.{suffix}")
+        np.zeros(1, dtype='<i8').tofile(f"{prefix}.offsets.i64")
+        return {
+            'bounds': [0.0, 0.0, 0.0, 0.0],
+            'tile_capacity': tile_capacity,
+            'max_tile_points': max_tile_points,
+            'max_zoom': 0,
+            'levels': [{'zoom': 0, 'n_tiles': 0, 'n_points': 0}],
+        }
+
+    xmin, ymin = coords.min(axis=0)
+    xmax, ymax = coords.max(axis=0)
+    span = np.maximum(np.array([xmax - xmin, ymax - ymin]), 1e-6)
+    norm_xy = (coords - np.array([xmin, ymin])) / span
+
+    # 随机优先级：rank 越小越早出现在低缩放级别
+    priority = np.empty(n_obs, dtype=np.int64)
+    priority[np.random.default_rng(seed).permutation(n_obs)] = np.arange(n_obs)
+
+    levels = []
+    for zoom in range(MAX_ZOOM_LIMIT + 1):
+        budget = min(n_obs, tile_capacity * 4 ** zoom)
+        candidates = np.flatnonzero(priority < budget)
+        tile_ids = _tile_ids(norm_xy[candidates], zoom)
+
+        # 按 (瓦片, 优先级) 排序，每块只保留优先级最高的 max_tile_points 个点
+        order = np.lexsort((priority[candidates], tile_ids))
+        candidates, tile_ids = candidates[order], tile_ids[order]
+        tiles, starts, counts = np.unique(tile_ids, return_index=True, return_counts=True)
+        rank_in_tile = np.arange(len(candidates)) - np.repeat(starts, counts)
+        keep = rank_in_tile < max_tile_points
+        cells, tile_ids = candidates[keep], tile_ids[keep]
+        offsets = np.concatenate([[0], np.cumsum(np.minimum(counts, max_tile_points))])
+
+        prefix = os.path.join(viz_dir, f"tiles_z{zoom}")
+        tiles.astype('<i8').tofile(f"{prefix}.tiles.i64")
+        offsets.astype('<i8').tofile(f"{prefix}.offsets.i64")
+        cells.astype('<i4').tofile(f"{prefix}.cells.i32")
+        coords[cells].astype('<f4').tofile(f"{prefix}.xy.f32")
+        levels.append({'zoom': zoom, 'n_tiles': int(len(tiles)), 'n_points': int(len(cells))})
+
+        # 所有细胞都已纳入且没有瓦片被截断时，该级别即为最高细节级别
+        if budget == n_obs and counts.max() <= max_tile_points:
+            break
+
+    return {
+        'bounds': [float(xmin), float(xmax), float(ymin), float(ymax)],
+        'tile_capacity': tile_capacity,
+        'max_tile_points': max_tile_points,
+        'max_zoom': levels[-1]['zoom'],
+        'levels': levels,
+    }
+
+
+def read_viewport(viz_dir: str, tiles: Dict[str, Any], zoom: int, x0: float, x1: float,
+                  y0: float, y1: float) -> bytes:
+    """
+    读取视野范围内指定缩放级别的瓦片点
+
+    Returns:
+        二进制数据: uint32 点数n，随后依次为 n 个float32 x坐标、n 个float32 y坐标、n 个int32 细胞索引
+    """
+    zoom = int(min(max(zoom, 0), tiles['max_zoom']))
+    xmin, xmax, ymin, ymax = tiles['bounds']
+    n_tiles = 2 ** zoom
+
+    def tile_range(lo, hi, vmin, vmax):
+        span = max(vmax - vmin, 1e-6)
+        first = int(np.clip(np.floor((lo - vmin) / span * n_tiles), 0, n_tiles - 1))
+        last = int(np.clip(np.floor((hi - vmin) / span * n_tiles), 0, n_tiles - 1))
+        return min(first, last), max(first, last)
+
+    tx0, tx1 = tile_range(x0, x1, xmin, xmax)
+    ty0, ty1 = tile_range(y0, y1, ymin, ymax)
+
+    prefix = os.path.join(viz_dir, f"tiles_z{zoom}")
+    tile_ids = np.fromfile(f"{prefix}.tiles.i64", dtype='<i8')
+    offsets = np.fromfile(f"{prefix}.offsets.i64", dtype='<i8')
+
+    # 同一行内视野覆盖的瓦片编号连续，在排序后的数组中对应一段连续区间
+    slices = []
+    for ty in range(ty0, ty1 + 1):
+        lo = np.searchsorted(tile_ids, ty * n_tiles + tx0, side='left')
+        hi = np.searchsorted(tile_ids, ty * n_tiles + tx1, side='right')
+        if hi > lo:
+            slices.append(slice(int(offsets[lo]), int(offsets[hi])))
+
+    if slices:
+        # 空文件无法内存映射，只在有点可读时映射
+        cells = np.memmap(f"{prefix}.cells.i32", dtype='<i4', mode='r')
+        xy = np.memmap(f"{prefix}.xy.f32", dtype='<f4', mode='r').reshape(-1, 2)
+        point_xy = np.concatenate([xy[s] for s in slices])
+        point_cells = np.concatenate([cells[s] for s in slices])
+    else:
+        point_xy = np.zeros((0, 2), dtype='<f4')
+        point_cells = np.zeros(0, dtype='<i4')
+
+    return b''.join([
+        np.array([len(point_cells)], dtype='<u4').tobytes(),
+        np.ascontiguousarray(point_xy[:, 0], dtype='<f4').tobytes(),
+        np.ascontiguousarray(point_xy[:, 1], dtype='<f4').tobytes(),
+        np.ascontiguousarray(point_cells, dtype='<i4').tobytes(),
+    ])
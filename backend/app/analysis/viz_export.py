@@ -0,0 +1,164 @@
+"""
+前端可视化数据导出: 以二进制列式格式导出UMAP坐标、元数据和基因表达
+
+每一列是一个小端序的类型化数组文件，前端可直接用 Float32Array / Int16Array 等读取，
+并只请求当前绘图需要的列。分类变量存为整数编码，类别名称记录在 manifest.json 中。
+基因表达从CSC副本按列写入一次，接口按需取出单个基因的表达向量。
+UMAP坐标另外按多分辨率瓦片组织（见 umap_tiles）。
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+from app.analysis.umap_tiles import build_umap_tiles
+
+MANIFEST_FILE = 'manifest.json'
+VIZ_DIR = 'viz'
+
+_DTYPE_SUFFIX = {
+    'float32': 'f32',
+    'int8': 'i8',
+    'int16': 'i16',
+    'int32': 'i32',
+    'int64': 'i64',
+}
+
+
+def _write_array(viz_dir: str, name: str, values: np.ndarray) -> Dict[str, Any]:
+    dtype = values.dtype.name
+    filename = f"{name}.{_DTYPE_SUFFIX[dtype]}"
+    values.astype(values.dtype.newbyteorder('<'), copy=False).tofile(os.path.join(viz_dir, filename))
+    return {'file': filename, 'dtype': dtype, 'length': int(len(values))}
+
+
+def _category_codes(series: pd.Series) -> Dict[str, Any]:
+    categorical = pd.Categorical(series.astype(str) if not isinstance(series.dtype, pd.CategoricalDtype) else series)
+    n_categories = len(categorical.categories)
+    dtype = np.int8 if n_categories < 2 ** 7 else np.int16 if n_categories < 2 ** 15 else np.int32
+    return {
+        'values': categorical.codes.astype(dtype),
+        'categories': [str(c) for c in categorical.categories],
+    }
+
+
+def top_marker_genes(adata, n_top_genes: int = 50) -> List[str]:
+    """按排名依次收集每个簇的前 n_top_genes 个marker基因（去重）"""
+    if 'rank_genes_groups' not in adata.uns:
+        return []
+    names = adata.uns['rank_genes_groups']['names']
+    top_genes = []
+    seen = set()
+    for i in range(min(n_top_genes, names.shape[0])):
+        for cluster in names.dtype.names:
+            gene = names[cluster][i]
+            if gene not in seen and gene in adata.var_names:
+                seen.add(gene)
+                top_genes.append(gene)
+    return top_genes
+
+
+def export_visualization(adata, output_path: str, n_top_genes: int = 50,
+                         genes: Optional[List[str]] = None, tile_capacity: int = 4096) -> Dict[str, Any]:
+    """
+    导出前端可视化所需的二进制列数据
+
+    Args:
+        adata: 分析完成的AnnData
+        output_path: 任务输出目录，数据写入其下的 viz/ 子目录
+        n_top_genes: 每个簇导出的marker基因数
+        genes: 额外指定导出的基因
+        tile_capacity: UMAP瓦片金字塔每块瓦片的目标点数
+
+    Returns:
+        manifest 字典
+    """
+    viz_dir = os.path.join(output_path, VIZ_DIR)
+    os.makedirs(viz_dir, exist_ok=True)
+
+    columns = {}
+    umap_coords = np.asarray(adata.obsm['X_umap'], dtype=np.float32)
+    columns['umap_x'] = dict(_write_array(viz_dir, 'umap_x', umap_coords[:, 0]), kind='numeric')
+    columns['umap_y'] = dict(_write_array(viz_dir, 'umap_y', umap_coords[:, 1]), kind='numeric')
+
+    # 多分辨率瓦片：前端按视野和缩放级别只加载需要的点
+    tiles = build_umap_tiles(umap_coords, viz_dir, tile_capacity=tile_capacity)
+
+    # 分类元数据：聚类与细胞类型
+    for name, key in [('cluster', 'leiden'), ('cell_type', 'predicted_cell_type')]:
+        if key in adata.obs:
+            encoded = _category_codes(adata.obs[key])
+            columns[name] = dict(
+                _write_array(viz_dir, name, encoded['values']),
+                kind='categorical',
+                categories=encoded['categories']
+            )
+
+    # 数值元数据：质控指标
+    for metric in ['n_genes_by_counts', 'total_counts', 'pct_counts_mt']:
+        if metric in adata.obs:
+            values = adata.obs[metric].to_numpy(dtype=np.float32)
+            columns[metric] = dict(_write_array(viz_dir, metric, values), kind='numeric')
+
+    # 基因表达：对选中的基因做一次CSC副本，按列顺序写出
+    export_genes = top_marker_genes(adata, n_top_genes)
+    for gene in genes or []:
+        if gene in adata.var_names and gene not in export_genes:
+            export_genes.append(gene)
+
+    gene_expression = None
+    if export_genes:
+        X = adata[:, export_genes].X
+        X = sp.csc_matrix(X) if sp.issparse(X) else sp.csc_matrix(np.asarray(X))
+        gene_expression = {
+            'genes': export_genes,
+            'data': _write_array(viz_dir, 'gene_expression.data', X.data.astype(np.float32)),
+            'indices': _write_array(viz_dir, 'gene_expression.indices', X.indices.astype(np.int32)),
+            'indptr': _write_array(viz_dir, 'gene_expression.indptr', X.indptr.astype(np.int64)),
+        }
+
+    manifest = {
+        'version': 1,
+        'n_cells': int(adata.n_obs),
+        'columns': columns,
+        'genes': export_genes,
+        'gene_expression': gene_expression,
+        'tiles': tiles,
+    }
+    with open(os.path.join(viz_dir, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f)
+    return manifest
+
+
+def read_manifest(viz_dir: str) -> Dict[str, Any]:
+    """读取可视化数据清单"""
+    with open(os.path.join(viz_dir, MANIFEST_FILE), 'r') as f:
+        return json.load(f)
+
+
+def read_column(viz_dir: str, manifest: Dict[str, Any], name: str) -> bytes:
+    """读取单个列的原始字节"""
+    column = manifest['columns'][name]
+    with open(os.path.join(viz_dir, column['file']), 'rb') as f:
+        return f.read()
+
+
+def read_gene(viz_dir: str, manifest: Dict[str, Any], gene: str) -> bytes:
+    """从CSC存储中取出单个基因的表达向量，返回float32稠密数组的字节"""
+    gene_expression = manifest['gene_expression']
+    col = gene_expression['genes'].index(gene)
+
+    def load(part):
+        info = gene_expression[part]
+        return np.memmap(os.path.join(viz_dir, info['file']), dtype=np.dtype(info['dtype']).newbyteorder('<'),
+                         mode='r', shape=(info['length'],))
+
+    indptr = load('indptr')
+    start, end = int(indptr[col]), int(indptr[col + 1])
+    values = np.zeros(manifest['n_cells'], dtype='<f4')
+    values[load('indices')[start:end]] = load('data')[start:end]
+    return values.tobytes()
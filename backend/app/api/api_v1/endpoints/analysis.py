@@ -1,13 +1,15 @@
 from typing import Any, List, Optional
-from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form
-from fastapi.responses import JSONResponse
+from fastapi import APIRouter, Depends, Header, HTTPException, Request, UploadFile, File, Form, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
+import json
 import uuid
 import os
 
-from app.llm.pipeline import LLMAnalysisPipeline
 from app.hpc.scheduler import HPCScheduler
 from app.api.deps import get_current_user
+from app.analysis import instrumentation, progress_log, umap_tiles, viz_export
+from app.core.config import settings
 
 router = APIRouter()
 
@@ -26,14 +28,26 @@ class TaskStatus(BaseModel):
     task_id: str
     status: str
     progress: float
+    stage: Optional[str] = None
     result: Optional[dict] = None
     error: Optional[str] = None
 
-# LLM分析流水线实例
-llm_pipeline = LLMAnalysisPipeline()
+# LLM分析流水线实例：加载模型开销很大，首次提交任务时才创建
+_llm_pipeline = None
+
+def get_llm_pipeline():
+    global _llm_pipeline
+    if _llm_pipeline is None:
+        from app.llm.pipeline import LLMAnalysisPipeline
+        _llm_pipeline = LLMAnalysisPipeline()
+    return _llm_pipeline
+
 # HPC调度器实例
 hpc_scheduler = HPCScheduler()
 
+# 任务进度事件分发：每个任务只有一个读取协程，与打开的客户端数量无关
+progress_broadcaster = progress_log.ProgressBroadcaster(poll_interval=settings.PROGRESS_POLL_INTERVAL)
+
 @router.post("/submit", response_model=AnalysisResponse)
 async def submit_analysis(
     request: AnalysisRequest,
@@ -47,7 +61,7 @@ async def submit_analysis(
         task_id = str(uuid.uuid4())
         
         # 使用LLM解析用户需求
-        analysis_plan = await llm_pipeline.parse_request(
+        analysis_plan = await get_llm_pipeline().parse_request(
             request.task_type,
             request.description,
             request.parameters
@@ -80,21 +94,168 @@ async def get_task_status(
     """
     获取任务状态
     """
+    output_path = _result_dir(current_user["username"], task_id)
     try:
-        # 从HPC系统获取作业状态
-        job_status = await hpc_scheduler.get_job_status(task_id)
+        # 优先读取作业写入的进度事件，作业未开始时才查询HPC系统
+        job_status = await hpc_scheduler.get_job_status(task_id, output_path=output_path)
         
         # 构造响应
         return TaskStatus(
             task_id=task_id,
             status=job_status["status"],
             progress=job_status["progress"],
+            stage=job_status.get("stage"),
             result=job_status.get("result"),
             error=job_status.get("error")
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"获取任务状态失败: {str(e)}")
 
+def _result_dir(username: str, task_id: str) -> str:
+    """任务结果目录（与HPC作业脚本中的 OUTPUT_PATH 一致）"""
+    # 任务ID由 submit_analysis 生成（uuid4），其他形式（如含 ../ 的路径）一律拒绝
+    try:
+        valid = str(uuid.UUID(task_id)) == task_id
+    except ValueError:
+        valid = False
+    if not valid:
+        raise HTTPException(status_code=400, detail="无效的任务ID")
+    return os.path.join(settings.RESULT_STORAGE_PATH, username, task_id)
+
+@router.get("/events/{task_id}")
+async def stream_task_events(
+    task_id: str,
+    request: Request,
+    last_event_id: Optional[str] = Header(None),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    以Server-Sent Events推送任务进度事件（阶段开始/完成/失败与总进度），任务结束后关闭连接
+
+    事件ID为进度日志中的字节偏移，重连时通过 Last-Event-ID 请求头从中断处继续
+    """
+    try:
+        offset = int(last_event_id) if last_event_id else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="无效的 Last-Event-ID")
+    path = progress_log.progress_log_path(_result_dir(current_user["username"], task_id))
+    
+    async def events():
+        subscription = progress_broadcaster.subscribe(
+            path, offset, fallback=lambda: hpc_scheduler.get_job_status(task_id)
+        )
+        try:
+            async for item in subscription:
+                if await request.is_disconnected():
+                    break
+                if item is None:
+                    yield ": keepalive\n\n"
+                    continue
+                event_offset, event = item
+                event_id = f"id: {event_offset}\n" if event_offset is not None else ""
+                yield f"{event_id}event: progress\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+        finally:
+            await subscription.aclose()
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.get("/metrics/{task_id}", response_model=dict)
+async def get_task_metrics(
+    task_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    获取任务各阶段的资源使用（墙钟时间、CPU时间、峰值内存、读写字节数）
+    """
+    try:
+        return instrumentation.read_metrics(_result_dir(current_user["username"], task_id))
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="任务指标不存在")
+
+def _load_viz_manifest(username: str, task_id: str):
+    viz_dir = os.path.join(_result_dir(username, task_id), viz_export.VIZ_DIR)
+    try:
+        return viz_dir, viz_export.read_manifest(viz_dir)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="可视化数据不存在")
+
+@router.get("/visualization/{task_id}", response_model=dict)
+async def get_visualization_manifest(
+    task_id: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    获取可视化数据清单（可用的列、类别名称和基因列表）
+    """
+    _, manifest = _load_viz_manifest(current_user["username"], task_id)
+    return manifest
+
+@router.get("/visualization/{task_id}/columns/{column}")
+async def get_visualization_column(
+    task_id: str,
+    column: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    获取单个可视化列的二进制数据（小端序类型化数组）
+    """
+    viz_dir, manifest = _load_viz_manifest(current_user["username"], task_id)
+    if column not in manifest["columns"]:
+        raise HTTPException(status_code=404, detail=f"列 {column} 不存在")
+    
+    return Response(
+        content=viz_export.read_column(viz_dir, manifest, column),
+        media_type="application/octet-stream",
+        headers={"X-Dtype": manifest["columns"][column]["dtype"]}
+    )
+
+@router.get("/visualization/{task_id}/genes/{gene}")
+async def get_visualization_gene(
+    task_id: str,
+    gene: str,
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    获取单个基因在所有细胞中的表达量（float32二进制数组）
+    """
+    viz_dir, manifest = _load_viz_manifest(current_user["username"], task_id)
+    if gene not in manifest["genes"]:
+        raise HTTPException(status_code=404, detail=f"基因 {gene} 不存在")
+    
+    return Response(
+        content=viz_export.read_gene(viz_dir, manifest, gene),
+        media_type="application/octet-stream",
+        headers={"X-Dtype": "float32"}
+    )
+
+@router.get("/visualization/{task_id}/tiles")
+async def get_visualization_tiles(
+    task_id: str,
+    zoom: int = Query(0, ge=0, description="缩放级别"),
+    x0: float = Query(..., description="视野x最小值"),
+    x1: float = Query(..., description="视野x最大值"),
+    y0: float = Query(..., description="视野y最小值"),
+    y1: float = Query(..., description="视野y最大值"),
+    current_user: dict = Depends(get_current_user)
+):
+    """
+    获取当前视野和缩放级别下的UMAP瓦片点
+
+    返回二进制数据: uint32 点数n，随后为 n 个float32 x、n 个float32 y、n 个int32 细胞索引
+    """
+    viz_dir, manifest = _load_viz_manifest(current_user["username"], task_id)
+    if not manifest.get("tiles"):
+        raise HTTPException(status_code=404, detail="UMAP瓦片数据不存在")
+    
+    return Response(
+        content=umap_tiles.read_viewport(viz_dir, manifest["tiles"], zoom, x0, x1, y0, y1),
+        media_type="application/octet-stream"
+    )
+
 @router.post("/upload_data", response_model=dict)
 async def upload_data(
     file: UploadFile = File(...),
@@ -29,6 +29,19 @@ class Settings(BaseSettings):
     SCGPT_MODEL_PATH: str = os.getenv("SCGPT_MODEL_PATH", "/models/scgpt")
     GENEFORMER_MODEL_PATH: str = os.getenv("GENEFORMER_MODEL_PATH", "/models/geneformer")
     
+    # scGPT推理: 每批细胞数与后台分词最多提前准备的读取单元数（分桶窗口或批次）
+    SCGPT_BATCH_SIZE: int = int(os.getenv("SCGPT_BATCH_SIZE", "32"))
+    SCGPT_PREFETCH_BATCHES: int = int(os.getenv("SCGPT_PREFETCH_BATCHES", "4"))
+    # 按token长度分桶的窗口细胞数，0表示按原顺序分批（每批仍只填充到本批最长细胞）
+    SCGPT_BUCKET_SIZE: int = int(os.getenv("SCGPT_BUCKET_SIZE", "2048"))
+    
+    # scGPT细胞嵌入缓存，未设置路径时保存在数据文件旁的 .scgpt_embeddings 目录
+    SCGPT_EMBEDDING_CACHE_ENABLED: bool = os.getenv("SCGPT_EMBEDDING_CACHE_ENABLED", "true").lower() == "true"
+    SCGPT_EMBEDDING_CACHE_PATH: str = os.getenv("SCGPT_EMBEDDING_CACHE_PATH", "")
+    SCGPT_EMBEDDING_CACHE_MAX_SIZE_GB: float = float(os.getenv("SCGPT_EMBEDDING_CACHE_MAX_SIZE_GB", "50"))
+    SCGPT_EMBEDDING_CACHE_MAX_AGE_DAYS: float = float(os.getenv("SCGPT_EMBEDDING_CACHE_MAX_AGE_DAYS", "30"))
+    SCGPT_EMBEDDING_DTYPE: str = os.getenv("SCGPT_EMBEDDING_DTYPE", "float16")
+    
     # ChromaDB设置
     CHROMADB_HOST: str = os.getenv("CHROMADB_HOST", "localhost")
     CHROMADB_PORT: int = int(os.getenv("CHROMADB_PORT", "8000"))
@@ -38,6 +51,10 @@ class Settings(BaseSettings):
     HPC_USERNAME: str = os.getenv("HPC_USERNAME", "user")
     HPC_PASSWORD: str = os.getenv("HPC_PASSWORD", "password")
     
+    # 任务进度推送: 进度日志检查间隔与调度器状态查询结果的缓存时间（秒）
+    PROGRESS_POLL_INTERVAL: float = float(os.getenv("PROGRESS_POLL_INTERVAL", "1.0"))
+    HPC_STATUS_CACHE_SECONDS: float = float(os.getenv("HPC_STATUS_CACHE_SECONDS", "30"))
+    
     # 日志设置
     LOKI_URL: str = os.getenv("LOKI_URL", "http://localhost:3100")
     
@@ -45,6 +62,18 @@ class Settings(BaseSettings):
     DATA_STORAGE_PATH: str = os.getenv("DATA_STORAGE_PATH", "/shared/data")
     RESULT_STORAGE_PATH: str = os.getenv("RESULT_STORAGE_PATH", "/shared/results")
     
+    # 分析阶段缓存设置
+    STAGE_CACHE_ENABLED: bool = os.getenv("STAGE_CACHE_ENABLED", "false").lower() == "true"
+    STAGE_CACHE_PATH: str = os.getenv("STAGE_CACHE_PATH", "/shared/cache/stages")
+    STAGE_CACHE_MAX_SIZE_GB: float = float(os.getenv("STAGE_CACHE_MAX_SIZE_GB", "500"))
+    STAGE_CACHE_MAX_AGE_DAYS: float = float(os.getenv("STAGE_CACHE_MAX_AGE_DAYS", "14"))
+    
+    # 近邻图后端: nndescent / hnsw / exact
+    NEIGHBORS_BACKEND: str = os.getenv("NEIGHBORS_BACKEND", "nndescent")
+    
+    # 几何抽样模式的默认抽样细胞数
+    SKETCH_SIZE: int = int(os.getenv("SKETCH_SIZE", "50000"))
+    
     class Config:
         case_sensitive = True
         env_file = ".env"
@@ -1,11 +1,17 @@
 import os
 import json
+import time
 import aiohttp
 import asyncio
 import logging
+from collections import OrderedDict
 from typing import Dict, Any, Optional
+from app.analysis import progress_log
 from app.core.config import settings
 
+# 调度器状态缓存最多保留的任务数
+_STATUS_CACHE_MAX_ENTRIES = 1024
+
 class HPCScheduler:
     """多瑙调度器客户端"""
     
@@ -16,6 +22,8 @@ class HPCScheduler:
         self.password = settings.HPC_PASSWORD
         self.token = None
         self.token_expires = 0
+        # 调度器状态查询结果缓存: task_id -> (查询时间, 状态)，按查询时间排序
+        self._status_cache: "OrderedDict[str, Any]" = OrderedDict()
     
     async def _get_auth_token(self):
         """获取身份验证令牌"""
@@ -89,6 +97,8 @@ class HPCScheduler:
 #SBATCH --gres=gpu:1
 #SBATCH --time=12:00:00
 #SBATCH --partition=gpu
+# 被抢占时重新排队；run_analysis 会从上次完成的阶段继续
+#SBATCH --requeue
 
 # 激活环境
 source activate bio-llm-env
@@ -126,16 +136,69 @@ python /shared/apps/bio-llm-platform/backend/app/analysis/run_analysis.py \\
         with open(mapping_file, 'w') as f:
             json.dump(mappings, f, indent=2)
     
-    async def get_job_status(self, task_id: str) -> Dict[str, Any]:
+    async def get_job_status(self, task_id: str, output_path: Optional[str] = None) -> Dict[str, Any]:
         """
         获取HPC作业状态
         
+        作业开始运行后会向输出目录追加进度事件，此时以最后一个事件为准；最后一个事件不是结束事件时
+        仍会查询调度器（结果缓存 HPC_STATUS_CACHE_SECONDS 秒），作业被强制终止而没有写入结束事件时
+        报告为失败。作业尚未写入事件时直接返回调度器状态。
+        
         Args:
             task_id: 任务ID
+            output_path: 任务输出目录
             
         Returns:
             作业状态字典
         """
+        if not output_path:
+            return await self._scheduler_status(task_id)
+        
+        log_path = progress_log.progress_log_path(output_path)
+        event = progress_log.last_event(log_path)
+        if event is None:
+            return await self._scheduler_status(task_id)
+        
+        if event["status"] not in progress_log.TERMINAL_STATUSES:
+            scheduler_status = await self._scheduler_status(task_id)
+            if progress_log.orphaned_event(event, scheduler_status) is not None:
+                # 作业可能在两次读取之间写完结束事件并退出
+                event = progress_log.last_event(log_path) or event
+                event = progress_log.orphaned_event(event, scheduler_status) or event
+        
+        result = None
+        if event["status"] == "completed":
+            result = {"result_url": f"/api/v1/analysis/result/{task_id}"}
+        return {
+            "status": event["status"],
+            "progress": event.get("progress", 0),
+            "stage": event.get("stage"),
+            "result": result,
+            "error": event.get("error")
+        }
+    
+    async def _scheduler_status(self, task_id: str) -> Dict[str, Any]:
+        """查询调度器中的作业状态，结果缓存 HPC_STATUS_CACHE_SECONDS 秒"""
+        now = time.monotonic()
+        cached = self._status_cache.get(task_id)
+        if cached and now - cached[0] < settings.HPC_STATUS_CACHE_SECONDS:
+            return cached[1]
+        status = await self._query_job_status(task_id)
+        
+        now = time.monotonic()
+        self._status_cache.pop(task_id, None)
+        self._status_cache[task_id] = (now, status)
+        # 淘汰过期条目（按查询时间排序，从最早的开始），并限制条目数
+        while self._status_cache:
+            queried_at, _ = next(iter(self._status_cache.values()))
+            if now - queried_at < settings.HPC_STATUS_CACHE_SECONDS and \
+                    len(self._status_cache) <= _STATUS_CACHE_MAX_ENTRIES:
+                break
+            self._status_cache.popitem(last=False)
+        return status
+    
+    async def _query_job_status(self, task_id: str) -> Dict[str, Any]:
+        """向调度器查询作业状态"""
         try:
             # 获取HPC作业ID
             mapping_file = "task_mappings.json"
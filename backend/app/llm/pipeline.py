@@ -1,14 +1,7 @@
 import os
 from typing import Dict, Any, List
 import logging
-from langchain.chains import LLMChain
-from langchain.prompts import PromptTemplate
-from langchain_huggingface import HuggingFacePipeline
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_huggingface.embeddings import HuggingFaceEmbeddings
 from app.core.config import settings
-import torch
 
 class LLMAnalysisPipeline:
     """LLMs driven analysis pipeline"""
@@ -18,6 +11,8 @@ class LLMAnalysisPipeline:
         
         # Initialize LLM
         try:
+            from langchain.prompts import PromptTemplate
+            
             self.logger.info("Initialize LLM model...")
             self.llm = self._init_llm_model()
             
@@ -62,6 +57,8 @@ class LLMAnalysisPipeline:
         """初始化LLM模型"""
         # 这里应该是实际从本地或远程加载LLM
         # 简化版本使用HuggingFacePipeline
+        import torch
+        from langchain_huggingface import HuggingFacePipeline
         from transformers import AutoModelForCausalLM, AutoTokenizer, pipeline
         
         model_path = settings.LLM_MODEL_PATH
@@ -90,6 +87,9 @@ class LLMAnalysisPipeline:
     
     def _init_vector_store(self):
         """初始化向量存储"""
+        from langchain_community.vectorstores import Chroma
+        from langchain_huggingface.embeddings import HuggingFaceEmbeddings
+        
         # 使用HuggingFace的嵌入模型
         embeddings = HuggingFaceEmbeddings(
             model_name="sentence-transformers/all-MiniLM-L6-v2"
@@ -1,4 +1,12 @@
 # models 模型包初始化文件
-from app.models.scgpt_integration import ScGPTModel
+# ScGPTModel 依赖torch，首次访问时才导入，使分词等不依赖torch的子模块可以单独使用
 
-__all__ = ["ScGPTModel"] 
\ No newline at end of file
+
+def __getattr__(name):
+    if name == "ScGPTModel":
+        from app.models.scgpt_integration import ScGPTModel
+        return ScGPTModel
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+__all__ = ["ScGPTModel"]
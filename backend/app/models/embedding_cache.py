@@ -0,0 +1,189 @@
+"""
+scGPT细胞嵌入缓存: 把每个细胞的[CLS]嵌入保存为内存映射的 .npy 数组，以表达矩阵内容哈希、模型版本和分词设置为键
+
+只修改marker字典或置信度阈值重新注释时，直接用缓存的嵌入重新打分，不再运行Transformer。
+表达矩阵、模型文件或分词设置任一变化都会得到新的键，旧条目不再命中，按最近使用时间与总大小淘汰。
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.models.tokenization import as_csr
+
+# 计算矩阵哈希时每次读取的细胞数
+_HASH_CHUNK_CELLS = 50000
+
+
+def matrix_digest(X, gene_names: Sequence[str], cell_names: Optional[Sequence[str]] = None) -> str:
+    """
+    表达矩阵的内容哈希（按块读取，backed模式下不会整体加载）
+
+    Args:
+        X: 细胞×基因表达矩阵
+        gene_names: 各列基因名
+        cell_names: 各行细胞名（细胞顺序也是内容的一部分）
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{X.shape[0]}x{X.shape[1]}\n".encode())
+    digest.update("\n".join(map(str, gene_names)).encode())
+    if cell_names is not None:
+        digest.update("\n".join(map(str, cell_names)).encode())
+    # 每行非零个数、列号与表达值分别哈希，并统一整数类型，结果与分块大小和索引类型无关
+    parts = [hashlib.sha256() for _ in range(3)]
+    for start in range(0, X.shape[0], _HASH_CHUNK_CELLS):
+        chunk = as_csr(X[start:start + _HASH_CHUNK_CELLS])
+        chunk.sort_indices()
+        for part, array in zip(parts, (np.diff(chunk.indptr).astype(np.int64, copy=False),
+                                       chunk.indices.astype(np.int64, copy=False),
+                                       chunk.data.astype(np.float32, copy=False))):
+            part.update(np.ascontiguousarray(array).tobytes())
+    for part in parts:
+        digest.update(part.digest())
+    return digest.hexdigest()
+
+
+def model_fingerprint(model_path: str) -> str:
+    """模型版本指纹：模型目录中各文件的名称、大小与修改时间（权重或词汇表更新后指纹随之变化）"""
+    digest = hashlib.sha256(os.path.abspath(model_path).encode())
+    paths = [model_path]
+    if os.path.isdir(model_path):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(model_path) for name in names)
+    for path in paths:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        digest.update(f"{os.path.relpath(path, model_path)}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+class EmbeddingCache:
+    """按内容寻址的细胞嵌入缓存，按总大小和时间淘汰"""
+
+    def __init__(self, cache_dir: str, max_size_bytes: Optional[int] = None,
+                 max_age_seconds: Optional[float] = None, dtype: str = 'float16'):
+        """
+        初始化嵌入缓存
+
+        Args:
+            cache_dir: 缓存目录
+            max_size_bytes: 缓存总大小上限，超出时淘汰最久未使用的条目
+            max_age_seconds: 条目最长保留时间（自最近一次使用起算）
+            dtype: 嵌入的存储类型，'float16' 或 'float32'
+        """
+        self.logger = logging.getLogger(__name__)
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.max_age_seconds = max_age_seconds
+        self.dtype = np.dtype(dtype)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @classmethod
+    def from_settings(cls, data_path: Optional[str] = None) -> Optional["EmbeddingCache"]:
+        """
+        根据全局设置创建缓存，未启用或缓存目录不可写时返回None
+
+        未设置 SCGPT_EMBEDDING_CACHE_PATH 时缓存保存在数据文件旁的 .scgpt_embeddings 目录中。
+        """
+        from app.core.config import settings
+
+        if not settings.SCGPT_EMBEDDING_CACHE_ENABLED:
+            return None
+        cache_dir = settings.SCGPT_EMBEDDING_CACHE_PATH
+        if not cache_dir:
+            if not data_path:
+                return None
+            cache_dir = os.path.join(os.path.dirname(os.path.abspath(data_path)), '.scgpt_embeddings')
+
+        max_size_gb = settings.SCGPT_EMBEDDING_CACHE_MAX_SIZE_GB
+        max_age_days = settings.SCGPT_EMBEDDING_CACHE_MAX_AGE_DAYS
+        try:
+            return cls(
+                cache_dir,
+                max_size_bytes=int(max_size_gb * 1024 ** 3) if max_size_gb else None,
+                max_age_seconds=max_age_days * 86400 if max_age_days else None,
+                dtype=settings.SCGPT_EMBEDDING_DTYPE
+            )
+        except OSError as e:
+            logging.getLogger(__name__).warning(f"嵌入缓存目录不可用，不使用缓存: {str(e)}")
+            return None
+
+    @staticmethod
+    def key(data_digest: str, model_digest: str, tokenization: Dict[str, Any]) -> str:
+        """由表达矩阵哈希、模型指纹与分词设置计算缓存键"""
+        payload = json.dumps(tokenization, sort_keys=True, default=str)
+        return hashlib.sha256(f"{data_digest}\n{model_digest}\n{payload}".encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def load(self, key: str) -> Optional[np.ndarray]:
+        """以只读内存映射方式加载嵌入，并刷新条目的使用时间；不存在时返回None"""
+        path = self._entry_path(key)
+        try:
+            embeddings = np.load(path, mmap_mode='r')
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            self.logger.warning(f"嵌入缓存条目损坏，将重新计算: {str(e)}")
+            return None
+        self.logger.info(f"命中嵌入缓存: {path}")
+        return embeddings
+
+    @contextmanager
+    def writer(self, key: str, shape: Tuple[int, int]):
+        """
+        写入新条目：产出临时文件上的内存映射数组，正常退出时原子替换为正式条目并执行淘汰，
+        出错时删除临时文件
+        """
+        path = self._entry_path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        try:
+            embeddings = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.dtype, shape=shape)
+            yield embeddings
+            embeddings.flush()
+            del embeddings
+            os.replace(tmp_path, path)
+            self.logger.info(f"细胞嵌入已写入缓存: {path}")
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        # 刚写入的条目即使单独超过大小上限也保留，供调用方读取
+        self.evict(keep=key)
+
+    def evict(self, keep: Optional[str] = None):
+        """删除过期条目，并按最近使用时间淘汰直到总大小不超过上限；keep 指定的条目不淘汰"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npy') or '.tmp' in name:
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        now = time.time()
+        entries.sort()
+        total_size = sum(size for _, size, _ in entries)
+        keep_path = self._entry_path(keep) if keep is not None else None
+        for mtime, size, path in entries:
+            expired = self.max_age_seconds is not None and now - mtime > self.max_age_seconds
+            oversized = self.max_size_bytes is not None and total_size > self.max_size_bytes
+            if not (expired or oversized) or path == keep_path:
+                continue
+            try:
+                os.remove(path)
+                total_size -= size
+                self.logger.info(f"淘汰嵌入缓存: {path}")
+            except FileNotFoundError:
+                pass
@@ -4,10 +4,22 @@ scGPT模型集成模块: 用于细胞类型注释和生物数据分析
 
 import os
 import logging
+import threading
+from collections import OrderedDict
 import torch
 import numpy as np
 import pandas as pd
-from typing import List, Dict, Any, Optional, Union, Tuple
+from typing import List, Dict, Any, Mapping, Optional, Sequence, Union, Tuple
+
+from app.core.config import settings
+from app.models.embedding_cache import EmbeddingCache, matrix_digest, model_fingerprint
+from app.models.tokenization import TOKENIZATION_VERSION, iter_token_batches, vocab_lookup
+
+# 最多缓存的marker集合中心矩阵数
+_MAX_CENTROID_SETS = 16
+
+# 细胞类型marker：基因列表（权重相同），或 {基因: 权重}
+MarkerGenes = Union[Sequence[str], Mapping[str, float]]
 
 # 假设scGPT已经安装并可以导入
 try:
@@ -18,6 +30,25 @@ try:
 except ImportError:
     logging.warning("scGPT模块未安装，某些功能可能不可用")
 
+# 进程内已加载的模型：批量模式下多个数据集共享同一个模型，只加载一次
+_MODEL_CACHE: Dict[Tuple[str, str], "ScGPTModel"] = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+def get_scgpt_model(model_path: str, device: str = None) -> "ScGPTModel":
+    """
+    获取scGPT模型，同一模型路径与设备在进程内只加载一次
+    
+    Args:
+        model_path: 模型路径
+        device: 设备（'cuda'或'cpu'），默认自动选择
+    """
+    key = (os.path.abspath(model_path), device or "auto")
+    # 加载期间持有锁：并发请求同一模型时等待第一次加载完成，而不是重复加载
+    with _MODEL_CACHE_LOCK:
+        if key not in _MODEL_CACHE:
+            _MODEL_CACHE[key] = ScGPTModel(model_path, device=device)
+        return _MODEL_CACHE[key]
+
 class ScGPTModel:
     """scGPT模型封装类"""
     
@@ -56,115 +87,234 @@ class ScGPTModel:
             gene_vocab = GeneVocab.from_file(vocab_file)
             self.tokenizer = TokenizerForSC(gene_vocab)
             
+            # 各marker集合的归一化细胞类型中心矩阵，按最近使用顺序排列
+            self._centroid_cache: "OrderedDict[Tuple, torch.Tensor]" = OrderedDict()
+            # 模型版本指纹（嵌入缓存键的一部分），首次使用缓存时计算
+            self._fingerprint: Optional[str] = None
+            
             self.logger.info("scGPT模型加载成功")
         except Exception as e:
             self.logger.error(f"scGPT模型加载失败: {str(e)}")
             raise e
     
-    def annotate_cell_types(self, gene_expr_matrix: pd.DataFrame, cell_type_markers: Dict[str, List[str]], 
-                           confidence_threshold: float = 0.7) -> Tuple[np.ndarray, np.ndarray]:
+    def _expression_source(self, data, gene_names: Optional[Sequence[str]] = None):
+        """
+        统一输入格式，返回 (可按行切片的表达矩阵, 各列基因名, 各行细胞名或None)
+        
+        支持AnnData（含backed模式）、scipy稀疏矩阵/numpy数组（需提供gene_names）以及DataFrame。
+        """
+        if hasattr(data, 'var_names') and hasattr(data, 'X'):
+            return data.X, list(data.var_names), list(data.obs_names)
+        if isinstance(data, pd.DataFrame):
+            return data.to_numpy(), list(data.columns), list(data.index)
+        if gene_names is None:
+            raise ValueError("使用矩阵输入时必须提供gene_names")
+        return (data.tocsr() if hasattr(data, 'tocsr') else data), list(gene_names), None
+    
+    def _cls_embeddings(self, tokens: Dict[str, torch.Tensor]) -> torch.Tensor:
+        """运行模型，返回每个细胞[CLS]令牌的最后一层输出"""
+        outputs = self.model(
+            input_ids=tokens["input_ids"],
+            attention_mask=tokens["attention_mask"],
+            output_hidden_states=True
+        )
+        return outputs.hidden_states[-1][:, 0, :]
+    
+    def cell_embeddings(self, data, gene_names: Optional[Sequence[str]] = None, batch_size: Optional[int] = None,
+                        cache: Optional[EmbeddingCache] = None, max_length: int = 512) -> np.ndarray:
+        """
+        计算每个细胞的[CLS]嵌入
+        
+        给定cache时以表达矩阵内容哈希、模型版本与分词设置为键查找缓存：命中时直接返回内存映射数组，
+        否则逐批写入新的缓存条目后返回。
+        
+        Returns:
+            (细胞数, 嵌入维度) 的数组
+        """
+        X, gene_names, cell_names = self._expression_source(data, gene_names)
+        vocab_ids = vocab_lookup(gene_names, self.tokenizer.vocab)
+        embedding_dim = getattr(self.config, 'hidden_size', None) or self.model.get_input_embeddings().embedding_dim
+        shape = (X.shape[0], embedding_dim)
+        
+        def embed_into(out: np.ndarray):
+            with torch.no_grad():
+                for rows, tokens in self._token_batches(X, vocab_ids, batch_size, max_length=max_length):
+                    out[rows] = self._cls_embeddings(tokens).float().cpu().numpy()
+        
+        if cache is None:
+            embeddings = np.empty(shape, dtype=np.float32)
+            embed_into(embeddings)
+            return embeddings
+        
+        if self._fingerprint is None:
+            self._fingerprint = model_fingerprint(self.model_path)
+        key = cache.key(
+            matrix_digest(X, gene_names, cell_names), self._fingerprint,
+            {"version": TOKENIZATION_VERSION, "max_length": max_length, "output": "cls_last_layer"}
+        )
+        embeddings = cache.load(key)
+        if embeddings is not None and embeddings.shape == shape:
+            return embeddings
+        
+        self.logger.info(f"计算 {shape[0]} 个细胞的嵌入并写入缓存")
+        with cache.writer(key, shape) as out:
+            embed_into(out)
+        # 条目可能已被其他进程淘汰，此时直接使用刚计算的结果（内存映射在文件删除后仍然有效）
+        embeddings = cache.load(key)
+        return embeddings if embeddings is not None else out
+    
+    def _token_batches(self, X, vocab_ids: np.ndarray, batch_size: Optional[int] = None,
+                       leading_ids: Optional[List[int]] = None, max_length: int = 512):
+        """
+        流式读取与分词：后台线程提前准备有限数量的批次，与推理重叠进行；
+        细胞按token长度分桶（SCGPT_BUCKET_SIZE），每批只填充到本批最长细胞的长度
+        
+        Yields:
+            (本批细胞的行号, 设备上的张量字典)
+        """
+        batches = iter_token_batches(
+            X, vocab_ids, self.tokenizer.cls_token_id, self.tokenizer.pad_token_id,
+            batch_size=batch_size or settings.SCGPT_BATCH_SIZE, max_length=max_length,
+            leading_ids=leading_ids, bucket_size=settings.SCGPT_BUCKET_SIZE or None,
+            prefetch=settings.SCGPT_PREFETCH_BATCHES
+        )
+        non_blocking = self.device.type == 'cuda'
+        for rows, tokens in batches:
+            yield rows, {
+                key: torch.from_numpy(value).to(self.device, non_blocking=non_blocking)
+                for key, value in tokens.items()
+            }
+    
+    def marker_centroids(self, cell_type_markers: Dict[str, MarkerGenes]) -> torch.Tensor:
+        """
+        细胞类型中心矩阵：每个细胞类型的marker基因输入嵌入的加权平均向量，按行L2归一化
+        
+        marker为基因列表时权重相同；为 {基因: 权重} 时按权重加权（与 MarkerScorer 一致，
+        权重按词汇表中存在的marker归一化）。同一marker集合只计算一次，缓存最近使用的
+        _MAX_CENTROID_SETS 个集合；没有任何marker在词汇表中的细胞类型为零向量（相似度为0）。
+        
+        Returns:
+            (细胞类型数, 嵌入维度) 的张量
+        """
+        marker_weights = {
+            cell_type: dict(markers) if isinstance(markers, Mapping) else dict.fromkeys(markers, 1.0)
+            for cell_type, markers in cell_type_markers.items()
+        }
+        key = tuple((cell_type, tuple(weights.items())) for cell_type, weights in marker_weights.items())
+        centroids = self._centroid_cache.get(key)
+        if centroids is not None:
+            self._centroid_cache.move_to_end(key)
+            return centroids
+        
+        embedding = self.model.get_input_embeddings()
+        rows = []
+        with torch.no_grad():
+            for weights in marker_weights.values():
+                present = [(gene, weight) for gene, weight in weights.items() if gene in self.tokenizer.vocab]
+                total = sum(weight for _, weight in present)
+                if not present or total == 0:
+                    rows.append(torch.zeros(embedding.embedding_dim, dtype=embedding.weight.dtype, device=self.device))
+                    continue
+                marker_tokens = torch.tensor(
+                    [self.tokenizer.convert_tokens_to_ids(gene) for gene, _ in present], device=self.device
+                )
+                marker_weight = torch.tensor(
+                    [weight / total for _, weight in present], dtype=embedding.weight.dtype, device=self.device
+                )
+                rows.append(marker_weight @ embedding(marker_tokens))
+            centroids = torch.nn.functional.normalize(torch.stack(rows), dim=1)
+        
+        self._centroid_cache[key] = centroids
+        if len(self._centroid_cache) > _MAX_CENTROID_SETS:
+            self._centroid_cache.popitem(last=False)
+        return centroids
+    
+    def annotate_cell_types(self, data, cell_type_markers: Dict[str, MarkerGenes],
+                           confidence_threshold: float = 0.7, gene_names: Optional[Sequence[str]] = None,
+                           batch_size: Optional[int] = None, output_dir: Optional[str] = None,
+                           embedding_cache: Optional[EmbeddingCache] = None) -> Tuple[pd.Categorical, np.ndarray]:
         """
         对单细胞数据进行细胞类型注释
         
         Args:
-            gene_expr_matrix: 基因表达矩阵 (cells x genes)
-            cell_type_markers: 细胞类型marker基因字典
+            data: 表达数据 (cells x genes)，AnnData、稀疏矩阵或DataFrame
+            cell_type_markers: 细胞类型marker基因字典，值为基因列表或 {基因: 权重}
             confidence_threshold: 置信度阈值
+            gene_names: 矩阵输入时各列的基因名
+            batch_size: 每批推理的细胞数，默认为 SCGPT_BATCH_SIZE
+            output_dir: 给定时逐批把各细胞类型的概率、预测类型编码与置信度写入该目录下的
+                .npy文件（内存映射），内存占用与细胞数无关
+            embedding_cache: 细胞嵌入缓存；给定时细胞嵌入只计算一次，之后更换marker或阈值
+                只需对缓存的嵌入重新打分
             
         Returns:
-            预测的细胞类型和置信度
+            预测的细胞类型（类别为各细胞类型与"Unknown"）和置信度
         """
         try:
             self.logger.info("开始细胞类型注释")
             
-            # 将DataFrame转换为模型输入
-            input_ids_list = []
-            attention_mask_list = []
+            # 直接从稀疏矩阵按批分词，不构造稠密矩阵
+            X, gene_names, _ = self._expression_source(data, gene_names)
+            n_cells = X.shape[0]
+            cell_types = list(cell_type_markers.keys())
+            centroids = self.marker_centroids(cell_type_markers)
+            unknown_code = cell_types.index("Unknown") if "Unknown" in cell_types else len(cell_types)
             
-            for idx, cell_vec in gene_expr_matrix.iterrows():
-                # 选择高表达基因作为输入
-                expr_genes = cell_vec[cell_vec > 0].index.tolist()
-                
-                # 标记化处理
-                tokenized = self.tokenizer(
-                    expr_genes,
-                    padding="max_length",
-                    truncation=True,
-                    max_length=512,
-                    return_tensors="pt"
+            # 结果逐批写入（output_dir给定时为磁盘上的内存映射数组）
+            if output_dir:
+                os.makedirs(output_dir, exist_ok=True)
+                allocate = lambda name, shape, dtype: np.lib.format.open_memmap(
+                    os.path.join(output_dir, f"{name}.npy"), mode='w+', dtype=dtype, shape=shape
                 )
-                
-                input_ids_list.append(tokenized["input_ids"])
-                attention_mask_list.append(tokenized["attention_mask"])
+            else:
+                allocate = lambda name, shape, dtype: np.empty(shape, dtype=dtype)
+            all_probs = allocate("cell_type_probs", (n_cells, len(cell_types)), np.float32)
+            codes = allocate("cell_type_codes", (n_cells,), np.int16)
+            predicted_probs = allocate("cell_type_scores", (n_cells,), np.float32)
             
-            # 批量处理
-            all_input_ids = torch.cat(input_ids_list, dim=0).to(self.device)
-            all_attention_mask = torch.cat(attention_mask_list, dim=0).to(self.device)
+            # 使用[CLS]令牌的输出表示每个细胞：有缓存时按块读取缓存的嵌入，否则边推理边打分
+            if embedding_cache is not None:
+                cached = self.cell_embeddings(data, gene_names, batch_size, cache=embedding_cache)
+                chunk = 8192
+                embedding_batches = (
+                    (slice(i, i + chunk),
+                     torch.from_numpy(np.asarray(cached[i:i + chunk])).to(self.device, dtype=centroids.dtype))
+                    for i in range(0, n_cells, chunk)
+                )
+            else:
+                vocab_ids = vocab_lookup(gene_names, self.tokenizer.vocab)
+                embedding_batches = (
+                    (rows, self._cls_embeddings(tokens))
+                    for rows, tokens in self._token_batches(X, vocab_ids, batch_size)
+                )
             
             # 批量推理
-            cell_type_probs = []
-            cell_types = list(cell_type_markers.keys())
-            
             with torch.no_grad():
-                batch_size = 32
-                for i in range(0, len(all_input_ids), batch_size):
-                    batch_input_ids = all_input_ids[i:i+batch_size]
-                    batch_attention_mask = all_attention_mask[i:i+batch_size]
+                for rows, cell_embeddings in embedding_batches:
                     
-                    # 获取模型输出向量
-                    outputs = self.model(
-                        input_ids=batch_input_ids,
-                        attention_mask=batch_attention_mask,
-                        output_hidden_states=True
-                    )
+                    # 与所有细胞类型中心的余弦相似度：归一化后一次矩阵乘法
+                    similarity = torch.nn.functional.normalize(cell_embeddings, dim=1) @ centroids.T
                     
-                    # 使用[CLS]令牌的输出表示每个细胞
-                    cell_embeddings = outputs.hidden_states[-1][:, 0, :]
-                    
-                    # 计算与每个细胞类型的相似度
-                    batch_probs = []
-                    for cell_type, markers in cell_type_markers.items():
-                        # 将marker基因转换为嵌入向量
-                        marker_tokens = [self.tokenizer.convert_tokens_to_ids(marker) for marker in markers if marker in self.tokenizer.vocab]
-                        
-                        if len(marker_tokens) == 0:
-                            # 如果没有找到marker基因，则跳过
-                            batch_probs.append(torch.zeros(len(batch_input_ids), 1).to(self.device))
-                            continue
-                            
-                        # 查询模型的嵌入层
-                        marker_embeddings = self.model.get_input_embeddings()(torch.tensor(marker_tokens).to(self.device))
-                        
-                        # 计算平均marker嵌入
-                        marker_centroid = marker_embeddings.mean(dim=0).unsqueeze(0)
-                        
-                        # 计算余弦相似度
-                        similarity = torch.nn.functional.cosine_similarity(
-                            cell_embeddings, 
-                            marker_centroid.expand(cell_embeddings.size(0), -1),
-                            dim=1
-                        )
-                        
-                        batch_probs.append(similarity.unsqueeze(1))
+                    # Softmax归一化获得概率
+                    norm_probs = torch.softmax(similarity.float(), dim=1)
+                    batch_scores, batch_indices = norm_probs.max(dim=1)
+                    batch_scores = batch_scores.cpu().numpy()
                     
-                    # 连接所有细胞类型的概率
-                    batch_cell_type_probs = torch.cat(batch_probs, dim=1)
-                    cell_type_probs.append(batch_cell_type_probs.cpu().numpy())
-            
-            # 合并所有批次的结果
-            all_probs = np.concatenate(cell_type_probs, axis=0)
-            
-            # Softmax归一化获得概率
-            exp_probs = np.exp(all_probs)
-            norm_probs = exp_probs / np.sum(exp_probs, axis=1, keepdims=True)
+                    # 获取最可能的细胞类型和置信度，低于阈值的记为Unknown；按行号写回原始细胞顺序
+                    all_probs[rows] = norm_probs.cpu().numpy()
+                    predicted_probs[rows] = batch_scores
+                    codes[rows] = np.where(
+                        batch_scores >= confidence_threshold, batch_indices.cpu().numpy(), unknown_code
+                    )
             
-            # 获取最可能的细胞类型和置信度
-            predicted_indices = np.argmax(norm_probs, axis=1)
-            predicted_probs = np.max(norm_probs, axis=1)
+            if output_dir:
+                for array in (all_probs, codes, predicted_probs):
+                    array.flush()
             
             # 转换为细胞类型名称
-            predicted_cell_types = np.array([cell_types[i] if predicted_probs[idx] >= confidence_threshold else "Unknown" 
-                                            for idx, i in enumerate(predicted_indices)])
+            predicted_cell_types = pd.Categorical.from_codes(
+                codes, categories=cell_types + (["Unknown"] if unknown_code == len(cell_types) else [])
+            )
             
             self.logger.info(f"细胞类型注释完成, 标注了 {len(predicted_cell_types)} 个细胞")
             return predicted_cell_types, predicted_probs
@@ -173,15 +323,18 @@ class ScGPTModel:
             self.logger.error(f"细胞类型注释失败: {str(e)}")
             raise e
     
-    def analyze_gene_perturbation(self, gene_expr_matrix: pd.DataFrame, target_genes: List[str],
-                                 n_top_responses: int = 100) -> Dict[str, Any]:
+    def analyze_gene_perturbation(self, data, target_genes: List[str], n_top_responses: int = 100,
+                                 gene_names: Optional[Sequence[str]] = None,
+                                 batch_size: Optional[int] = None) -> Dict[str, Any]:
         """
         分析基因扰动效应
         
         Args:
-            gene_expr_matrix: 基因表达矩阵
+            data: 表达数据 (cells x genes)，AnnData、稀疏矩阵或DataFrame
             target_genes: 目标扰动基因列表
             n_top_responses: 返回的顶部响应基因数量
+            gene_names: 矩阵输入时各列的基因名
+            batch_size: 每批推理的细胞数，默认为 SCGPT_BATCH_SIZE
             
         Returns:
             扰动分析结果字典
@@ -190,86 +343,56 @@ class ScGPTModel:
             self.logger.info(f"开始基因扰动分析，目标基因: {target_genes}")
             
             # 将目标基因转换为模型词汇表ID
-            target_ids = []
+            targets = []
             for gene in target_genes:
                 if gene in self.tokenizer.vocab:
-                    target_ids.append(self.tokenizer.convert_tokens_to_ids(gene))
+                    targets.append((gene, self.tokenizer.convert_tokens_to_ids(gene)))
                 else:
                     self.logger.warning(f"基因 {gene} 不在词汇表中，将被忽略")
             
-            if not target_ids:
+            if not targets:
                 raise ValueError("所有目标基因都不在模型词汇表中")
             
-            # 为每个细胞准备输入
+            X, gene_names, _ = self._expression_source(data, gene_names)
+            vocab_ids = vocab_lookup(gene_names, self.tokenizer.vocab)
+            n_cells = X.shape[0]
             results = {}
             
-            # 准备待掩码的目标基因输入
             with torch.no_grad():
                 # 对每个目标基因进行分析
-                for target_gene, target_id in zip(target_genes, target_ids):
+                for target_gene, target_id in targets:
                     self.logger.info(f"分析基因 {target_gene} 的扰动效应")
                     
-                    # 获取所有基因的响应分数
-                    all_gene_scores = []
-                    
-                    for idx, cell_vec in gene_expr_matrix.iterrows():
-                        # 选择高表达基因作为输入
-                        expr_genes = cell_vec[cell_vec > 0].index.tolist()
-                        
-                        # 如果目标基因不在表达基因中，则添加它
-                        if target_gene not in expr_genes:
-                            expr_genes.append(target_gene)
-                        
-                        # 标记化处理
-                        tokenized = self.tokenizer(
-                            expr_genes,
-                            padding="max_length",
-                            truncation=True,
-                            max_length=512,
-                            return_tensors="pt"
-                        )
-                        
-                        # 找到目标基因的位置
-                        target_positions = (tokenized["input_ids"] == target_id).nonzero(as_tuple=True)[1]
-                        
-                        if len(target_positions) == 0:
-                            continue
-                            
-                        # 创建mask输入
-                        masked_input_ids = tokenized["input_ids"].clone()
-                        masked_input_ids[0, target_positions[0]] = self.tokenizer.mask_token_id
+                    # 目标基因固定放在[CLS]之后并被掩码，不会因截断而丢失
+                    score_sum = None
+                    for _, tokens in self._token_batches(X, vocab_ids, batch_size, leading_ids=[target_id]):
+                        tokens["input_ids"][:, 1] = self.tokenizer.mask_token_id
                         
                         # 运行模型进行预测
                         outputs = self.model(
-                            input_ids=masked_input_ids.to(self.device),
-                            attention_mask=tokenized["attention_mask"].to(self.device)
+                            input_ids=tokens["input_ids"],
+                            attention_mask=tokens["attention_mask"]
                         )
                         
-                        # 获取掩码位置的预测
-                        mask_pos = target_positions[0]
-                        logits = outputs.logits[0, mask_pos, :]
-                        probs = torch.softmax(logits, dim=0).cpu().numpy()
-                        
-                        # 保存所有基因的概率分数
-                        all_gene_scores.append(probs)
+                        # 获取掩码位置的预测，累加所有基因的概率分数
+                        probs = torch.softmax(outputs.logits[:, 1, :], dim=-1).sum(dim=0)
+                        score_sum = probs if score_sum is None else score_sum + probs
                     
-                    if not all_gene_scores:
+                    if score_sum is None:
                         self.logger.warning(f"没有找到基因 {target_gene} 的扰动效应数据")
                         continue
                         
                     # 计算平均分数
-                    avg_scores = np.mean(all_gene_scores, axis=0)
+                    avg_scores = (score_sum / n_cells).cpu().numpy()
                     
-                    # 获取前N个响应基因
-                    top_indices = np.argsort(-avg_scores)[:n_top_responses]
-                    top_genes = [self.tokenizer.convert_ids_to_tokens(idx) for idx in top_indices 
-                                if self.tokenizer.convert_ids_to_tokens(idx) != target_gene]
-                    top_scores = [float(avg_scores[idx]) for idx in top_indices]
+                    # 获取前N个响应基因（排除目标基因本身）
+                    top_indices = [idx for idx in np.argsort(-avg_scores)[:n_top_responses + 1] if idx != target_id]
+                    top_indices = top_indices[:n_top_responses]
                     
                     # 组装结果
                     results[target_gene] = {
-                        "top_response_genes": top_genes[:n_top_responses],
-                        "response_scores": top_scores[:n_top_responses],
+                        "top_response_genes": [self.tokenizer.convert_ids_to_tokens(int(idx)) for idx in top_indices],
+                        "response_scores": [float(avg_scores[idx]) for idx in top_indices],
                     }
             
             self.logger.info("基因扰动分析完成")
@@ -277,4 +400,4 @@ class ScGPTModel:
         
         except Exception as e:
             self.logger.error(f"基因扰动分析失败: {str(e)}")
-            raise e 
\ No newline at end of file
+            raise e
@@ -0,0 +1,171 @@
+"""
+单细胞表达矩阵的向量化分词: 直接从CSR矩阵的 indptr/indices/data 构造整批细胞的token ID、表达值与注意力掩码
+
+不构造稠密的 细胞×基因 矩阵，也不逐个细胞调用分词器：基因名到词汇表ID的映射预先计算为查找数组，
+每批细胞只做一次排序与一次散射赋值。每个细胞的序列为 [CLS] + 按表达量降序排列的表达基因，
+超出最大长度时保留表达量最高的基因。
+
+iter_token_batches 在后台线程中读取与分词，最多提前准备固定数量的批次，推理与分词重叠进行，
+内存占用与细胞总数无关。每批只填充到本批最长细胞的长度；可选按token长度分桶，
+使长度相近的细胞组成同一批，减少花在填充位置上的注意力计算。
+"""
+
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, Mapping, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import scipy.sparse as sp
+
+# 分词规则（基因排序、截断方式）变化时递增，使依赖分词结果的缓存失效
+TOKENIZATION_VERSION = 1
+
+
+def vocab_lookup(gene_names: Sequence[str], vocab: Mapping[str, int]) -> np.ndarray:
+    """基因名到词汇表ID的查找数组，不在词汇表中的基因为-1"""
+    return np.fromiter((vocab.get(gene, -1) for gene in gene_names), dtype=np.int64, count=len(gene_names))
+
+
+def as_csr(X) -> sp.csr_matrix:
+    """把一批细胞的表达矩阵（稀疏、稠密或backed数据集的切片）转换为CSR"""
+    if sp.issparse(X):
+        return X.tocsr()
+    return sp.csr_matrix(np.asarray(X))
+
+
+def _expressed_tokens(X: sp.csr_matrix, vocab_ids: np.ndarray):
+    """CSR中表达量大于0且在词汇表中的元素：(行号, 词汇表ID, 表达值)"""
+    rows = np.repeat(np.arange(X.shape[0]), np.diff(X.indptr))
+    ids = vocab_ids[X.indices]
+    values = X.data.astype(np.float32, copy=False)
+    keep = (ids >= 0) & (values > 0)
+    return rows[keep], ids[keep], values[keep]
+
+
+def token_lengths(X: sp.csr_matrix, vocab_ids: np.ndarray, max_length: int = 512,
+                  leading_ids: Optional[Sequence[int]] = None) -> np.ndarray:
+    """每个细胞分词后的有效长度（含[CLS]与固定基因，不超过max_length）"""
+    X = as_csr(X)
+    rows, ids, _ = _expressed_tokens(X, vocab_ids)
+    n_leading = 1
+    if leading_ids is not None and len(leading_ids):
+        rows = rows[~np.isin(ids, leading_ids)]
+        n_leading += len(leading_ids)
+    return np.minimum(np.bincount(rows, minlength=X.shape[0]) + n_leading, max_length)
+
+
+def tokenize_csr(X: sp.csr_matrix, vocab_ids: np.ndarray, cls_id: int, pad_id: int, max_length: int = 512,
+                 leading_ids: Optional[Sequence[int]] = None, dynamic_padding: bool = False) -> Dict[str, np.ndarray]:
+    """
+    对一批细胞分词
+
+    Args:
+        X: 细胞×基因CSR表达矩阵
+        vocab_ids: 每一列基因的词汇表ID（vocab_lookup的结果），-1表示忽略该基因
+        cls_id: 序列开头的[CLS] token ID
+        pad_id: 填充token ID
+        max_length: 最大序列长度（含[CLS]）
+        leading_ids: 固定放在[CLS]之后的基因ID（如待掩码的扰动基因），不论是否表达；
+            这些基因不会在表达基因中重复出现
+        dynamic_padding: 只填充到本批最长细胞的长度，而不是max_length
+
+    Returns:
+        input_ids（int64）、values（float32，表达值，[CLS]与填充为0）与 attention_mask（int64），
+        形状均为 (细胞数, 序列长度)
+    """
+    X = as_csr(X)
+    n_cells = X.shape[0]
+    leading_ids = np.asarray(leading_ids if leading_ids is not None else [], dtype=np.int64)
+    n_leading = 1 + len(leading_ids)
+    if n_leading > max_length:
+        raise ValueError(f"max_length={max_length} 放不下 [CLS] 与 {len(leading_ids)} 个固定基因")
+
+    rows, ids, values = _expressed_tokens(X, vocab_ids)
+    leading_values = np.zeros((n_cells, len(leading_ids)), dtype=np.float32)
+    if len(leading_ids):
+        for j, leading_id in enumerate(leading_ids):
+            hit = ids == leading_id
+            leading_values[rows[hit], j] = values[hit]
+        keep = ~np.isin(ids, leading_ids)
+        rows, ids, values = rows[keep], ids[keep], values[keep]
+
+    # 细胞内按表达量降序（rows本身有序，lexsort以最后一个键为主键）
+    order = np.lexsort((-values, rows))
+    rows, ids, values = rows[order], ids[order], values[order]
+    counts = np.bincount(rows, minlength=n_cells)
+    row_starts = np.zeros(n_cells + 1, dtype=np.int64)
+    np.cumsum(counts, out=row_starts[1:])
+    positions = np.arange(len(rows)) - row_starts[rows] + n_leading
+    keep = positions < max_length
+    rows, positions = rows[keep], positions[keep]
+
+    length = max_length
+    if dynamic_padding:
+        length = int(min(max_length, n_leading + (counts.max() if n_cells else 0)))
+
+    input_ids = np.full((n_cells, length), pad_id, dtype=np.int64)
+    token_values = np.zeros((n_cells, length), dtype=np.float32)
+    attention_mask = np.zeros((n_cells, length), dtype=np.int64)
+    input_ids[:, 0] = cls_id
+    attention_mask[:, :n_leading] = 1
+    input_ids[:, 1:n_leading] = leading_ids
+    token_values[:, 1:n_leading] = leading_values
+
+    input_ids[rows, positions] = ids[keep]
+    token_values[rows, positions] = values[keep]
+    attention_mask[rows, positions] = 1
+    return {'input_ids': input_ids, 'values': token_values, 'attention_mask': attention_mask}
+
+
+def iter_token_batches(X, vocab_ids: np.ndarray, cls_id: int, pad_id: int, batch_size: int = 32,
+                       max_length: int = 512, leading_ids: Optional[Sequence[int]] = None,
+                       bucket_size: Optional[int] = None, prefetch: int = 4,
+                       num_workers: int = 1) -> Iterator[Tuple[Union[slice, np.ndarray], Dict[str, np.ndarray]]]:
+    """
+    按批读取并分词，每批只填充到本批最长细胞的长度；后台线程最多提前准备prefetch个读取单元
+
+    Args:
+        X: 可按行切片的细胞×基因表达矩阵（CSR、numpy数组或backed AnnData的X）
+        vocab_ids, cls_id, pad_id, max_length, leading_ids: 见 tokenize_csr
+        batch_size: 每批细胞数
+        bucket_size: 按长度分桶的窗口细胞数。给定时每次读取一个窗口，窗口内按token长度排序后
+            再切分批次，长度相近的细胞在同一批中，填充最少；为None时按原顺序切分批次
+        prefetch: 最多提前准备的读取单元数（窗口或批次，决定内存上限）
+        num_workers: 分词线程数
+
+    Yields:
+        (本批细胞在X中的行号, tokenize_csr的结果)；行号为slice（按原顺序切分时）或整数数组，
+        调用方用它把结果写回原始细胞顺序
+    """
+    n_cells = X.shape[0]
+    window = max(bucket_size or batch_size, batch_size)
+
+    def work(start: int):
+        end = min(start + window, n_cells)
+        X_window = as_csr(X[start:end])
+        tokenize = lambda part: tokenize_csr(
+            part, vocab_ids, cls_id, pad_id, max_length=max_length, leading_ids=leading_ids, dynamic_padding=True
+        )
+        if not bucket_size:
+            return [(slice(start, end), tokenize(X_window))]
+        order = np.argsort(token_lengths(X_window, vocab_ids, max_length, leading_ids), kind='stable')
+        return [
+            (start + order[i:i + batch_size], tokenize(X_window[order[i:i + batch_size]]))
+            for i in range(0, len(order), batch_size)
+        ]
+
+    starts = iter(range(0, n_cells, window))
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix='tokenize') as pool:
+        pending = deque(pool.submit(work, start) for start in itertools.islice(starts, max(prefetch, 1)))
+        try:
+            while pending:
+                batches = pending.popleft().result()
+                start = next(starts, None)
+                if start is not None:
+                    pending.append(pool.submit(work, start))
+                yield from batches
+        finally:
+            # 提前结束迭代时不再准备剩余的批次
+            for future in pending:
+                future.cancel()
@@ -0,0 +1,102 @@
+"""
+近邻图后端基准: 在合成数据上比较各ANN后端相对精确kNN的召回率与加速比
+
+用法:
+    python benchmarks/bench_neighbors.py --n-cells 200000 --backends nndescent hnsw
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.analysis.neighbors import NEIGHBOR_BACKENDS, knn
+
+
+def synthetic_embedding(n_cells: int, n_dims: int, n_clusters: int, seed: int = 0) -> np.ndarray:
+    """生成类似PCA表示的高斯混合数据：各簇中心不同，方差随维数递减"""
+    rng = np.random.default_rng(seed)
+    scales = np.linspace(3.0, 0.3, n_dims)
+    centers = rng.normal(scale=4.0, size=(n_clusters, n_dims)) * scales
+    labels = rng.integers(n_clusters, size=n_cells)
+    X = centers[labels] + rng.normal(size=(n_cells, n_dims)) * scales
+    return X.astype(np.float32)
+
+
+def exact_neighbors_for(X: np.ndarray, queries: np.ndarray, n_neighbors: int) -> np.ndarray:
+    """对抽样的查询细胞分块暴力计算精确kNN"""
+    sq_norms = (X.astype(np.float64) ** 2).sum(axis=1)
+    result = np.empty((len(queries), n_neighbors), dtype=np.int64)
+    for start in range(0, len(queries), 256):
+        q = X[queries[start:start + 256]].astype(np.float64)
+        d = sq_norms[None, :] - 2 * q @ X.T.astype(np.float64) + (q ** 2).sum(axis=1)[:, None]
+        part = np.argpartition(d, n_neighbors - 1, axis=1)[:, :n_neighbors]
+        result[start:start + 256] = part
+    return result
+
+
+def recall(approx: np.ndarray, exact: np.ndarray) -> float:
+    hits = [len(np.intersect1d(a, e, assume_unique=True)) for a, e in zip(approx, exact)]
+    return float(np.sum(hits) / exact.size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="近邻图后端基准")
+    parser.add_argument("--n-cells", type=int, default=100000)
+    parser.add_argument("--n-dims", type=int, default=50)
+    parser.add_argument("--n-clusters", type=int, default=30)
+    parser.add_argument("--n-neighbors", type=int, default=15)
+    parser.add_argument("--n-queries", type=int, default=2000, help="用于计算召回率的抽样细胞数")
+    parser.add_argument("--n-threads", type=int, default=None)
+    parser.add_argument("--backends", nargs="+", default=["nndescent", "hnsw"], choices=NEIGHBOR_BACKENDS)
+    parser.add_argument("--skip-exact", action="store_true", help="不计时完整的精确kNN（大数据时很慢）")
+    parser.add_argument("--output", help="结果JSON输出路径")
+    args = parser.parse_args()
+
+    X = synthetic_embedding(args.n_cells, args.n_dims, args.n_clusters)
+    queries = np.random.default_rng(1).choice(args.n_cells, size=min(args.n_queries, args.n_cells), replace=False)
+    exact = exact_neighbors_for(X, queries, args.n_neighbors)
+
+    results = {"n_cells": args.n_cells, "n_dims": args.n_dims, "n_neighbors": args.n_neighbors, "backends": {}}
+    exact_seconds = None
+    if not args.skip_exact:
+        start = time.perf_counter()
+        knn(X, args.n_neighbors, backend="exact", n_threads=args.n_threads)
+        exact_seconds = time.perf_counter() - start
+        results["backends"]["exact"] = {"seconds": exact_seconds, "recall": 1.0, "speedup": 1.0}
+        print(f"exact       {exact_seconds:8.2f}s")
+
+    for backend in args.backends:
+        if backend == "exact":
+            continue
+        try:
+            # 预热：排除numba首次JIT编译的时间
+            knn(X[:2000], args.n_neighbors, backend=backend, n_threads=args.n_threads)
+            start = time.perf_counter()
+            indices, _ = knn(X, args.n_neighbors, backend=backend, n_threads=args.n_threads)
+            seconds = time.perf_counter() - start
+        except ImportError as e:
+            print(f"{backend:<11} 跳过: {e}")
+            continue
+        entry = {
+            "seconds": seconds,
+            "recall": recall(indices[queries], exact),
+            "speedup": exact_seconds / seconds if exact_seconds else None,
+        }
+        results["backends"][backend] = entry
+        speedup = f"{entry['speedup']:6.1f}x" if entry["speedup"] else "     -"
+        print(f"{backend:<11} {seconds:8.2f}s  recall@{args.n_neighbors} {entry['recall']:.4f}  speedup {speedup}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
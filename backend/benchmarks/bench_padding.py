@@ -0,0 +1,166 @@
+"""
+填充策略基准: 比较固定填充到max_length、按批动态填充与按长度分桶三种分批方式
+
+在不同测序深度的合成数据上统计填充比例与注意力计算量（按 批大小×序列长度² 估算），
+并测量分词吞吐量。安装了torch时还在CPU上用一个Transformer编码器测量推理吞吐量，
+并检查三种方式按原始细胞顺序得到的[CLS]输出一致。
+
+用法:
+    python benchmarks/bench_padding.py --n-cells 20000 --depths 200 500 2000
+    python benchmarks/bench_padding.py --n-cells 5000 --layers 4 --d-model 256 --output padding.json
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import parse_size, synthetic_counts
+from app.models.tokenization import iter_token_batches, vocab_lookup
+
+PAD_ID, CLS_ID = 0, 1
+
+# 分批方式: 固定填充到max_length、按原顺序分批并动态填充、按长度分桶并动态填充
+MODES = ["fixed", "dynamic", "bucketed"]
+
+
+def batches(X, vocab_ids, mode: str, args):
+    """按指定方式产生 (行号, 分词结果)"""
+    if mode == "fixed":
+        # 固定填充：与动态填充相同的分批，再把每批补齐到max_length
+        for rows, tokens in iter_token_batches(X, vocab_ids, CLS_ID, PAD_ID, batch_size=args.batch_size,
+                                               max_length=args.max_length):
+            pad = args.max_length - tokens["input_ids"].shape[1]
+            yield rows, {
+                "input_ids": np.pad(tokens["input_ids"], ((0, 0), (0, pad)), constant_values=PAD_ID),
+                "values": np.pad(tokens["values"], ((0, 0), (0, pad))),
+                "attention_mask": np.pad(tokens["attention_mask"], ((0, 0), (0, pad))),
+            }
+        return
+    yield from iter_token_batches(
+        X, vocab_ids, CLS_ID, PAD_ID, batch_size=args.batch_size, max_length=args.max_length,
+        bucket_size=args.bucket_size if mode == "bucketed" else None
+    )
+
+
+def padding_stats(X, vocab_ids, mode: str, args) -> dict:
+    """分词吞吐量、填充比例与相对注意力计算量"""
+    real = padded = attention = 0
+    start = time.perf_counter()
+    for _, tokens in batches(X, vocab_ids, mode, args):
+        n, length = tokens["input_ids"].shape
+        real += int(tokens["attention_mask"].sum())
+        padded += n * length
+        attention += n * length ** 2
+    seconds = time.perf_counter() - start
+    return {
+        "tokenize_cells_per_second": X.shape[0] / seconds,
+        "mean_length": padded / X.shape[0],
+        "padding_fraction": 1 - real / padded,
+        "attention_cost": attention,
+    }
+
+
+def build_encoder(args, vocab_size: int):
+    import torch
+
+    torch.manual_seed(0)
+    torch.set_num_threads(args.threads or torch.get_num_threads())
+    embedding = torch.nn.Embedding(vocab_size, args.d_model, padding_idx=PAD_ID)
+    encoder = torch.nn.TransformerEncoder(
+        torch.nn.TransformerEncoderLayer(args.d_model, args.heads, dim_feedforward=4 * args.d_model,
+                                         batch_first=True, dropout=0.0),
+        num_layers=args.layers, enable_nested_tensor=False
+    )
+    return embedding.eval(), encoder.eval()
+
+
+def inference(X, vocab_ids, mode: str, args, model) -> tuple:
+    """推理吞吐量与按原始顺序排列的[CLS]输出"""
+    import torch
+
+    embedding, encoder = model
+    outputs = np.zeros((X.shape[0], args.d_model), dtype=np.float32)
+    start = time.perf_counter()
+    with torch.no_grad():
+        for rows, tokens in batches(X, vocab_ids, mode, args):
+            input_ids = torch.from_numpy(tokens["input_ids"])
+            padding_mask = torch.from_numpy(tokens["attention_mask"]) == 0
+            hidden = encoder(embedding(input_ids), src_key_padding_mask=padding_mask)
+            outputs[rows] = hidden[:, 0, :].numpy()
+    return X.shape[0] / (time.perf_counter() - start), outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="scGPT分批填充策略基准")
+    parser.add_argument("--n-cells", default="20000", help="每种深度的细胞数，如 20000、5k")
+    parser.add_argument("--n-genes", type=int, default=2000)
+    parser.add_argument("--depths", nargs="+", type=float, default=[200, 500, 2000],
+                        help="平均每个细胞的UMI数（文库大小服从对数正态分布）")
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--bucket-size", type=int, default=2048)
+    parser.add_argument("--max-length", type=int, default=512)
+    parser.add_argument("--inference-cells", type=int, default=2000, help="推理测量使用的细胞数（0表示跳过推理）")
+    parser.add_argument("--d-model", type=int, default=256)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--threads", type=int, help="torch线程数")
+    parser.add_argument("--output", help="结果JSON输出路径")
+    args = parser.parse_args()
+
+    has_torch = importlib.util.find_spec("torch") is not None
+    if not has_torch:
+        print("未安装torch，只统计填充比例与估算的注意力计算量")
+
+    results = {}
+    for depth in args.depths:
+        adata = synthetic_counts(parse_size(args.n_cells), n_genes=args.n_genes, mean_library_size=depth)
+        X = adata.X
+        vocab_ids = vocab_lookup(list(adata.var_names), {gene: i + 2 for i, gene in enumerate(adata.var_names)})
+        print(f"\n=== 平均深度 {depth:.0f} UMI, {X.shape[0]} 个细胞 ===")
+        print(f"{'方式':10s} {'分词 细胞/s':>12s} {'平均长度':>9s} {'填充比例':>9s} {'注意力计算量':>12s} {'推理 细胞/s':>12s} {'加速':>6s}")
+
+        depth_results = {}
+        reference = None
+        model = build_encoder(args, args.n_genes + 2) if has_torch and args.inference_cells else None
+        for mode in MODES:
+            stats = padding_stats(X, vocab_ids, mode, args)
+            if model is not None:
+                stats["inference_cells_per_second"], cls = inference(
+                    X[:args.inference_cells], vocab_ids, mode, args, model
+                )
+                if reference is None:
+                    reference = cls
+                stats["max_abs_diff_vs_fixed"] = float(np.abs(cls - reference).max())
+            depth_results[mode] = stats
+
+        fixed = depth_results["fixed"]
+        for mode, stats in depth_results.items():
+            stats["attention_cost_ratio"] = stats["attention_cost"] / fixed["attention_cost"]
+            line = (
+                f"{mode:10s} {stats['tokenize_cells_per_second']:12.0f} {stats['mean_length']:9.1f} "
+                f"{stats['padding_fraction']:9.1%} {stats['attention_cost_ratio']:12.3f}"
+            )
+            if "inference_cells_per_second" in stats:
+                stats["speedup"] = stats["inference_cells_per_second"] / fixed["inference_cells_per_second"]
+                line += f" {stats['inference_cells_per_second']:12.1f} {stats['speedup']:5.2f}x"
+            print(line)
+        if reference is not None:
+            print(f"与固定填充的[CLS]输出最大差异: "
+                  f"{max(stats['max_abs_diff_vs_fixed'] for stats in depth_results.values()):.2e}")
+        results[f"{depth:.0f}"] = depth_results
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""
+分析阶段基准: 在合成数据上依次运行 SingleCellAnalysis 的各阶段，记录耗时与峰值内存，并可与基线比较
+
+阶段包括加载、预处理、PCA、各批次校正方法、聚类、marker注释与h5ad导出；
+同时用合成数据的真实标签评估聚类（ARI）与注释（准确率）质量。只使用CPU。
+
+用法:
+    python benchmarks/bench_stages.py --sizes 10k 100k --output results.json
+    python benchmarks/bench_stages.py --sizes 10k --baseline results.json --tolerance 0.2
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# 只使用CPU；聚类扫描会fork子进程，与 run_analysis 一样默认使用workqueue线程层
+os.environ.setdefault("CUDA_VISIBLE_DEVICES", "")
+os.environ.setdefault("NUMBA_THREADING_LAYER", "workqueue")
+
+# 添加 backend 目录到 Python 路径
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BACKEND_DIR)
+
+from app.analysis.instrumentation import StageMonitor
+from app.analysis.qc import available_cpus
+from benchmarks.synthetic import format_size, parse_size, synthetic_h5ad
+
+BATCH_METHODS = ["harmony", "bbknn", "scanorama"]
+_BATCH_MODULES = {"harmony": "harmonypy", "bbknn": "bbknn", "scanorama": "scanorama"}
+
+
+def environment() -> dict:
+    """记录运行环境，便于解释不同机器之间的差异"""
+    from importlib.metadata import version
+
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True, text=True
+        ).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "timestamp": time.time(),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": available_cpus(),
+        "versions": {name: version(name) for name in ("numpy", "scipy", "anndata", "scanpy")},
+    }
+
+
+def run_stage(monitor: StageMonitor, name: str, func, required: bool = True) -> bool:
+    """在监控下运行一个阶段；阶段返回False时记为失败"""
+    try:
+        with monitor.stage(name):
+            if not func():
+                raise RuntimeError(f"阶段 {name} 失败")
+        return True
+    except RuntimeError:
+        if required:
+            raise
+        return False
+
+
+def bench_size(n_cells: int, args) -> dict:
+    """在一个数据规模上运行全部阶段"""
+    from sklearn.metrics import adjusted_rand_score
+
+    from app.analysis.sc_analysis import SingleCellAnalysis
+
+    data_path = synthetic_h5ad(
+        n_cells, args.data_dir, seed=args.seed,
+        n_genes=args.n_genes, n_clusters=args.n_clusters, n_batches=args.n_batches
+    )
+    output_path = tempfile.mkdtemp(prefix=f"bench_{format_size(n_cells)}_")
+    monitor = StageMonitor(f"bench_{format_size(n_cells)}")
+    analyzer = SingleCellAnalysis(data_path, output_path)
+    quality = {}
+    skipped = []
+    try:
+        run_stage(monitor, "load", analyzer.load_data)
+        run_stage(monitor, "preprocess", lambda: analyzer.preprocess(min_genes=50, max_genes=10000))
+        run_stage(monitor, "pca", analyzer.pca)
+
+        # 每种批次校正方法都从同一个PCA结果出发
+        base = analyzer.adata
+        for method in args.batch_methods:
+            if importlib.util.find_spec(_BATCH_MODULES[method]) is None:
+                skipped.append(f"batch_correction:{method}")
+                continue
+            analyzer.adata = base.copy()
+            run_stage(
+                monitor, f"batch_correction:{method}",
+                lambda: analyzer.batch_correction(batch_key="batch", method=method), required=False
+            )
+        analyzer.adata = base
+
+        run_stage(monitor, "clustering", analyzer.clustering)
+        quality["clustering_ari"] = float(
+            adjusted_rand_score(analyzer.adata.obs["true_cluster"], analyzer.adata.obs["leiden"])
+        )
+
+        run_stage(monitor, "marker_annotation", lambda: analyzer.cell_type_annotation(method="marker_genes"))
+        obs = analyzer.adata.obs
+        known = ~obs["true_cell_type"].astype(str).str.startswith("type")
+        quality["annotation_accuracy"] = float(
+            (obs.loc[known, "predicted_cell_type"].astype(str) == obs.loc[known, "true_cell_type"].astype(str)).mean()
+        )
+
+        run_stage(monitor, "export", analyzer.export_h5ad)
+        analyzer.close()
+    finally:
+        shutil.rmtree(output_path, ignore_errors=True)
+
+    return {
+        "n_cells": n_cells,
+        "n_genes": args.n_genes,
+        "stages": monitor.stages,
+        "skipped": skipped,
+        "quality": quality,
+    }
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_seconds: float) -> list:
+    """与基线比较，返回超出容差的阶段"""
+    regressions = []
+    print(f"\n{'规模':>6s} {'阶段':28s} {'耗时':>9s} {'基线':>9s} {'比值':>6s} {'峰值内存':>10s} {'基线':>10s}")
+    for size, result in results.items():
+        if size not in baseline.get("results", {}):
+            continue
+        base_stages = {
+            stage["stage"]: stage for stage in baseline["results"][size]["stages"] if stage["status"] == "completed"
+        }
+        for stage in result["stages"]:
+            base = base_stages.get(stage["stage"])
+            if base is None or stage["status"] != "completed":
+                continue
+            time_ratio = stage["wall_seconds"] / max(base["wall_seconds"], 1e-9)
+            memory_ratio = stage["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9)
+            slower = time_ratio > 1 + tolerance and base["wall_seconds"] >= min_seconds
+            larger = memory_ratio > 1 + tolerance
+            flag = "  <- 回退" if slower or larger else ""
+            print(
+                f"{size:>6s} {stage['stage']:28s} {stage['wall_seconds']:8.2f}s {base['wall_seconds']:8.2f}s "
+                f"{time_ratio:6.2f} {stage['peak_rss_mb']:8.0f}MB {base['peak_rss_mb']:8.0f}MB{flag}"
+            )
+            if flag:
+                regressions.append({
+                    "size": size, "stage": stage["stage"],
+                    "time_ratio": time_ratio, "memory_ratio": memory_ratio,
+                })
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="SingleCellAnalysis 各阶段基准")
+    parser.add_argument("--sizes", nargs="+", default=["10k", "100k"], help="细胞数，如 10k 100k 1M")
+    parser.add_argument("--n-genes", type=int, default=2000)
+    parser.add_argument("--n-clusters", type=int, default=10)
+    parser.add_argument("--n-batches", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-methods", nargs="*", default=BATCH_METHODS, choices=BATCH_METHODS)
+    parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "bench_synthetic"),
+                        help="合成数据缓存目录（相同参数的数据只生成一次）")
+    parser.add_argument("--output", help="结果JSON输出路径")
+    parser.add_argument("--baseline", help="作为基线的历史结果JSON")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允许的耗时/内存相对增幅")
+    parser.add_argument("--min-seconds", type=float, default=1.0, help="基线耗时低于该值的阶段不判定耗时回退")
+    args = parser.parse_args()
+
+    results = {}
+    for size in args.sizes:
+        n_cells = parse_size(size)
+        label = format_size(n_cells)
+        print(f"=== {label} 个细胞 ===")
+        results[label] = bench_size(n_cells, args)
+        for stage in results[label]["stages"]:
+            print(
+                f"{stage['stage']:28s} {stage['status']:9s} {stage['wall_seconds']:8.2f}s "
+                f"CPU {stage['cpu_seconds']:8.2f}s  峰值内存 {stage['peak_rss_mb']:8.0f}MB"
+            )
+        if results[label]["skipped"]:
+            print(f"未安装依赖而跳过: {', '.join(results[label]['skipped'])}")
+        print(f"质量: {results[label]['quality']}")
+
+    report = {"environment": environment(), "results": results}
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            print(f"\n{len(regressions)} 个阶段超出容差 {args.tolerance:.0%}")
+            sys.exit(1)
+        print("\n未发现回退")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+"""
+启动耗时基准: 在全新的解释器中测量入口模块的导入耗时，超出预算或导入了重量级依赖时以非零状态退出
+
+HPC作业（run_analysis）与API进程（app.app）启动时不应加载scanpy、matplotlib、torch、langchain等库，
+这些库只在真正用到的代码路径中导入。
+
+用法:
+    python benchmarks/bench_startup.py --repeat 5
+    python benchmarks/bench_startup.py --budget app.app=1.5 --budget app.analysis.run_analysis=1.0
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 各入口模块的默认导入耗时预算（秒）
+DEFAULT_BUDGETS = {
+    "app.app": 2.0,
+    "app.analysis.run_analysis": 1.5,
+}
+
+# 入口模块导入后不应出现在 sys.modules 中的库
+HEAVY_MODULES = [
+    "scanpy", "anndata", "matplotlib", "seaborn", "numba", "umap", "sklearn",
+    "torch", "transformers", "langchain", "langchain_community", "langchain_huggingface", "scgpt",
+]
+
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+heavy = [name for name in {heavy!r} if name in sys.modules]
+print(json.dumps({{"seconds": seconds, "heavy": heavy}}))
+"""
+
+
+def measure(module: str) -> dict:
+    """在子进程中导入模块，返回导入耗时与被加载的重量级库"""
+    env = dict(os.environ, PYTHONPATH=BACKEND_DIR, PYTHONDONTWRITEBYTECODE="1")
+    proc = subprocess.run(
+        [sys.executable, "-c", _PROBE.format(module=module, heavy=HEAVY_MODULES)],
+        cwd=BACKEND_DIR, env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        return {"error": proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "导入失败"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def parse_budgets(values) -> dict:
+    budgets = dict(DEFAULT_BUDGETS)
+    for value in values or []:
+        module, _, seconds = value.partition("=")
+        budgets[module] = float(seconds)
+    return budgets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="入口模块启动耗时基准")
+    parser.add_argument("--budget", action="append", metavar="MODULE=SECONDS",
+                        help="覆盖或新增模块的导入耗时预算，可重复指定")
+    parser.add_argument("--repeat", type=int, default=3, help="每个模块测量次数（取中位数）")
+    parser.add_argument("--output", help="结果JSON输出路径")
+    args = parser.parse_args()
+
+    budgets = parse_budgets(args.budget)
+    results = {}
+    failed = False
+    for module, budget in budgets.items():
+        runs = [measure(module) for _ in range(args.repeat)]
+        errors = [run["error"] for run in runs if "error" in run]
+        if errors:
+            results[module] = {"budget": budget, "error": errors[0]}
+            print(f"{module:32s} 导入失败: {errors[0]}")
+            failed = True
+            continue
+
+        seconds = sorted(run["seconds"] for run in runs)[len(runs) // 2]
+        heavy = sorted(set(name for run in runs for name in run["heavy"]))
+        ok = seconds <= budget and not heavy
+        failed = failed or not ok
+        results[module] = {"seconds": seconds, "budget": budget, "heavy": heavy, "ok": ok}
+        status = "通过" if ok else ("超出预算" if seconds > budget else "加载了重量级依赖")
+        print(
+            f"{module:32s} {seconds:6.2f}s / 预算 {budget:.2f}s  {status}"
+            + (f"  已加载: {', '.join(heavy)}" if heavy else "")
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""
+合成单细胞数据: 生成具有已知簇结构与批次效应的稀疏UMI计数矩阵，供基准测试使用
+
+每个簇有一组上调基因（前几个簇使用内置marker基因，便于测试marker注释），
+每个批次对所有基因施加一个对数正态的乘性偏移；文库大小服从对数正态分布。
+计数按细胞分块以泊松分布抽样；写入h5ad文件时逐块追加到磁盘，内存峰值只取决于块大小，
+synthetic_counts 则在内存中返回完整矩阵。
+
+用法:
+    python benchmarks/synthetic.py --n-cells 100000 --output /tmp/synthetic_100k.h5ad
+"""
+
+import argparse
+import os
+import sys
+from typing import Iterator, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.analysis.markers import DEFAULT_MARKERS
+
+N_MT_GENES = 13
+
+
+def parse_size(value: str) -> int:
+    """解析 10k / 1M 形式的细胞数"""
+    value = value.strip().lower()
+    scale = {'k': 1000, 'm': 1000000}.get(value[-1], 1)
+    return int(float(value.rstrip('km')) * scale)
+
+
+def format_size(n_cells: int) -> str:
+    if n_cells >= 1000000 and n_cells % 1000000 == 0:
+        return f"{n_cells // 1000000}M"
+    if n_cells >= 1000 and n_cells % 1000 == 0:
+        return f"{n_cells // 1000}k"
+    return str(n_cells)
+
+
+def gene_names(n_genes: int) -> np.ndarray:
+    """内置marker基因 + 线粒体基因 + 其余编号基因"""
+    markers = list(dict.fromkeys(gene for genes in DEFAULT_MARKERS.values() for gene in genes))
+    mt = [f"MT-GENE{i}" for i in range(N_MT_GENES)]
+    rest = [f"GENE{i}" for i in range(max(n_genes - len(markers) - len(mt), 0))]
+    return np.array((markers + mt + rest)[:n_genes], dtype=object)
+
+
+def _synthetic_chunks(n_cells: int, n_genes: int = 2000, n_clusters: int = 10, n_batches: int = 3,
+                      mean_library_size: float = 2000.0, batch_strength: float = 0.5,
+                      chunk_size: int = 20000, seed: int = 0) -> Tuple[pd.DataFrame, pd.DataFrame, Iterator]:
+    """
+    生成合成数据的细胞与基因元数据，以及按块惰性抽样计数的迭代器（参数见 synthetic_counts）
+
+    Returns:
+        (obs, var, 依次产出float32 CSR计数块的迭代器)
+    """
+    rng = np.random.default_rng(seed)
+    var_names = gene_names(n_genes)
+    gene_index = {gene: i for i, gene in enumerate(var_names)}
+
+    # 基础表达谱：长尾分布，少数基因贡献大部分UMI
+    base = rng.lognormal(mean=0.0, sigma=1.5, size=n_genes)
+    base[[gene_index[f"MT-GENE{i}"] for i in range(N_MT_GENES) if f"MT-GENE{i}" in gene_index]] *= 5
+
+    # 每个簇上调一组基因；前几个簇的上调基因包含对应细胞类型的marker
+    profiles = np.tile(base, (n_clusters, 1))
+    cell_types = list(DEFAULT_MARKERS)
+    for cluster in range(n_clusters):
+        up = rng.choice(n_genes, size=max(n_genes // 50, 5), replace=False)
+        if cluster < len(cell_types):
+            up = np.union1d(up, [gene_index[g] for g in DEFAULT_MARKERS[cell_types[cluster]] if g in gene_index])
+        profiles[cluster, up] *= rng.uniform(4, 12, size=len(up))
+    profiles /= profiles.sum(axis=1, keepdims=True)
+
+    batch_shift = rng.lognormal(mean=0.0, sigma=batch_strength, size=(n_batches, n_genes))
+
+    # 簇大小不均衡，包含稀有簇
+    cluster_weights = rng.dirichlet(np.full(n_clusters, 2.0))
+    clusters = rng.choice(n_clusters, size=n_cells, p=cluster_weights)
+    batches = rng.integers(n_batches, size=n_cells)
+    library_size = rng.lognormal(mean=np.log(mean_library_size), sigma=0.4, size=n_cells)
+
+    def chunks():
+        for start in range(0, n_cells, chunk_size):
+            end = min(start + chunk_size, n_cells)
+            rates = profiles[clusters[start:end]] * batch_shift[batches[start:end]]
+            rates *= (library_size[start:end] / rates.sum(axis=1))[:, None]
+            yield sp.csr_matrix(rng.poisson(rates).astype(np.float32))
+
+    obs = pd.DataFrame({
+        'batch': pd.Categorical([f"batch{b}" for b in batches]),
+        'true_cluster': pd.Categorical(clusters.astype(str)),
+        'true_cell_type': pd.Categorical([
+            cell_types[c] if c < len(cell_types) else f"type{c}" for c in clusters
+        ]),
+    }, index=pd.Index([f"cell{i}" for i in range(n_cells)]))
+    return obs, pd.DataFrame(index=pd.Index(var_names)), chunks()
+
+
+def synthetic_counts(n_cells: int, n_genes: int = 2000, n_clusters: int = 10, n_batches: int = 3,
+                     mean_library_size: float = 2000.0, batch_strength: float = 0.5,
+                     chunk_size: int = 20000, seed: int = 0):
+    """
+    在内存中生成合成计数矩阵（大规模数据请用 write_synthetic_h5ad 直接写入磁盘）
+
+    Args:
+        n_cells: 细胞数
+        n_genes: 基因数
+        n_clusters: 簇数（真实标签在 obs['true_cluster']）
+        n_batches: 批次数（obs['batch']）
+        mean_library_size: 平均每个细胞的UMI数
+        batch_strength: 批次偏移的对数标准差
+        chunk_size: 每块抽样的细胞数
+        seed: 随机种子
+
+    Returns:
+        AnnData，X为float32 CSR计数矩阵
+    """
+    import anndata as ad
+
+    obs, var, chunks = _synthetic_chunks(
+        n_cells, n_genes=n_genes, n_clusters=n_clusters, n_batches=n_batches,
+        mean_library_size=mean_library_size, batch_strength=batch_strength, chunk_size=chunk_size, seed=seed
+    )
+    return ad.AnnData(X=sp.vstack(list(chunks), format='csr'), obs=obs, var=var)
+
+
+def write_synthetic_h5ad(path: str, n_cells: int, **kwargs):
+    """生成合成计数矩阵并逐块写入h5ad文件，内容与 synthetic_counts 相同（参数见 synthetic_counts）"""
+    from app.analysis.backed import write_h5ad_chunks
+
+    obs, var, chunks = _synthetic_chunks(n_cells, **kwargs)
+    write_h5ad_chunks(path, chunks, obs, var)
+
+
+def synthetic_h5ad(n_cells: int, data_dir: str, seed: int = 0, **kwargs) -> str:
+    """生成（或复用已生成的）合成数据h5ad文件，返回文件路径"""
+    suffix = ''.join(f"_{key}{value}" for key, value in sorted(kwargs.items()))
+    path = os.path.join(data_dir, f"synthetic_{format_size(n_cells)}_seed{seed}{suffix}.h5ad")
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        tmp_path = path[:-len('.h5ad')] + '.tmp.h5ad'
+        write_synthetic_h5ad(tmp_path, n_cells, seed=seed, **kwargs)
+        os.replace(tmp_path, path)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description="生成合成单细胞计数矩阵")
+    parser.add_argument("--n-cells", default="10k", help="细胞数，如 10k、100k、1M")
+    parser.add_argument("--n-genes", type=int, default=2000)
+    parser.add_argument("--n-clusters", type=int, default=10)
+    parser.add_argument("--n-batches", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", required=True, help="输出h5ad路径")
+    args = parser.parse_args()
+
+    n_cells = parse_size(args.n_cells)
+    write_synthetic_h5ad(
+        args.output, n_cells, n_genes=args.n_genes, n_clusters=args.n_clusters,
+        n_batches=args.n_batches, seed=args.seed
+    )
+    print(f"已生成 {n_cells} 个细胞 × {args.n_genes} 个基因: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+sc = pytest.importorskip("scanpy")
+ad = pytest.importorskip("anndata")
+
+from app.analysis.backed import BackedPreprocessor, iter_chunks, mito_gene_mask, select_hvg_seurat
+
+
+def _counts(seed: int = 0):
+    """基因均值与离散度各不相同的计数矩阵，含线粒体基因与几乎不表达的基因"""
+    rng = np.random.default_rng(seed)
+    n_obs, n_vars = 400, 150
+    means = rng.gamma(0.8, 2.0, size=n_vars)
+    # 负二项分布，基因间离散度不同
+    dispersion = rng.uniform(0.1, 5.0, size=n_vars)
+    counts = rng.negative_binomial(1 / dispersion, 1 / (1 + means * dispersion), size=(n_obs, n_vars))
+    counts[:, -3:] = 0
+    counts[:5, -3] = 1
+    # 表达基因过少与线粒体比例过高的细胞应被质控过滤
+    counts[10:15, 5:] = 0
+    counts[20:25, :3] += 500
+    adata = ad.AnnData(sp.csr_matrix(counts.astype(np.float32)))
+    adata.obs_names = [f"c{i}" for i in range(n_obs)]
+    adata.var_names = [f"MT-{i}" if i < 3 else f"g{i}" for i in range(n_vars)]
+    return adata
+
+
+def test_iter_chunks_and_mito_mask():
+    X = _counts().X
+    chunks = list(iter_chunks(X, 97))
+    assert [(start, end) for start, end, _ in chunks][-1] == (388, 400)
+    assert (sp.vstack([chunk for _, _, chunk in chunks]) != X).nnz == 0
+
+    adata = _counts()
+    assert list(np.flatnonzero(mito_gene_mask(adata.var))) == [0, 1, 2]
+    adata.var["mt"] = False
+    assert not mito_gene_mask(adata.var).any()
+
+
+def test_matches_in_memory_scanpy(tmp_path):
+    adata = _counts()
+    source = str(tmp_path / "raw.h5ad")
+    adata.write_h5ad(source)
+    backed = ad.read_h5ad(source, backed="r")
+    try:
+        prep = BackedPreprocessor(backed, chunk_size=97)
+        result = prep.run(str(tmp_path / "preprocessed.h5ad"), min_genes=20, min_cells=10,
+                          max_genes=140, max_mt_percent=20.0, n_top_genes=40)
+        X_backed = result.X[:]
+        hvg_backed = list(result.var_names)
+        obs_backed = list(result.obs_names)
+        result.file.close()
+    finally:
+        backed.file.close()
+    assert 0 < len(obs_backed) < adata.n_obs
+
+    # 内存模式：相同的细胞过滤后，按scanpy流程过滤基因、标准化并选择Seurat高变基因
+    expected = adata[prep.cell_mask].copy()
+    sc.pp.filter_genes(expected, min_cells=10)
+    assert list(expected.var_names) == list(adata.var_names[prep.gene_mask])
+    sc.pp.normalize_total(expected, target_sum=1e4)
+    sc.pp.log1p(expected)
+    sc.pp.highly_variable_genes(expected, flavor="seurat", n_top_genes=40)
+
+    assert obs_backed == list(expected.obs_names)
+    assert hvg_backed == list(expected.var_names[expected.var["highly_variable"]])
+    expected_X = expected[:, expected.var["highly_variable"]].X
+    np.testing.assert_allclose(X_backed.toarray(), expected_X.toarray(), rtol=1e-5, atol=1e-6)
+
+
+def test_select_hvg_seurat_matches_scanpy():
+    adata = _counts(seed=3)
+    sc.pp.normalize_total(adata, target_sum=1e4)
+    X = adata.X.toarray().astype(np.float64)
+    sc.pp.log1p(adata)
+    sc.pp.highly_variable_genes(adata, flavor="seurat", n_top_genes=30)
+
+    hvg = select_hvg_seurat(X.mean(axis=0), X.var(axis=0, ddof=1), 30)
+    assert list(hvg["highly_variable"]) == list(adata.var["highly_variable"])
+    np.testing.assert_allclose(hvg["dispersions_norm"], adata.var["dispersions_norm"], rtol=1e-4)
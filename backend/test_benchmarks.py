@@ -0,0 +1,77 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+pytest.importorskip("anndata")
+
+from app.analysis.markers import DEFAULT_MARKERS
+from benchmarks.bench_stages import compare
+from benchmarks.synthetic import format_size, parse_size, synthetic_counts, synthetic_h5ad, write_synthetic_h5ad
+
+
+def test_parse_and_format_size():
+    assert [parse_size(value) for value in ["500", "10k", "2.5K", "1M"]] == [500, 10000, 2500, 1000000]
+    assert [format_size(n) for n in [500, 10000, 2500, 1000000]] == ["500", "10k", "2500", "1M"]
+
+
+def test_synthetic_counts_structure():
+    adata = synthetic_counts(3000, n_genes=300, n_clusters=4, n_batches=2, chunk_size=700, seed=1)
+    assert adata.shape == (3000, 300)
+    assert adata.X.dtype == np.float32
+    assert np.all(adata.X.data == np.round(adata.X.data))
+    assert set(adata.obs["batch"]) == {"batch0", "batch1"}
+    assert set(adata.obs["true_cluster"].astype(int)) <= set(range(4))
+    # 内置marker基因在基因名中，且前几个簇标为对应细胞类型
+    first_type = list(DEFAULT_MARKERS)[0]
+    assert set(DEFAULT_MARKERS[first_type]) <= set(adata.var_names)
+    assert first_type in set(adata.obs["true_cell_type"])
+
+    # 分块抽样不影响确定性
+    again = synthetic_counts(3000, n_genes=300, n_clusters=4, n_batches=2, chunk_size=700, seed=1)
+    assert (again.X != adata.X).nnz == 0
+    assert list(again.obs["true_cluster"]) == list(adata.obs["true_cluster"])
+
+
+def test_write_synthetic_h5ad_matches_in_memory(tmp_path):
+    ad = pytest.importorskip("anndata")
+    path = str(tmp_path / "synthetic.h5ad")
+    # 逐块写入磁盘的结果与内存中生成的完全相同
+    write_synthetic_h5ad(path, 1000, n_genes=200, chunk_size=300, seed=2)
+    expected = synthetic_counts(1000, n_genes=200, chunk_size=300, seed=2)
+    written = ad.read_h5ad(path)
+    assert (written.X != expected.X).nnz == 0
+    assert written.X.dtype == np.float32
+    assert list(written.var_names) == list(expected.var_names)
+    for column in ["batch", "true_cluster", "true_cell_type"]:
+        assert list(written.obs[column]) == list(expected.obs[column])
+
+
+def test_synthetic_h5ad_is_reused(tmp_path):
+    path = synthetic_h5ad(500, str(tmp_path), n_genes=200)
+    mtime = os.stat(path).st_mtime_ns
+    assert synthetic_h5ad(500, str(tmp_path), n_genes=200) == path
+    assert os.stat(path).st_mtime_ns == mtime
+    assert synthetic_h5ad(500, str(tmp_path), n_genes=300) != path
+
+
+def _result(wall_seconds, peak_rss_mb, status="completed"):
+    return {"stages": [{"stage": "pca", "status": status, "wall_seconds": wall_seconds, "peak_rss_mb": peak_rss_mb}]}
+
+
+def test_compare_flags_regressions():
+    baseline = {"results": {"10k": _result(10.0, 1000.0)}}
+    assert compare({"10k": _result(11.0, 1100.0)}, baseline, tolerance=0.2, min_seconds=1.0) == []
+
+    slower = compare({"10k": _result(13.0, 1000.0)}, baseline, tolerance=0.2, min_seconds=1.0)
+    assert [(r["stage"], round(r["time_ratio"], 2)) for r in slower] == [("pca", 1.3)]
+    assert len(compare({"10k": _result(10.0, 1300.0)}, baseline, tolerance=0.2, min_seconds=1.0)) == 1
+
+    # 基线耗时过短的阶段不判定耗时回退；失败的阶段与基线中没有的规模不比较
+    assert compare({"10k": _result(13.0, 1000.0)}, baseline, tolerance=0.2, min_seconds=20.0) == []
+    assert compare({"10k": _result(30.0, 1000.0, status="failed")}, baseline, 0.2, 1.0) == []
+    assert compare({"100k": _result(30.0, 1000.0)}, baseline, 0.2, 1.0) == []
@@ -0,0 +1,76 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.clustering import choose_resolution, leiden_sweep, resolution_key, stability_scores
+
+
+@pytest.fixture(scope="module")
+def adata():
+    ad = pytest.importorskip("anndata")
+    pytest.importorskip("leidenalg")
+    pytest.importorskip("umap")
+    from app.analysis.neighbors import compute_neighbors
+
+    # 4个分离良好的簇
+    rng = np.random.default_rng(0)
+    labels = np.repeat(np.arange(4), 60)
+    X = (rng.standard_normal((4, 8)) * 10)[labels] + rng.standard_normal((len(labels), 8))
+    adata = ad.AnnData(np.zeros((len(labels), 2), dtype=np.float32))
+    adata.obsm["X_pca"] = X.astype(np.float32)
+    adata.obs["truth"] = labels
+    compute_neighbors(adata, n_neighbors=15, backend="exact", n_threads=1)
+    return adata
+
+
+@pytest.mark.parametrize("n_workers", [1, 2])
+def test_leiden_sweep(adata, n_workers):
+    from sklearn.metrics import adjusted_rand_score
+
+    adata = adata.copy()
+    summary = leiden_sweep(adata, [1.0, 0.1, 0.5, 1.0], n_workers=n_workers)
+    # 分辨率去重并升序，每个分辨率一列聚类结果
+    assert summary["resolutions"] == [0.1, 0.5, 1.0]
+    assert summary["keys"] == [resolution_key(r) for r in [0.1, 0.5, 1.0]] == ["leiden_r0.1", "leiden_r0.5", "leiden_r1"]
+    for key, n_clusters in zip(summary["keys"], summary["n_clusters"]):
+        assert adata.obs[key].dtype == "category"
+        assert adata.obs[key].nunique() == n_clusters
+    assert summary["n_clusters"] == sorted(summary["n_clusters"])
+    assert len(summary["stability"]) == 3
+
+    chosen = choose_resolution(summary)
+    assert adjusted_rand_score(adata.obs["truth"], adata.obs[resolution_key(chosen)]) > 0.9
+
+
+def test_sweep_is_deterministic(adata):
+    first, second = adata.copy(), adata.copy()
+    leiden_sweep(first, [0.5], n_workers=1, random_state=3)
+    leiden_sweep(second, [0.5, 0.8], n_workers=2, random_state=3)
+    assert list(first.obs["leiden_r0.5"]) == list(second.obs["leiden_r0.5"])
+
+
+def test_stability_scores():
+    a = np.array([0, 0, 1, 1, 2, 2])
+    b = np.array([0, 0, 1, 1, 1, 1])
+    assert stability_scores([a]) == [1.0]
+    scores = stability_scores([b, a, a])
+    # 端点只有一个相邻分辨率，中间的取两侧均值
+    assert scores[2] == pytest.approx(1.0)
+    assert scores[1] == pytest.approx((scores[0] + 1.0) / 2)
+    assert scores[0] < 1.0
+
+
+def test_choose_resolution():
+    summary = {"resolutions": [0.1, 0.5, 1.0, 2.0], "n_clusters": [1, 4, 6, 12], "stability": [1.0, 0.9, 0.7, 0.6]}
+    # 单簇划分不参与选择，取其余分辨率中ARI稳定性最高的
+    assert choose_resolution(summary) == 0.5
+    # 指定的分辨率在扫描范围内时直接使用，否则按稳定性选择
+    assert choose_resolution(summary, 2.0) == 2.0
+    assert choose_resolution(summary, 3.0) == 0.5
+    # 全部为单簇时退回按稳定性选择
+    assert choose_resolution({"resolutions": [0.1, 0.2], "n_clusters": [1, 1], "stability": [0.8, 1.0]}) == 0.2
@@ -0,0 +1,144 @@
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.models import embedding_cache
+from app.models.embedding_cache import EmbeddingCache, matrix_digest, model_fingerprint
+
+GENES = [f"g{i}" for i in range(20)]
+CELLS = [f"c{i}" for i in range(30)]
+
+
+def _matrix(seed: int = 0) -> sp.csr_matrix:
+    return sp.random(30, 20, density=0.3, format="csr", dtype=np.float32, random_state=seed)
+
+
+def test_matrix_digest_content_and_chunking(monkeypatch):
+    X = _matrix()
+    digest = matrix_digest(X, GENES, CELLS)
+    assert matrix_digest(X.toarray(), GENES, CELLS) == digest
+
+    # 分块读取与元素存放顺序不影响哈希
+    monkeypatch.setattr(embedding_cache, "_HASH_CHUNK_CELLS", 7)
+    assert matrix_digest(X, GENES, CELLS) == digest
+    unsorted = X.copy()
+    for i in range(unsorted.shape[0]):
+        start, end = unsorted.indptr[i], unsorted.indptr[i + 1]
+        unsorted.indices[start:end] = unsorted.indices[start:end][::-1]
+        unsorted.data[start:end] = unsorted.data[start:end][::-1]
+    unsorted.has_sorted_indices = False
+    assert matrix_digest(unsorted, GENES, CELLS) == digest
+    wide = sp.csr_matrix((X.data, X.indices.astype(np.int64), X.indptr.astype(np.int64)), shape=X.shape)
+    assert matrix_digest(wide, GENES, CELLS) == digest
+
+    # 表达值、基因名或细胞顺序变化都得到新的哈希
+    changed = X.copy()
+    changed.data[0] += 1
+    assert matrix_digest(changed, GENES, CELLS) != digest
+    assert matrix_digest(X, GENES[::-1], CELLS) != digest
+    assert matrix_digest(X, GENES, CELLS[::-1]) != digest
+
+
+def test_matrix_digest_backed(tmp_path):
+    ad = pytest.importorskip("anndata")
+    X = _matrix()
+    path = str(tmp_path / "data.h5ad")
+    ad.AnnData(X).write_h5ad(path)
+    backed = ad.read_h5ad(path, backed="r")
+    try:
+        assert matrix_digest(backed.X, GENES, CELLS) == matrix_digest(X, GENES, CELLS)
+    finally:
+        backed.file.close()
+
+
+def test_model_fingerprint_tracks_files(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "vocab.json").write_text("{}")
+    (model_dir / "best_model.pt").write_bytes(b"weights")
+    fingerprint = model_fingerprint(str(model_dir))
+    assert model_fingerprint(str(model_dir)) == fingerprint
+
+    (model_dir / "best_model.pt").write_bytes(b"new weights")
+    assert model_fingerprint(str(model_dir)) != fingerprint
+
+
+def test_key_depends_on_all_parts():
+    key = EmbeddingCache.key("data", "model", {"max_length": 512, "version": 1})
+    assert EmbeddingCache.key("data", "model", {"version": 1, "max_length": 512}) == key
+    assert EmbeddingCache.key("data", "model", {"max_length": 256, "version": 1}) != key
+    assert EmbeddingCache.key("other", "model", {"max_length": 512, "version": 1}) != key
+    assert EmbeddingCache.key("data", "other", {"max_length": 512, "version": 1}) != key
+
+
+def test_writer_and_load(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache"))
+    assert cache.load("key") is None
+
+    values = np.random.default_rng(0).standard_normal((30, 8)).astype(np.float32)
+    with cache.writer("key", values.shape) as out:
+        out[:] = values
+        # 写入完成前不会命中
+        assert cache.load("key") is None
+
+    loaded = cache.load("key")
+    assert isinstance(loaded, np.memmap) and loaded.dtype == np.float16
+    np.testing.assert_allclose(loaded, values, atol=1e-2)
+
+    # 写入出错时删除临时文件，不留下条目
+    with pytest.raises(RuntimeError):
+        with cache.writer("broken", (4, 8)):
+            raise RuntimeError("inference failed")
+    assert cache.load("broken") is None
+    assert sorted(os.listdir(cache.cache_dir)) == ["key.npy"]
+
+    # 损坏的条目当作未命中
+    with open(os.path.join(cache.cache_dir, "bad.npy"), "wb") as f:
+        f.write(b"not an array")
+    assert cache.load("bad") is None
+
+
+def test_evict_by_size_and_age(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache"), dtype="float32")
+    for i, key in enumerate(["old", "mid", "new"]):
+        with cache.writer(key, (100, 8)) as out:
+            out[:] = i
+        path = cache._entry_path(key)
+        os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+    entry_size = os.path.getsize(cache._entry_path("new"))
+
+    cache.max_size_bytes = 2 * entry_size + entry_size // 2
+    cache.evict()
+    assert [cache.load(key) is not None for key in ["old", "mid", "new"]] == [False, True, True]
+
+    # load 刷新了使用时间，之后按时间淘汰只删除未使用的条目
+    os.utime(cache._entry_path("mid"), (time.time() - 100, time.time() - 100))
+    cache.max_size_bytes = None
+    cache.max_age_seconds = 10
+    cache.evict()
+    assert sorted(os.listdir(cache.cache_dir)) == ["new.npy"]
+
+
+def test_new_entry_larger_than_cap_is_kept(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "cache"), dtype="float32")
+    with cache.writer("old", (10, 8)) as out:
+        out[:] = 0
+
+    # 新条目单独超过大小上限：为它淘汰其余条目，但它本身保留，可以立即读取
+    cache.max_size_bytes = 100
+    with cache.writer("big", (100, 8)) as out:
+        out[:] = 1
+    loaded = cache.load("big")
+    assert loaded is not None and np.all(loaded == 1)
+    assert sorted(os.listdir(cache.cache_dir)) == ["big.npy"]
+
+    # 不再是刚写入的条目时按上限正常淘汰
+    cache.evict()
+    assert cache.load("big") is None
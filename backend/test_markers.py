@@ -0,0 +1,85 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.markers import MarkerScorer, load_marker_table
+
+
+def test_load_cellmarker_table(tmp_path):
+    path = tmp_path / "cellmarker.tsv"
+    pd.DataFrame({
+        "speciesType": ["Human", "Mouse", "Human", "Human"],
+        "cellName": ["T cell", "T cell", "B cell", "B cell"],
+        "geneSymbol": ["CD3D, CD3E,[CD3G]", "Cd3d", "CD19,CD79A", "CD19"],
+    }).to_csv(path, sep="\t", index=False)
+
+    markers = load_marker_table(str(path), species="human")
+    # 逗号分隔的基因拆成多行，去掉方括号，重复的 (细胞类型, 基因) 只保留一次
+    assert list(zip(markers["cell_type"], markers["gene"])) == [
+        ("T cell", "CD3D"), ("T cell", "CD3E"), ("T cell", "CD3G"), ("B cell", "CD19"), ("B cell", "CD79A")
+    ]
+    assert (markers["weight"] == 1.0).all()
+    assert len(load_marker_table(str(path))) == 6
+
+    with pytest.raises(ValueError):
+        load_marker_table(str(path), gene_column="missing")
+
+
+def test_load_panglao_weights(tmp_path):
+    path = tmp_path / "panglao.csv"
+    pd.DataFrame({
+        "species": ["Hs", "Hs", "Hs", "Hs Mm", "Mm"],
+        "official gene symbol": ["CD14", "LYZ", "CSF1R", "NKG7", "Cd14"],
+        "cell type": ["Monocytes", "Monocytes", "Monocytes", "NK cells", "Monocytes"],
+        "ubiquitousness index": [0.5, "", -1.0, 0.2, 0.5],
+    }).to_csv(path, index=False)
+
+    markers = load_marker_table(str(path), weight_column="ubiquitousness index", species="Hs")
+    # 缺失与非正的权重被丢弃
+    assert list(markers["gene"]) == ["CD14", "NKG7"]
+    assert list(markers["weight"]) == [0.5, 0.2]
+
+    with pytest.raises(ValueError):
+        load_marker_table(str(path), cell_type_column="celltype_missing")
+
+
+def test_weight_matrix_normalizes_per_type():
+    markers = pd.DataFrame({
+        "cell_type": ["A", "A", "A", "B", "C"],
+        "gene": ["g0", "g1", "absent", "g1", "g2"],
+        "weight": [1.0, 3.0, 5.0, 2.0, 0.0],
+    })
+    used_genes, W, cell_types = MarkerScorer(markers).weight_matrix(["G0", "g1", "g2"])
+    # 数据中不存在的基因不参与归一化；权重全为0的类型被跳过
+    assert cell_types == ["A", "B"]
+    assert list(used_genes) == [0, 1]
+    np.testing.assert_allclose(W.toarray(), [[0.25, 0.0], [0.75, 1.0]])
+
+
+def test_annotate():
+    scorer = MarkerScorer.from_dict({"T": ["CD3D", "CD3E"], "B": ["CD19", "MS4A1"]})
+    var_names = ["cd3d", "CD3E", "CD19", "MS4A1", "ACTB"]
+    X = np.array([
+        [4, 2, 0, 0, 9],
+        [0, 1, 3, 3, 9],
+        [0, 0, 0, 0, 9],
+        [1, 1, 0, 1, 0],
+    ], dtype=np.float32)
+
+    labels, scores = scorer.annotate(sp.csr_matrix(X), var_names, chunk_size=2)
+    assert list(labels) == ["T", "B", "Unknown", "T"]
+    np.testing.assert_allclose(scores, [3.0, 3.0, 0.0, 1.0])
+
+    # 稠密输入与稀疏输入结果一致；区分大小写时 cd3d 不匹配
+    dense_labels, _ = scorer.annotate(X, var_names)
+    assert list(dense_labels) == list(labels)
+    strict = MarkerScorer(scorer.markers, case_sensitive=True)
+    _, strict_scores = strict.annotate(X, var_names)
+    assert strict_scores[0] == pytest.approx(2.0)
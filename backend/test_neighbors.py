@@ -0,0 +1,101 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.neighbors import NEIGHBOR_BACKENDS, _self_first, compute_neighbors, knn, knn_query, neighbor_graphs
+
+N_NEIGHBORS = 15
+
+
+def _embedding(seed: int = 0, n_obs: int = 600, n_dims: int = 10) -> np.ndarray:
+    """几个簇组成的低维表示"""
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((4, n_dims)) * 5
+    return (centers[rng.integers(0, 4, n_obs)] + rng.standard_normal((n_obs, n_dims))).astype(np.float32)
+
+
+def _recall(indices: np.ndarray, exact: np.ndarray) -> float:
+    return float(np.mean([len(set(a) & set(b)) / len(b) for a, b in zip(indices, exact)]))
+
+
+def test_self_first():
+    indices = np.array([[0, 3, 4], [2, 1, 0], [4, 0, 3]])
+    distances = np.array([[0.0, 1.0, 2.0], [0.0, 0.0, 3.0], [1.0, 2.0, 3.0]], dtype=np.float32)
+    fixed_indices, fixed_distances = _self_first(indices.copy(), distances.copy())
+    # 已在首位的行不变；自身不在首位时移到首位，其余保持顺序；缺少自身时插入并丢弃最远的近邻
+    np.testing.assert_array_equal(fixed_indices, [[0, 3, 4], [1, 2, 0], [2, 4, 0]])
+    np.testing.assert_array_equal(fixed_distances, [[0, 1, 2], [0, 0, 3], [0, 1, 2]])
+
+    # 全部行已满足时原样返回
+    ordered = np.array([[0, 1], [1, 0]])
+    assert _self_first(ordered, np.zeros((2, 2)))[0] is ordered
+
+
+@pytest.mark.parametrize("backend", NEIGHBOR_BACKENDS)
+def test_backend_recall(backend):
+    if backend == "nndescent":
+        pytest.importorskip("pynndescent")
+    elif backend == "hnsw":
+        pytest.importorskip("hnswlib")
+    pytest.importorskip("sklearn")
+    X = _embedding()
+    # 加入一个重复细胞，近似搜索可能把副本排在自身之前
+    X = np.vstack([X, X[:1]])
+    exact_indices, exact_distances = knn(X, N_NEIGHBORS, backend="exact", n_threads=1)
+    indices, distances = knn(X, N_NEIGHBORS, backend=backend, n_threads=1, random_state=0)
+
+    assert indices.shape == (X.shape[0], N_NEIGHBORS) and indices.dtype == np.int64
+    assert distances.dtype == np.float32
+    np.testing.assert_array_equal(indices[:, 0], np.arange(X.shape[0]))
+    np.testing.assert_array_equal(exact_indices[:, 0], np.arange(X.shape[0]))
+    assert np.all(np.diff(distances[:, 1:], axis=1) >= -1e-5)
+    assert _recall(indices, exact_indices) >= 0.95
+    np.testing.assert_allclose(np.sort(distances, axis=1)[:, -1].mean(), exact_distances[:, -1].mean(), rtol=0.05)
+
+
+def test_unknown_backend():
+    X = _embedding(n_obs=20)
+    with pytest.raises(ValueError):
+        knn(X, 5, backend="annoy")
+    with pytest.raises(ValueError):
+        knn_query(X, X[:3], 5, backend="annoy")
+
+
+def test_knn_query_matches_exact():
+    pytest.importorskip("pynndescent")
+    X = _embedding(seed=1)
+    index, query = X[::3], X[1::3]
+    exact_indices, _ = knn_query(index, query, 10, backend="exact", n_threads=1)
+    indices, _ = knn_query(index, query, 10, backend="nndescent", n_threads=1)
+    assert indices.shape == (len(query), 10)
+    assert _recall(indices, exact_indices) >= 0.95
+
+    # 近邻数不超过索引点数
+    assert knn_query(index[:4], query, 10, backend="exact")[0].shape == (len(query), 4)
+
+
+def test_neighbor_graphs_and_compute_neighbors():
+    pytest.importorskip("umap")
+    ad = pytest.importorskip("anndata")
+    X = _embedding(seed=2, n_obs=200)
+    indices, distances = knn(X, N_NEIGHBORS, backend="exact", n_threads=1)
+    distance_matrix, connectivities = neighbor_graphs(indices, distances)
+
+    # 距离矩阵每行 n_neighbors - 1 个近邻，不含自身；连接权重对称
+    assert distance_matrix.shape == connectivities.shape == (200, 200)
+    assert np.all(np.diff(distance_matrix.indptr) == N_NEIGHBORS - 1)
+    assert distance_matrix.diagonal().sum() == 0
+    assert abs(connectivities - connectivities.T).max() < 1e-6
+    assert connectivities.max() <= 1.0
+
+    adata = ad.AnnData(np.zeros((200, 3), dtype=np.float32))
+    adata.obsm["X_pca"] = X
+    params = compute_neighbors(adata, n_neighbors=N_NEIGHBORS, backend="exact", n_threads=1)
+    assert params["backend"] == "exact" and params["use_rep"] == "X_pca"
+    assert (adata.obsp["distances"] != distance_matrix).nnz == 0
+    assert adata.uns["neighbors"]["connectivities_key"] == "connectivities"
@@ -0,0 +1,136 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.pca import _flip_signs, incremental_pca, randomized_pca, run_pca
+
+ad = pytest.importorskip("anndata")
+
+N_COMPS = 4
+
+
+def _matrix(n_obs: int = 600, n_vars: int = 80, seed: int = 0) -> sp.csr_matrix:
+    """主成分方差差距明显的低秩数据，截断负值后约一半为零"""
+    rng = np.random.default_rng(seed)
+    latent = rng.standard_normal((n_obs, N_COMPS)) * np.array([8.0, 5.0, 3.0, 2.0])
+    loadings = np.linalg.qr(rng.standard_normal((n_vars, N_COMPS)))[0].T
+    X = latent @ loadings + 0.05 * rng.standard_normal((n_obs, n_vars))
+    return sp.csr_matrix(np.maximum(X, 0).astype(np.float32))
+
+
+def _exact_pca(X) -> dict:
+    """稠密矩阵中心化后的精确SVD"""
+    A = X.toarray().astype(np.float64)
+    A -= A.mean(axis=0)
+    U, S, Vt = np.linalg.svd(A, full_matrices=False)
+    components, scores = _flip_signs(Vt[:N_COMPS], U[:, :N_COMPS] * S[:N_COMPS])
+    variance = S ** 2 / (A.shape[0] - 1)
+    return {
+        'X_pca': scores,
+        'components': components,
+        'variance': variance[:N_COMPS],
+        'variance_ratio': variance[:N_COMPS] / variance.sum(),
+    }
+
+
+# 增量PCA每个批次都截断到 n_comps 个主成分，只是近似，容差放宽
+INCREMENTAL_RTOL = 5e-2
+
+
+def _assert_close(result: dict, expected: dict, rtol: float):
+    for key in ['variance', 'variance_ratio']:
+        np.testing.assert_allclose(result[key], expected[key], rtol=rtol)
+    np.testing.assert_allclose(result['components'], expected['components'], atol=rtol)
+    scale = np.abs(expected['X_pca']).max()
+    np.testing.assert_allclose(result['X_pca'] / scale, expected['X_pca'] / scale, atol=rtol)
+
+
+def test_randomized_matches_exact_without_densifying():
+    X = _matrix()
+    before = X.copy()
+    result = randomized_pca(X, n_comps=N_COMPS, random_state=0)
+    _assert_close(result, _exact_pca(X), rtol=1e-3)
+    assert result['X_pca'].dtype == np.float32
+    # 输入矩阵保持稀疏且未被修改
+    assert (X != before).nnz == 0
+
+
+def test_incremental_matches_exact():
+    X = _matrix()
+
+    def chunks():
+        for start in range(0, X.shape[0], 100):
+            yield X[start:start + 100]
+
+    _assert_close(incremental_pca(chunks, n_comps=N_COMPS, batch_size=200), _exact_pca(X), rtol=INCREMENTAL_RTOL)
+
+
+@pytest.mark.parametrize("n_obs", [603, 650, 6])
+def test_incremental_fits_every_cell(monkeypatch, n_obs):
+    from sklearn.decomposition import IncrementalPCA
+
+    X = _matrix(n_obs=n_obs)
+    batch_sizes = []
+    partial_fit = IncrementalPCA.partial_fit
+
+    def record(self, X, *args, **kwargs):
+        batch_sizes.append(X.shape[0])
+        return partial_fit(self, X, *args, **kwargs)
+
+    monkeypatch.setattr(IncrementalPCA, "partial_fit", record)
+
+    def chunks():
+        for start in range(0, X.shape[0], 100):
+            yield X[start:start + 100]
+
+    result = incremental_pca(chunks, n_comps=N_COMPS, batch_size=200)
+    # 末尾不足 n_comps 个细胞的剩余部分并入前一个批次，而不是被丢弃
+    assert sum(batch_sizes) == n_obs
+    assert min(batch_sizes) >= N_COMPS
+    assert result['X_pca'].shape == (n_obs, N_COMPS)
+
+
+def test_run_pca_highly_variable_mask():
+    X = _matrix()
+    adata = ad.AnnData(X)
+    hvg = np.zeros(adata.n_vars, dtype=bool)
+    hvg[::2] = True
+    adata.var['highly_variable'] = hvg
+
+    run_pca(adata, n_comps=N_COMPS, n_threads=1)
+    assert adata.obsm['X_pca'].shape == (adata.n_obs, N_COMPS)
+    assert adata.varm['PCs'].shape == (adata.n_vars, N_COMPS)
+    assert not adata.varm['PCs'][~hvg].any()
+    _assert_close(
+        {**adata.uns['pca'], 'X_pca': adata.obsm['X_pca'], 'components': adata.varm['PCs'][hvg].T},
+        _exact_pca(X[:, hvg]), rtol=1e-3
+    )
+    memory = adata.uns['pca']['memory']
+    assert memory['peak_rss_mb'] >= memory['rss_before_mb'] - 1
+
+
+def test_run_pca_backed_uses_incremental(tmp_path):
+    X = _matrix()
+    path = str(tmp_path / "backed.h5ad")
+    ad.AnnData(X).write_h5ad(path)
+    adata = ad.read_h5ad(path, backed='r')
+    try:
+        run_pca(adata, method='randomized', n_comps=N_COMPS, chunk_size=150, n_threads=1)
+        assert adata.uns['pca']['params']['method'] == 'incremental'
+        _assert_close(
+            {**adata.uns['pca'], 'X_pca': adata.obsm['X_pca'], 'components': adata.varm['PCs'].T},
+            _exact_pca(X), rtol=INCREMENTAL_RTOL
+        )
+    finally:
+        adata.file.close()
+
+
+def test_run_pca_rejects_unknown_method():
+    with pytest.raises(ValueError):
+        run_pca(ad.AnnData(_matrix()), method='arpack')
@@ -0,0 +1,194 @@
+import json
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.instrumentation import StageMonitor, read_metrics
+from app.analysis.pipeline_dag import STATE_FILE, DAGExecutor, PipelineState, Stage, StageFailed, run_fingerprint
+
+
+class _Recorder:
+    """记录阶段执行顺序，可指定失败的阶段"""
+
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail = set(fail)
+        self._lock = threading.Lock()
+
+    def __call__(self, name):
+        def func():
+            with self._lock:
+                self.calls.append(name)
+            return name not in self.fail
+        return func
+
+
+def _stages(recorder):
+    # load（未持久化） -> preprocess -> pca -> {clustering, export}
+    return [
+        Stage("load", recorder("load"), persistent=False),
+        Stage("preprocess", recorder("preprocess"), deps=["load"]),
+        Stage("pca", recorder("pca"), deps=["preprocess"]),
+        Stage("clustering", recorder("clustering"), deps=["pca"], weight=3.0),
+        Stage("export", recorder("export"), deps=["pca"]),
+    ]
+
+
+def test_runs_in_dependency_order_with_progress(tmp_path):
+    recorder = _Recorder()
+    progress, events = [], []
+    executor = DAGExecutor(
+        _stages(recorder), PipelineState(str(tmp_path), "fp"),
+        on_progress=progress.append,
+        on_stage_event=lambda stage, status, error: events.append((stage.name, status))
+    )
+    executor.run()
+    assert recorder.calls.index("load") < recorder.calls.index("preprocess") < recorder.calls.index("pca")
+    assert set(recorder.calls[3:]) == {"clustering", "export"}
+    assert progress[0] == 0 and progress[-1] == pytest.approx(1.0)
+    assert progress == sorted(progress)
+    assert ("clustering", "running") in events and ("clustering", "completed") in events
+    assert set(PipelineState(str(tmp_path), "fp").completed()) == set(recorder.calls)
+
+
+def test_independent_stages_run_concurrently(tmp_path):
+    # 两个阶段都要等对方开始后才能结束，串行执行会超时
+    barrier = threading.Barrier(2, timeout=5)
+    stages = [Stage("a", lambda: barrier.wait() is not None), Stage("b", lambda: barrier.wait() is not None)]
+    DAGExecutor(stages, PipelineState(str(tmp_path), "fp"), max_workers=2).run()
+
+
+def test_failure_then_resume(tmp_path):
+    failing = _Recorder(fail={"clustering"})
+    with pytest.raises(StageFailed) as info:
+        DAGExecutor(_stages(failing), PipelineState(str(tmp_path), "fp"), max_workers=1).run()
+    assert info.value.stage == "clustering"
+    with open(os.path.join(str(tmp_path), STATE_FILE)) as f:
+        assert json.load(f)["stages"]["clustering"]["status"] == "failed"
+
+    # 恢复时跳过已持久化的阶段；未持久化的 load 仅在有待执行阶段依赖它时才重新执行
+    recorder = _Recorder()
+    state = PipelineState(str(tmp_path), "fp")
+    executor = DAGExecutor(_stages(recorder), state)
+    to_run = executor.plan()
+    assert "preprocess" not in to_run and "pca" not in to_run and "clustering" in to_run
+    executor.run()
+    assert "preprocess" not in recorder.calls and "clustering" in recorder.calls
+
+    # 指纹变化（数据或配置不同）时全部重新执行
+    recorder = _Recorder()
+    DAGExecutor(_stages(recorder), PipelineState(str(tmp_path), "other")).run()
+    assert sorted(recorder.calls) == sorted(stage.name for stage in _stages(_Recorder()))
+
+
+def test_non_persistent_dependency_reruns(tmp_path):
+    state = PipelineState(str(tmp_path), "fp")
+    for name in ["load", "preprocess"]:
+        state.update(name, status="completed", persistent=name != "load")
+    executor = DAGExecutor(_stages(_Recorder()), PipelineState(str(tmp_path), "fp"))
+    # pca 依赖的 preprocess 已持久化，不需要重新加载数据
+    assert executor.plan() == {"pca", "clustering", "export"}
+
+    state.update("preprocess", status="completed", persistent=False)
+    assert DAGExecutor(_stages(_Recorder()), PipelineState(str(tmp_path), "fp")).plan() == {
+        "load", "preprocess", "pca", "clustering", "export"
+    }
+
+
+def test_unknown_dependency_and_callback_errors(tmp_path):
+    with pytest.raises(ValueError):
+        DAGExecutor([Stage("a", lambda: True, deps=["missing"])], PipelineState(str(tmp_path), "fp"))
+
+    def broken_callback(stage, status, error):
+        raise RuntimeError("callback")
+
+    # 事件回调失败不影响阶段执行
+    DAGExecutor([Stage("a", lambda: True)], PipelineState(str(tmp_path), "fp"),
+                on_stage_event=broken_callback).run()
+
+
+def test_run_fingerprint(tmp_path):
+    data = tmp_path / "data.h5ad"
+    data.write_bytes(b"data")
+    fingerprint = run_fingerprint(str(data), {"a": 1, "b": 2})
+    assert run_fingerprint(str(data), {"b": 2, "a": 1}) == fingerprint
+    assert run_fingerprint(str(data), {"a": 2, "b": 2}) != fingerprint
+
+
+def test_monitor_reports_elapsed_wall_time(tmp_path):
+    monitor = StageMonitor("task", output_path=str(tmp_path), sample_interval=0.05)
+    stages = [
+        Stage(name, lambda: time.sleep(0.3) is None) for name in ["a", "b", "c"]
+    ]
+    DAGExecutor(stages, PipelineState(str(tmp_path), "fp"), max_workers=3, monitor=monitor).run()
+    total = monitor.summary()["total"]
+    # 并发阶段的墙钟时间重叠，合计为经过的时间而不是各阶段之和
+    assert total["stage_wall_seconds"] >= 0.9
+    assert total["wall_seconds"] < total["stage_wall_seconds"]
+    assert [stage["status"] for stage in monitor.stages] == ["completed"] * 3
+
+
+def test_prefetch_only_when_load_runs(tmp_path):
+    pytest.importorskip("scanpy")
+    from app.analysis.run_analysis import _needs_load, pipeline_stages
+
+    data = tmp_path / "data.h5ad"
+    data.write_bytes(b"data")
+    config = {"cell_annotation": {"enabled": True}, "output": {"export_h5ad": True}}
+    dataset = {"data_path": str(data), "output_path": str(tmp_path / "out"), "config": config}
+    stages = pipeline_stages(config)
+    assert [stage.name for stage in stages] == [
+        "load", "preprocess", "pca", "clustering", "cell_annotation", "plots", "viz_export", "report", "export_h5ad"
+    ]
+    assert stages[4].deps == ["clustering"] and stages[5].deps == ["cell_annotation"]
+
+    # 首次运行与不恢复时需要加载数据
+    assert _needs_load(dataset, resume=True)
+    state = PipelineState(dataset["output_path"], run_fingerprint(str(data), config))
+    os.makedirs(dataset["output_path"])
+    for stage in stages[:3]:
+        state.update(stage.name, status="completed", persistent=stage.persistent)
+    # 从检查点恢复（pca已持久化）时不加载；全部完成时也不加载
+    assert not _needs_load(dataset, resume=True)
+    assert _needs_load(dataset, resume=False)
+    for stage in stages[3:]:
+        state.update(stage.name, status="completed", persistent=stage.persistent)
+    assert not _needs_load(dataset, resume=True)
+
+    # 配置变化后指纹不同，重新加载
+    changed = dict(dataset, config=dict(config, pca_params={"n_comps": 20}))
+    assert _needs_load(changed, resume=True)
+
+
+def test_monitor_merges_previous_metrics_on_resume(tmp_path):
+    first = StageMonitor("task", output_path=str(tmp_path), sample_interval=0.05)
+    with pytest.raises(StageFailed):
+        DAGExecutor(_stages(_Recorder(fail={"clustering"})), PipelineState(str(tmp_path), "fp"), max_workers=1,
+                    monitor=first).run()
+    first_stages = [stage["stage"] for stage in read_metrics(str(tmp_path))["stages"]]
+    assert "clustering" in first_stages
+
+    # 恢复运行只执行剩余阶段，metrics.json 保留之前运行的阶段记录
+    resumed = StageMonitor("task", output_path=str(tmp_path), sample_interval=0.05, resume=True)
+    DAGExecutor(_stages(_Recorder()), PipelineState(str(tmp_path), "fp"), monitor=resumed).run()
+    metrics = read_metrics(str(tmp_path))
+    assert [stage["stage"] for stage in metrics["stages"]][:len(first_stages)] == first_stages
+    resumed_stages = {stage["stage"] for stage in resumed.stages}
+    assert "clustering" in resumed_stages and "preprocess" not in resumed_stages
+    assert metrics["started_at"] == first.started_at
+    assert metrics["total"]["stage_wall_seconds"] == pytest.approx(
+        sum(stage["wall_seconds"] for stage in metrics["stages"])
+    )
+
+    # 丢弃之前的指标（全部阶段重新执行）或不恢复时只记录本次运行
+    resumed.discard_previous()
+    assert resumed.summary()["stages"] == resumed.stages
+    StageMonitor("task", output_path=str(tmp_path)).save()
+    assert read_metrics(str(tmp_path))["stages"] == []
+    assert StageMonitor("task", output_path=str(tmp_path / "missing"), resume=True).summary()["stages"] == []
@@ -0,0 +1,186 @@
+import asyncio
+import json
+import os
+import sys
+
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.progress_log import (ProgressBroadcaster, ProgressLog, last_event, orphaned_event,
+                                       progress_log_path, read_events)
+
+
+def test_append_and_incremental_read(tmp_path):
+    log = ProgressLog(str(tmp_path), "task")
+    path = progress_log_path(str(tmp_path))
+    log.append("running", 0.1, stage="load", stage_status="running", error=None)
+
+    events, offset = read_events(path)
+    assert offset == os.path.getsize(path)
+    assert [(end, event["stage"]) for end, event in events] == [(offset, "load")]
+    assert "error" not in events[0][1]
+
+    # 写了一半的行不会被读取，偏移停在最后一个完整行之后；无法解析的行被跳过
+    with open(path, "ab") as f:
+        f.write(b"not json\n" + json.dumps({"status": "running", "progress": 0.5}).encode())
+    events, new_offset = read_events(path, offset)
+    assert events == [] and new_offset == offset + len(b"not json\n")
+    with open(path, "ab") as f:
+        f.write(b"\n")
+    events, final_offset = read_events(path, new_offset)
+    assert [event["progress"] for _, event in events] == [0.5]
+    assert final_offset == os.path.getsize(path)
+    assert last_event(path)["progress"] == 0.5
+
+    assert read_events(str(tmp_path / "missing.jsonl"), 7) == ([], 7)
+    assert last_event(str(tmp_path / "missing.jsonl")) is None
+
+
+def test_orphaned_event():
+    running = {"task_id": "t", "status": "running", "progress": 0.4, "stage": "pca"}
+    orphan = orphaned_event(running, {"status": "failed", "error": "OOM"})
+    assert orphan["status"] == "failed" and orphan["progress"] == 0.4 and orphan["stage"] == "pca"
+    assert "OOM" in orphan["error"]
+
+    assert orphaned_event(running, {"status": "running"}) is None
+    assert orphaned_event(running, None) is None
+    assert orphaned_event({"status": "completed", "progress": 1.0}, {"status": "completed"}) is None
+
+
+async def _collect(subscription, limit: int = 20):
+    items = []
+    async for item in subscription:
+        if item is not None:
+            items.append(item)
+        if len(items) >= limit:
+            break
+    return items
+
+
+def test_broadcaster_shares_one_tail(tmp_path):
+    async def scenario():
+        log = ProgressLog(str(tmp_path), "task")
+        path = progress_log_path(str(tmp_path))
+        log.append("running", 0.0, stage="load")
+        broadcaster = ProgressBroadcaster(poll_interval=0.01)
+
+        first = asyncio.create_task(_collect(broadcaster.subscribe(path, heartbeat=0.05)))
+        second = asyncio.create_task(_collect(broadcaster.subscribe(path, heartbeat=0.05)))
+        await asyncio.sleep(0.05)
+        assert len(broadcaster._tails) == 1
+        log.append("running", 0.5, stage="pca")
+        log.append("completed", 1.0)
+        results = await asyncio.wait_for(asyncio.gather(first, second), 5)
+
+        assert results[0] == results[1]
+        assert [event["status"] for _, event in results[0]] == ["running", "running", "completed"]
+        # 所有订阅者离开后释放该任务的读取状态
+        assert broadcaster._tails == {}
+
+        # 从最后收到的事件ID（偏移）重连，只收到之后的事件
+        resumed = await asyncio.wait_for(
+            _collect(broadcaster.subscribe(path, offset=results[0][1][0], heartbeat=0.05)), 5
+        )
+        assert [event["status"] for _, event in resumed] == ["completed"]
+
+    asyncio.run(scenario())
+
+
+def test_broadcaster_fallback_before_log(tmp_path):
+    statuses = iter([{"status": "pending", "progress": 0}, {"status": "cancelled", "progress": 0}])
+
+    async def fallback():
+        return next(statuses)
+
+    async def scenario():
+        broadcaster = ProgressBroadcaster(poll_interval=0.01, fallback_interval=0.02)
+        path = progress_log_path(str(tmp_path))
+        return await asyncio.wait_for(_collect(broadcaster.subscribe(path, heartbeat=0.05, fallback=fallback)), 5)
+
+    items = asyncio.run(scenario())
+    assert [(offset, event["status"]) for offset, event in items] == [(None, "pending"), (None, "cancelled")]
+
+
+def test_broadcaster_reports_killed_job(tmp_path):
+    calls = []
+
+    async def fallback():
+        calls.append(1)
+        return {"status": "failed", "progress": 0, "error": "killed"}
+
+    async def scenario():
+        ProgressLog(str(tmp_path), "task").append("running", 0.3, stage="pca")
+        broadcaster = ProgressBroadcaster(poll_interval=0.01, fallback_interval=0.05)
+        path = progress_log_path(str(tmp_path))
+        return await asyncio.wait_for(_collect(broadcaster.subscribe(path, heartbeat=0.05, fallback=fallback)), 5)
+
+    items = asyncio.run(scenario())
+    assert [event["status"] for _, event in items] == ["running", "failed"]
+    assert items[-1][0] is None
+    assert items[-1][1]["stage"] == "pca" and "killed" in items[-1][1]["error"]
+    assert len(calls) == 1
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    pytest.importorskip("aiohttp")
+    from app.hpc import scheduler as scheduler_module
+
+    instance = scheduler_module.HPCScheduler()
+    instance.queries = []
+    instance.job_status = {"status": "running", "progress": 0}
+
+    async def query(task_id):
+        instance.queries.append(task_id)
+        return dict(instance.job_status)
+
+    monkeypatch.setattr(instance, "_query_job_status", query)
+    monkeypatch.setattr(scheduler_module.settings, "HPC_STATUS_CACHE_SECONDS", 60.0)
+    return instance
+
+
+def test_get_job_status_prefers_log(tmp_path, scheduler):
+    log = ProgressLog(str(tmp_path), "task")
+    output_path = str(tmp_path)
+
+    # 日志尚未出现时返回调度器状态
+    scheduler.job_status = {"status": "pending", "progress": 0}
+    assert asyncio.run(scheduler.get_job_status("task", output_path))["status"] == "pending"
+
+    # 运行中：以日志为准，调度器查询结果被缓存
+    log.append("running", 0.4, stage="pca")
+    scheduler.job_status = {"status": "running", "progress": 0}
+    for _ in range(3):
+        status = asyncio.run(scheduler.get_job_status("task", output_path))
+        assert (status["status"], status["progress"], status["stage"]) == ("running", 0.4, "pca")
+    assert len(scheduler.queries) == 1
+
+    # 结束事件之后不再查询调度器
+    log.append("completed", 1.0)
+    scheduler._status_cache.clear()
+    status = asyncio.run(scheduler.get_job_status("task", output_path))
+    assert status["status"] == "completed" and status["result"]
+    assert len(scheduler.queries) == 1
+
+
+def test_get_job_status_reports_killed_job(tmp_path, scheduler):
+    ProgressLog(str(tmp_path), "task").append("running", 0.4, stage="pca")
+    scheduler.job_status = {"status": "failed", "progress": 0, "error": "OOM"}
+    status = asyncio.run(scheduler.get_job_status("task", str(tmp_path)))
+    assert status["status"] == "failed" and status["stage"] == "pca" and "OOM" in status["error"]
+
+
+def test_status_cache_is_bounded(scheduler, monkeypatch):
+    from app.hpc import scheduler as scheduler_module
+
+    monkeypatch.setattr(scheduler_module, "_STATUS_CACHE_MAX_ENTRIES", 3)
+    for i in range(10):
+        asyncio.run(scheduler.get_job_status(f"task{i}"))
+    assert list(scheduler._status_cache) == ["task7", "task8", "task9"]
+
+    # 过期条目在下一次查询时被淘汰
+    monkeypatch.setattr(scheduler_module.settings, "HPC_STATUS_CACHE_SECONDS", 0.0)
+    asyncio.run(scheduler.get_job_status("task9"))
+    assert list(scheduler._status_cache) == []
@@ -0,0 +1,68 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.rank_markers import rank_genes_groups
+
+sc = pytest.importorskip("scanpy")
+ad = pytest.importorskip("anndata")
+
+
+def _adata(sparse: bool, seed: int = 0):
+    """含负值、大量零值与并列值的log标准化数据，3个大小不等的簇"""
+    rng = np.random.default_rng(seed)
+    n_obs, n_vars = 300, 40
+    counts = rng.poisson(0.6, size=(n_obs, n_vars)).astype(np.float32)
+    labels = np.repeat(["a", "b", "c"], [150, 100, 50])
+    counts[labels == "b", :5] += 3
+    X = np.log1p(counts)
+    X[:, -1] = -X[:, -1]
+    adata = ad.AnnData(sp.csr_matrix(X) if sparse else X)
+    adata.var_names = [f"g{i}" for i in range(n_vars)]
+    adata.obs["leiden"] = labels
+    adata.obs["leiden"] = adata.obs["leiden"].astype("category")
+    adata.uns["log1p"] = {"base": None}
+    return adata
+
+
+def _by_gene(result, field, group):
+    return dict(zip(result["names"][group], result[field][group]))
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+def test_matches_scanpy_wilcoxon(sparse):
+    adata = _adata(sparse)
+    expected = adata.copy()
+    sc.tl.rank_genes_groups(expected, "leiden", method="wilcoxon", tie_correct=True, n_genes=adata.n_vars)
+    expected = expected.uns["rank_genes_groups"]
+
+    # 块大小小于基因数，覆盖多线程分块
+    result = rank_genes_groups(adata, "leiden", n_threads=2, block_size=7)
+    assert adata.uns["rank_genes_groups"] is result
+
+    for group in ["a", "b", "c"]:
+        for field, rtol in [("scores", 1e-4), ("pvals", 1e-4), ("pvals_adj", 1e-4), ("logfoldchanges", 1e-3)]:
+            ours = _by_gene(result, field, group)
+            theirs = _by_gene(expected, field, group)
+            genes = sorted(theirs)
+            np.testing.assert_allclose(
+                [ours[g] for g in genes], [theirs[g] for g in genes], rtol=rtol, atol=1e-6,
+                err_msg=f"{group} {field}"
+            )
+        # 排名按得分降序
+        scores = np.asarray(result["scores"][group])
+        assert np.all(np.diff(scores) <= 1e-6)
+
+
+def test_top_n_genes_and_planted_markers():
+    adata = _adata(sparse=True)
+    result = rank_genes_groups(adata, "leiden", n_genes=5)
+    assert len(result["names"]) == 5
+    assert set(result["names"]["b"]) == {f"g{i}" for i in range(5)}
+    assert result["params"]["groupby"] == "leiden"
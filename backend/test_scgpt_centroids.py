@@ -0,0 +1,87 @@
+import os
+import sys
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+torch = pytest.importorskip("torch")
+
+from app.models import scgpt_integration
+from app.models.scgpt_integration import ScGPTModel
+
+VOCAB = {"<pad>": 0, "<cls>": 1, "CD3D": 2, "CD3E": 3, "CD19": 4, "MS4A1": 5}
+
+
+class _Tokenizer:
+    vocab = VOCAB
+
+    def convert_tokens_to_ids(self, gene):
+        return VOCAB[gene]
+
+
+class _Model:
+    """只提供输入嵌入层的模型替身，记录嵌入层被取用的次数"""
+
+    def __init__(self, weight):
+        self.embedding = torch.nn.Embedding.from_pretrained(weight)
+        self.calls = 0
+
+    def get_input_embeddings(self):
+        self.calls += 1
+        return self.embedding
+
+
+def _model():
+    weight = torch.tensor(np.random.default_rng(0).standard_normal((len(VOCAB), 8)), dtype=torch.float32)
+    model = object.__new__(ScGPTModel)
+    model.device = torch.device("cpu")
+    model.model = _Model(weight)
+    model.tokenizer = _Tokenizer()
+    model._centroid_cache = OrderedDict()
+    return model, weight.numpy()
+
+
+def _normalize(vector):
+    return vector / np.linalg.norm(vector)
+
+
+def test_weighted_centroids():
+    model, weight = _model()
+    centroids = model.marker_centroids({
+        "T": ["CD3D", "CD3E", "UNKNOWN"],
+        "B": {"CD19": 3.0, "MS4A1": 1.0},
+        "none": ["UNKNOWN"],
+    }).numpy()
+    assert centroids.shape == (3, 8)
+    # 列表为等权平均，字典按权重加权；不在词汇表中的基因忽略；没有marker的类型为零向量
+    np.testing.assert_allclose(centroids[0], _normalize(weight[2] + weight[3]), rtol=1e-5)
+    np.testing.assert_allclose(centroids[1], _normalize(0.75 * weight[4] + 0.25 * weight[5]), rtol=1e-5)
+    np.testing.assert_array_equal(centroids[2], np.zeros(8))
+
+
+def test_centroid_cache_hit_and_lru_eviction(monkeypatch):
+    monkeypatch.setattr(scgpt_integration, "_MAX_CENTROID_SETS", 3)
+    model, _ = _model()
+    markers = {"T": ["CD3D"], "B": ["CD19"]}
+    first = model.marker_centroids(markers)
+    # 相同的marker集合（新建的等价字典）命中缓存，不再计算
+    assert model.marker_centroids({"T": ["CD3D"], "B": ["CD19"]}) is first
+    assert model.model.calls == 1
+    # 权重不同即为不同的集合
+    assert model.marker_centroids({"T": {"CD3D": 2.0}, "B": ["CD19"]}) is not first
+    assert model.model.calls == 2
+
+    model.marker_centroids({"T": ["CD3E"]})
+    # 再次使用第一个集合，使其成为最近使用；之后加入新集合时淘汰最久未使用的集合
+    assert model.marker_centroids(markers) is first
+    model.marker_centroids({"B": ["MS4A1"]})
+    assert len(model._centroid_cache) == 3
+    calls = model.model.calls
+    assert model.marker_centroids(markers) is first
+    assert model.model.calls == calls
+    model.marker_centroids({"T": {"CD3D": 2.0}, "B": ["CD19"]})
+    assert model.model.calls == calls + 1
@@ -0,0 +1,91 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.sketch import geometric_sketch, project_embedding, propagate_labels
+
+ad = pytest.importorskip("anndata")
+
+
+def _clusters(seed: int = 0):
+    """一个5000细胞的密集群和两个50细胞的稀有群，返回 (PCA坐标, 真实标签)"""
+    rng = np.random.default_rng(seed)
+    centers = np.zeros((3, 10))
+    centers[1, 0], centers[2, 1] = 20.0, 20.0
+    sizes = [5000, 50, 50]
+    X = np.vstack([center + rng.standard_normal((size, 10)) for center, size in zip(centers, sizes)])
+    labels = np.repeat(["common", "rare1", "rare2"], sizes)
+    return X.astype(np.float32), labels
+
+
+def test_geometric_sketch_size_and_determinism():
+    X, _ = _clusters()
+    idx = geometric_sketch(X, 300, random_state=1)
+    assert len(idx) == 300
+    assert len(np.unique(idx)) == 300
+    assert np.all(np.diff(idx) > 0)
+    np.testing.assert_array_equal(idx, geometric_sketch(X, 300, random_state=1))
+    # 抽样数不少于细胞数时返回全部细胞
+    np.testing.assert_array_equal(geometric_sketch(X[:100], 100), np.arange(100))
+
+
+def test_geometric_sketch_keeps_rare_populations():
+    X, labels = _clusters()
+    idx = geometric_sketch(X, 200)
+    # 均匀抽样时每个稀有群期望不到2个细胞
+    for rare in ["rare1", "rare2"]:
+        assert np.sum(labels[idx] == rare) >= 10
+
+
+def test_propagate_labels_weighted_vote():
+    sketch_obs = pd.DataFrame({"leiden": pd.Categorical(["0", "1", "1"], categories=["0", "1", "2"])})
+    indices = np.array([[0, 1, 2], [1, 2, 0]])
+    # 第一个查询细胞离"0"很近，距离加权后"0"胜过两个较远的"1"
+    distances = np.array([[0.01, 1.0, 1.0], [0.5, 0.5, 0.6]])
+    labels, confidence = propagate_labels(sketch_obs, indices, distances, ["leiden"])
+    assert list(labels["leiden"]) == ["0", "1"]
+    assert list(labels["leiden"].cat.categories) == ["0", "1", "2"]
+    assert confidence["leiden"][0] > 0.9
+    assert 0.5 < confidence["leiden"][1] < 1.0
+
+
+def test_project_embedding_weighted_mean():
+    embedding = np.array([[0.0, 0.0], [2.0, 2.0]])
+    projected = project_embedding(embedding, np.array([[0, 1], [0, 1]]), np.array([[1.0, 1.0], [0.0, 10.0]]))
+    np.testing.assert_allclose(projected[0], [1.0, 1.0], atol=1e-5)
+    np.testing.assert_allclose(projected[1], [0.0, 0.0], atol=1e-5)
+
+
+def test_sketch_and_propagate_back_to_all_cells(tmp_path):
+    from app.analysis.sc_analysis import SingleCellAnalysis
+
+    X_pca, truth = _clusters()
+    adata = ad.AnnData(np.zeros((len(truth), 5), dtype=np.float32))
+    adata.obsm["X_pca"] = X_pca
+
+    analysis = SingleCellAnalysis("unused.h5ad", str(tmp_path), store_format="h5ad")
+    analysis.adata = adata
+    assert analysis.sketch(n_sketch=300)
+    sketch_idx = analysis.sketch_idx
+    assert analysis.adata.n_obs == 300
+    assert analysis.full_adata is adata
+
+    # 代替聚类与UMAP：在抽样细胞上写入真实标签与坐标
+    analysis.adata.obs["leiden"] = pd.Categorical(truth[sketch_idx])
+    analysis.adata.obsm["X_umap"] = analysis.adata.obsm["X_pca"][:, :2]
+    assert analysis.propagate_sketch(n_neighbors=5, backend="exact", n_threads=1)
+
+    full = analysis.adata
+    assert full is adata and analysis.full_adata is None
+    np.testing.assert_array_equal(full.obs["leiden"].astype(str).to_numpy(), truth)
+    assert full.obs["in_sketch"].sum() == 300
+    assert np.all(full.obs["sketch_label_confidence"].to_numpy()[sketch_idx] == 1)
+    assert full.obsm["X_umap"].shape == (len(truth), 2)
+    np.testing.assert_array_equal(full.obsm["X_umap"][sketch_idx], X_pca[sketch_idx, :2])
+    assert full.uns["sketch"]["agreement"]["leiden"] == 1.0
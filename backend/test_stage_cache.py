@@ -0,0 +1,114 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.stage_cache import StageCache, dataset_digest
+
+ad = pytest.importorskip("anndata")
+
+STAGES = [
+    ("preprocess", {"min_genes": 200, "n_top_genes": 2000}),
+    ("pca", {"n_comps": 50}),
+    ("clustering", {"resolution": 1.0}),
+    ("annotation", {"method": "marker"}),
+]
+
+
+def _adata(n_obs: int = 20):
+    adata = ad.AnnData(sp.random(n_obs, 10, density=0.3, format="csr", dtype=np.float32, random_state=0))
+    adata.obs["leiden"] = (np.arange(n_obs) % 2).astype(str)
+    return adata
+
+
+def test_stage_keys_chain():
+    keys = StageCache.stage_keys("data", STAGES)
+    assert list(keys) == [name for name, _ in STAGES]
+    assert len(set(keys.values())) == len(STAGES)
+    # 参数字典的键顺序不影响结果
+    reordered = [(name, dict(reversed(list(params.items())))) for name, params in STAGES]
+    assert StageCache.stage_keys("data", reordered) == keys
+
+    # 修改某一阶段参数只使该阶段及之后的键失效
+    changed = list(STAGES)
+    changed[2] = ("clustering", {"resolution": 0.5})
+    changed_keys = StageCache.stage_keys("data", changed)
+    assert [changed_keys[name] == keys[name] for name, _ in STAGES] == [True, True, False, False]
+
+    # 输入数据变化使所有键失效
+    other = StageCache.stage_keys("other", STAGES)
+    assert not set(other.values()) & set(keys.values())
+
+
+def test_dataset_digest_file_directory_and_memo(tmp_path):
+    data_dir = tmp_path / "10x"
+    data_dir.mkdir()
+    (data_dir / "matrix.mtx").write_bytes(b"matrix")
+    (data_dir / "genes.tsv").write_bytes(b"genes")
+    memo_file = str(tmp_path / "digests.json")
+
+    digest = dataset_digest(str(data_dir), memo_file=memo_file)
+    with open(memo_file) as f:
+        assert len(json.load(f)) == 2
+    assert dataset_digest(str(data_dir), memo_file=memo_file) == digest
+
+    # 内容变化（大小或修改时间随之变化）得到新的哈希
+    (data_dir / "genes.tsv").write_bytes(b"genes2")
+    assert dataset_digest(str(data_dir), memo_file=memo_file) != digest
+    assert dataset_digest(str(data_dir / "matrix.mtx")) != digest
+
+
+def test_save_load_and_latest_hit(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    keys = StageCache.stage_keys("data", STAGES)
+    assert cache.latest_hit(keys) is None
+
+    adata = _adata()
+    cache.save(keys["preprocess"], adata, "preprocess")
+    cache.save(keys["clustering"], adata, "clustering")
+    assert cache.latest_hit(keys) == "clustering"
+
+    loaded = cache.load(keys["clustering"])
+    assert (loaded.X != adata.X).nnz == 0
+    assert list(loaded.obs["leiden"]) == list(adata.obs["leiden"])
+    assert not any(name.endswith(".tmp") for name in os.listdir(cache.cache_dir))
+
+
+def test_save_backed_keeps_source_file(tmp_path):
+    path = str(tmp_path / "backed.h5ad")
+    _adata().write_h5ad(path)
+    backed = ad.read_h5ad(path, backed="r")
+    try:
+        cache = StageCache(str(tmp_path / "cache"))
+        cache.save("key", backed, "preprocess")
+        # 写入缓存后backed对象仍指向原文件
+        assert os.path.samefile(backed.filename, path)
+        assert cache.load("key").n_obs == backed.n_obs
+    finally:
+        backed.file.close()
+
+
+def test_evict_by_size_and_age(tmp_path):
+    cache = StageCache(str(tmp_path / "cache"))
+    for i, key in enumerate(["old", "mid", "new"]):
+        cache.save(key, _adata(), "stage")
+        os.utime(cache._entry_path(key), (time.time() - 100 + i, time.time() - 100 + i))
+    entry_size = os.path.getsize(cache._entry_path("new"))
+
+    # 超出总大小时先淘汰最久未使用的条目
+    cache.max_size_bytes = 2 * entry_size + entry_size // 2
+    cache.evict()
+    assert [cache.contains(key) for key in ["old", "mid", "new"]] == [False, True, True]
+
+    cache.max_size_bytes = None
+    cache.max_age_seconds = 10
+    os.utime(cache._entry_path("new"))
+    cache.evict()
+    assert [cache.contains(key) for key in ["mid", "new"]] == [False, True]
@@ -0,0 +1,120 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.stage_store import StageStore
+
+ad = pytest.importorskip("anndata")
+pytest.importorskip("zarr")
+
+
+def _adata():
+    adata = ad.AnnData(sp.random(30, 12, density=0.3, format="csr", dtype=np.float32, random_state=0))
+    adata.obs_names = [f"c{i}" for i in range(30)]
+    adata.var_names = [f"g{i}" for i in range(12)]
+    return adata
+
+
+def _matrix_files(path):
+    """表达矩阵在Zarr存储中的文件及修改时间"""
+    root = os.path.join(path, "X")
+    return {
+        os.path.join(dirpath, name): os.stat(os.path.join(dirpath, name)).st_mtime_ns
+        for dirpath, _, names in os.walk(root) for name in names
+    }
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_full_then_incremental_slots(tmp_path, background):
+    path = str(tmp_path / "analysis.zarr")
+    store = StageStore(path, background=background)
+    adata = _adata()
+    store.write_full(adata, "preprocess")
+    store.flush()
+    matrix_files = _matrix_files(path)
+    assert matrix_files
+
+    adata.obs["leiden"] = pd.Categorical((np.arange(30) % 3).astype(str))
+    adata.obsm["X_umap"] = np.arange(60, dtype=np.float32).reshape(30, 2)
+    adata.uns["leiden"] = {"params": {"resolution": 1.0}}
+    store.write_slots(adata, "clustering", obs=True, obsm=["X_umap", "missing"], uns=["leiden"])
+    store.close()
+
+    result = StageStore(path).read()
+    assert (result.X != adata.X).nnz == 0
+    assert list(result.obs["leiden"]) == list(adata.obs["leiden"])
+    np.testing.assert_array_equal(result.obsm["X_umap"], adata.obsm["X_umap"])
+    assert result.uns["leiden"]["params"]["resolution"] == 1.0
+    # 增量写入不重写表达矩阵
+    assert _matrix_files(path) == matrix_files
+
+
+def test_background_write_uses_snapshot(tmp_path):
+    path = str(tmp_path / "analysis.zarr")
+    store = StageStore(path, background=True)
+    adata = _adata()
+    store.write_full(adata, "preprocess")
+    # 写线程使用快照，之后修改obs与obsm不影响已提交的写入
+    adata.obs["later"] = 1
+    adata.obsm["X_later"] = np.zeros((30, 2))
+    store.close()
+
+    result = ad.read_zarr(path)
+    assert "later" not in result.obs
+    assert "X_later" not in result.obsm
+
+
+def test_slots_before_full_write_full(tmp_path):
+    path = str(tmp_path / "analysis.zarr")
+    adata = _adata()
+    adata.obs["leiden"] = "0"
+    StageStore(path).write_slots(adata, "clustering", obs=True)
+    result = ad.read_zarr(path)
+    assert result.shape == adata.shape
+    assert list(result.obs["leiden"]) == ["0"] * 30
+
+
+def test_background_error_is_raised(tmp_path):
+    # 存储路径是普通文件，写入失败
+    path = tmp_path / "analysis.zarr"
+    path.write_text("not a store")
+    store = StageStore(str(path), background=True)
+    store.write_full(_adata(), "preprocess")
+    with pytest.raises(Exception):
+        store.flush()
+    with pytest.raises(Exception):
+        store.write_full(_adata(), "pca")
+    with pytest.raises(Exception):
+        store.close()
+
+
+def test_export_h5ad_from_store(tmp_path):
+    path = str(tmp_path / "analysis.zarr")
+    store = StageStore(path)
+    adata = _adata()
+    store.write_full(adata, "preprocess")
+    h5ad_path = str(tmp_path / "result.h5ad")
+    store.export_h5ad(h5ad_path)
+    assert (ad.read_h5ad(h5ad_path).X != adata.X).nnz == 0
+
+
+def test_export_backed_keeps_source_file(tmp_path):
+    source = str(tmp_path / "source.h5ad")
+    _adata().write_h5ad(source)
+    backed = ad.read_h5ad(source, backed="r")
+    try:
+        store = StageStore(str(tmp_path / "analysis.zarr"))
+        h5ad_path = str(tmp_path / "result.h5ad")
+        store.export_h5ad(h5ad_path, backed)
+        # 导出不改变backed对象指向的文件，并发读取它的阶段不受影响
+        assert os.path.abspath(backed.filename) == os.path.abspath(source)
+        assert (ad.read_h5ad(h5ad_path).X != backed.X[:]).nnz == 0
+    finally:
+        backed.file.close()
@@ -0,0 +1,182 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.models.tokenization import iter_token_batches, token_lengths, tokenize_csr, vocab_lookup
+
+PAD_ID, CLS_ID = 0, 1
+
+
+def _data(n_cells: int = 50, n_genes: int = 40, seed: int = 0):
+    """含并列表达值、不在词汇表中的基因与空细胞的计数矩阵"""
+    rng = np.random.default_rng(seed)
+    X = rng.poisson(rng.uniform(0.05, 1.5, size=(n_cells, 1)), size=(n_cells, n_genes)).astype(np.float32)
+    X[3] = 0
+    genes = [f"g{i}" for i in range(n_genes)]
+    # 每第5个基因不在词汇表中
+    vocab = {gene: i + 2 for i, gene in enumerate(genes) if i % 5}
+    return sp.csr_matrix(X), genes, vocab
+
+
+def _reference(X: sp.csr_matrix, vocab_ids: np.ndarray, max_length: int, leading_ids=()):
+    """逐个细胞的参考实现：[CLS] + 固定基因 + 按表达量降序（并列时按列顺序）的表达基因"""
+    cells = []
+    for row in X.toarray():
+        expressed = [(j, value) for j, value in enumerate(row) if value > 0 and vocab_ids[j] >= 0]
+        leading_values = [dict((vocab_ids[j], value) for j, value in expressed).get(i, 0.0) for i in leading_ids]
+        expressed = [(j, value) for j, value in expressed if vocab_ids[j] not in leading_ids]
+        expressed.sort(key=lambda item: -item[1])
+        ids = [CLS_ID, *leading_ids, *(vocab_ids[j] for j, _ in expressed)][:max_length]
+        values = [0.0, *leading_values, *(value for _, value in expressed)][:max_length]
+        cells.append((ids, values))
+    return cells
+
+
+def _assert_matches_reference(tokens, reference, length: int):
+    assert tokens['input_ids'].shape == (len(reference), length)
+    for i, (ids, values) in enumerate(reference):
+        n = len(ids)
+        np.testing.assert_array_equal(tokens['input_ids'][i, :n], ids)
+        np.testing.assert_array_equal(tokens['input_ids'][i, n:], PAD_ID)
+        np.testing.assert_allclose(tokens['values'][i, :n], values)
+        np.testing.assert_array_equal(tokens['values'][i, n:], 0)
+        np.testing.assert_array_equal(tokens['attention_mask'][i], np.arange(length) < n)
+
+
+def test_vocab_lookup():
+    np.testing.assert_array_equal(vocab_lookup(["a", "x", "b"], {"a": 5, "b": 7}), [5, -1, 7])
+
+
+@pytest.mark.parametrize("max_length", [8, 64])
+def test_tokenize_csr_order_and_truncation(max_length):
+    X, genes, vocab = _data()
+    vocab_ids = vocab_lookup(genes, vocab)
+    tokens = tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=max_length)
+    assert tokens['input_ids'].dtype == np.int64
+    assert tokens['values'].dtype == np.float32
+    _assert_matches_reference(tokens, _reference(X, vocab_ids, max_length), max_length)
+    # 稠密输入得到相同结果
+    dense = tokenize_csr(X.toarray(), vocab_ids, CLS_ID, PAD_ID, max_length=max_length)
+    for key in tokens:
+        np.testing.assert_array_equal(dense[key], tokens[key])
+
+
+def test_tokenize_csr_leading_ids():
+    X, genes, vocab = _data()
+    vocab_ids = vocab_lookup(genes, vocab)
+    leading = [vocab["g1"], vocab["g7"]]
+    tokens = tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=12, leading_ids=leading)
+    _assert_matches_reference(tokens, _reference(X, vocab_ids, 12, leading), 12)
+    # 固定基因在未表达的细胞中也出现，并计入注意力
+    assert np.all(tokens['input_ids'][:, 1:3] == leading)
+    assert np.all(tokens['attention_mask'][:, :3] == 1)
+
+    with pytest.raises(ValueError):
+        tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=2, leading_ids=leading)
+
+
+class _CountingMatrix:
+    """记录被读取的行块，检查后台线程不会提前读取超过prefetch个批次"""
+
+    def __init__(self, X):
+        self.X = X
+        self.shape = X.shape
+        self.reads = []
+
+    def __getitem__(self, rows):
+        self.reads.append(rows)
+        return self.X[rows]
+
+
+def _dynamic(X, vocab_ids, rows, max_length=64):
+    return tokenize_csr(X[rows], vocab_ids, CLS_ID, PAD_ID, max_length=max_length, dynamic_padding=True)
+
+
+@pytest.mark.parametrize("num_workers", [1, 3])
+def test_iter_token_batches_in_order(num_workers):
+    X, genes, vocab = _data(n_cells=103)
+    vocab_ids = vocab_lookup(genes, vocab)
+    batches = list(iter_token_batches(X, vocab_ids, CLS_ID, PAD_ID, batch_size=10, max_length=64,
+                                      prefetch=2, num_workers=num_workers))
+    assert [rows for rows, _ in batches] == [slice(i, min(i + 10, 103)) for i in range(0, 103, 10)]
+    for rows, tokens in batches:
+        expected = _dynamic(X, vocab_ids, rows)
+        for key in expected:
+            np.testing.assert_array_equal(tokens[key], expected[key])
+
+
+def test_iter_token_batches_backed(tmp_path):
+    ad = pytest.importorskip("anndata")
+    X, genes, vocab = _data(n_cells=60)
+    path = str(tmp_path / "backed.h5ad")
+    adata = ad.AnnData(X)
+    adata.var_names = genes
+    adata.write_h5ad(path)
+
+    backed = ad.read_h5ad(path, backed='r')
+    try:
+        vocab_ids = vocab_lookup(list(backed.var_names), vocab)
+        for rows, tokens in iter_token_batches(backed.X, vocab_ids, CLS_ID, PAD_ID, batch_size=16, max_length=64):
+            np.testing.assert_array_equal(tokens['input_ids'], _dynamic(X, vocab_ids, rows)['input_ids'])
+    finally:
+        backed.file.close()
+
+
+def test_iter_token_batches_bounded_prefetch():
+    X, genes, vocab = _data(n_cells=200)
+    counting = _CountingMatrix(X)
+    batches = iter_token_batches(counting, vocab_lookup(genes, vocab), CLS_ID, PAD_ID, batch_size=10, prefetch=3)
+    next(batches)
+    # 取出第一批后最多读取 prefetch + 1 个批次（共20批）；提前关闭后剩余批次不再读取
+    assert len(counting.reads) <= 4
+    batches.close()
+    assert len(counting.reads) <= 4
+
+
+def test_dynamic_padding_and_token_lengths():
+    X, genes, vocab = _data()
+    vocab_ids = vocab_lookup(genes, vocab)
+    leading = [vocab["g1"]]
+    fixed = tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=64, leading_ids=leading)
+    dynamic = tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=64, leading_ids=leading, dynamic_padding=True)
+
+    lengths = token_lengths(X, vocab_ids, 64, leading)
+    np.testing.assert_array_equal(lengths, fixed['attention_mask'].sum(axis=1))
+    # 只填充到本批最长细胞的长度，截掉的部分全是填充
+    assert dynamic['input_ids'].shape[1] == lengths.max() < 64
+    for key in fixed:
+        np.testing.assert_array_equal(dynamic[key], fixed[key][:, :lengths.max()])
+    # 超过max_length时仍截断到max_length
+    assert tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=8, dynamic_padding=True)['input_ids'].shape[1] == 8
+
+
+def test_bucketed_batches_restore_cell_order():
+    X, genes, vocab = _data(n_cells=250, seed=1)
+    vocab_ids = vocab_lookup(genes, vocab)
+    reference = tokenize_csr(X, vocab_ids, CLS_ID, PAD_ID, max_length=64)
+
+    def padded_tokens(bucket_size):
+        total = 0
+        out = np.full_like(reference['input_ids'], -1)
+        seen = []
+        for rows, tokens in iter_token_batches(X, vocab_ids, CLS_ID, PAD_ID, batch_size=16, max_length=64,
+                                               bucket_size=bucket_size):
+            length = tokens['input_ids'].shape[1]
+            assert length == token_lengths(X[rows], vocab_ids, 64).max()
+            out[rows, :length] = tokens['input_ids']
+            out[rows, length:] = PAD_ID
+            seen.append(np.arange(X.shape[0])[rows])
+            total += tokens['input_ids'].size
+        # 按行号写回后与逐批不分桶的结果一致，每个细胞恰好出现一次
+        np.testing.assert_array_equal(out, reference['input_ids'])
+        np.testing.assert_array_equal(np.sort(np.concatenate(seen)), np.arange(X.shape[0]))
+        return total
+
+    # 窗口大小不是批大小的整数倍，最后一个窗口也不完整
+    assert padded_tokens(100) < padded_tokens(None)
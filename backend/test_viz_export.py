@@ -0,0 +1,87 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse as sp
+
+# 添加 backend 目录到 Python 路径
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from app.analysis.viz_export import (VIZ_DIR, export_visualization, read_column, read_gene, read_manifest,
+                                     top_marker_genes)
+
+ad = pytest.importorskip("anndata")
+
+
+def _adata(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    n_obs, n_vars = 200, 30
+    X = sp.random(n_obs, n_vars, density=0.2, format="csr", dtype=np.float32, random_state=seed)
+    adata = ad.AnnData(X)
+    adata.var_names = [f"g{i}" for i in range(n_vars)]
+    adata.obsm["X_umap"] = rng.standard_normal((n_obs, 2)).astype(np.float32)
+    adata.obs["leiden"] = pd.Categorical(rng.choice(["0", "1", "2"], size=n_obs))
+    adata.obs["predicted_cell_type"] = rng.choice(["T细胞", "B细胞"], size=n_obs)
+    adata.obs["total_counts"] = rng.uniform(100, 1000, size=n_obs)
+    # 每个簇的marker按排名排列，跨簇有重复基因
+    names = np.rec.fromarrays([["g1", "g2", "g3"], ["g2", "g4", "g5"], ["g6", "g1", "missing"]],
+                              names=["0", "1", "2"])
+    adata.uns["rank_genes_groups"] = {"names": names}
+    return adata
+
+
+def test_top_marker_genes():
+    adata = _adata()
+    assert top_marker_genes(adata, 2) == ["g1", "g2", "g6", "g4"]
+    assert top_marker_genes(adata, 10) == ["g1", "g2", "g6", "g4", "g3", "g5"]
+    del adata.uns["rank_genes_groups"]
+    assert top_marker_genes(adata) == []
+
+
+def test_export_round_trip(tmp_path):
+    adata = _adata()
+    manifest = export_visualization(adata, str(tmp_path), n_top_genes=1, genes=["g10", "g1", "absent"],
+                                    tile_capacity=64)
+    viz_dir = os.path.join(str(tmp_path), VIZ_DIR)
+    assert read_manifest(viz_dir) == manifest
+    assert manifest["n_cells"] == adata.n_obs
+    assert manifest["tiles"]
+
+    # 数值列
+    umap_x = np.frombuffer(read_column(viz_dir, manifest, "umap_x"), dtype="<f4")
+    np.testing.assert_array_equal(umap_x, adata.obsm["X_umap"][:, 0])
+    total_counts = np.frombuffer(read_column(viz_dir, manifest, "total_counts"), dtype="<f4")
+    np.testing.assert_allclose(total_counts, adata.obs["total_counts"].to_numpy(), rtol=1e-6)
+    assert "pct_counts_mt" not in manifest["columns"]
+
+    # 分类列：整数编码加类别名称
+    for name, key in [("cluster", "leiden"), ("cell_type", "predicted_cell_type")]:
+        column = manifest["columns"][name]
+        assert column["kind"] == "categorical" and column["dtype"] == "int8"
+        codes = np.frombuffer(read_column(viz_dir, manifest, name), dtype="<i1")
+        labels = np.asarray(column["categories"])[codes]
+        assert list(labels) == list(adata.obs[key].astype(str))
+
+    # 基因表达：簇marker在前，额外指定的基因去重追加，不存在的基因忽略
+    assert manifest["genes"] == ["g1", "g2", "g6", "g10"]
+    dense = adata.X.toarray()
+    for gene in manifest["genes"]:
+        values = np.frombuffer(read_gene(viz_dir, manifest, gene), dtype="<f4")
+        np.testing.assert_array_equal(values, dense[:, adata.var_names.get_loc(gene)])
+    with pytest.raises(ValueError):
+        read_gene(viz_dir, manifest, "g0")
+
+
+def test_export_dense_without_markers(tmp_path):
+    adata = _adata()
+    adata.X = adata.X.toarray()
+    del adata.uns["rank_genes_groups"]
+    manifest = export_visualization(adata, str(tmp_path))
+    assert manifest["genes"] == [] and manifest["gene_expression"] is None
+
+    manifest = export_visualization(adata, str(tmp_path), genes=["g3"])
+    viz_dir = os.path.join(str(tmp_path), VIZ_DIR)
+    values = np.frombuffer(read_gene(viz_dir, manifest, "g3"), dtype="<f4")
+    np.testing.assert_array_equal(values, adata.X[:, 3])